@@ -1,10 +1,25 @@
 from PyQt5.QtWidgets import *
+from PyQt5.QtCore import pyqtSignal
 import struct
+import queue
 import time
 import sys
+import yaml
 from Utils.Utils import *
 from Utils.benchmark_results_analysis import *
 from Utils.Comms import *
+from Utils.frame_cache import Frames_cache
+from Utils.stim_pool import Stim_pool
+from Utils.compositor import Compositor
+from Utils.tiled_output import Tiled_output
+from Utils.arduino_reader import Arduino_reader, RISING
+from Utils.control_server import Control_server
+from Utils.trigger_queue import Trigger_queue
+from Utils.sync_output import Sync_output, OFFSET
+from Utils.render_process import Render_process, READY, ONSET, END, ERROR, BG
+from Utils.params_snapshot import Params_snapshot, Snapshot_buffer
+from Utils.frame_state import Frame_state
+from Utils.latency_benchmark import Latency_recorder, timestamp_ns
 
 from App_UI import App_layout, App_control
 
@@ -14,6 +29,9 @@ from App_UI import App_layout, App_control
 
 
 class Main_UI(QWidget):
+    # Emitted from other threads [e.g. the control server] to set the background luminosity as if it was typed in the GUI
+    set_bg_signal = pyqtSignal(int)
+
     def __init__(self):
         """
         Initialise variables to control GUI behaviour
@@ -44,37 +62,52 @@ class Main_UI(QWidget):
         self.threadpool = QThreadPool()
         print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
-        # Loop to handle psychopy stim generation
-        psychopy_loop_worker = Worker(self.psychopy_loop)
-        self.threadpool.start(psychopy_loop_worker)  # Now the psychopy will keep looping
-
-        # Set up arduino commm in a separate loop
-        if self.use_arduino:
-            self.arduino_comm = SerialComms(self.arduino_comm)
-            if self.arduino_mode == 'read':
-                print("SETTING UP ARDUINO IN READ MODE")
-                # Use a worker to keep reading messages from the arduino
-                arduino_loop_worker = Worker(self.arduino_loop)
-                self.threadpool.start(arduino_loop_worker)  # Now the psychopy will keep looping
+        # Loop to handle psychopy stim generation: in this process or in a separate one
+        if self.settings.get('render_process', False):
+            self.render_process = Render_process(self.settings)
+            self.render_process.start()
+            render_process_worker = Worker(self.render_process_loop)
+            self.threadpool.start(render_process_worker)  # Now we will keep listening to the render process
+        else:
+            psychopy_loop_worker = Worker(self.psychopy_loop)
+            self.threadpool.start(psychopy_loop_worker)  # Now the psychopy will keep looping
 
         # Loop to handle mantis comms
-        # mantis_loop_worker = Worker(self.mantis_loop)
-        # self.threadpool.start(mantis_loop_worker)
+        if self.settings.get('use_mantis', False):
+            mantis_loop_worker = Worker(self.mantis_loop)
+            self.threadpool.start(mantis_loop_worker)
 
         # Create GUI UI
         App_layout.create_widgets(self)
         App_layout.define_layout(self)
         App_layout.define_style_sheet(self)
 
+        # Set up arduino commm in a separate loop [once the widgets exist, they set the background luminosity]
+        if self.use_arduino:
+            self.arduino_comm = SerialComms(self.arduino_comm, framed=self.settings.get('arduino_framed', False),
+                                            baud=self.settings.get('arduino_baud', None))
+            if self.arduino_mode == 'read':
+                print("SETTING UP ARDUINO IN READ MODE")
+                self.start_arduino_reader()
+
         # Load parameters YAML files
         App_control.get_stims_yaml_files_from_folder(self)
 
         # Load Audio WAV files
         App_control.get_audio_files_from_folder(self)
 
-        # Create stimuli log
+        # Create stimuli log, the stims launched are written to it by a background thread
         App_control.create_stim_log(self)
         self.stim_count = 0   # to keep track of stimuli in log
+        stim_log_worker = Worker(self.stim_log_loop)
+        self.threadpool.start(stim_log_worker)
+
+        # Local control server: lets other processes arm and trigger stims [once the widgets exist, it can edit them]
+        control_settings = self.settings.get('control_server', None) or {}
+        if control_settings.get('port', None) or control_settings.get('unix_path', None):
+            self.control_server = Control_server.for_main(self, port=control_settings.get('port', None),
+                                                          unix_path=control_settings.get('unix_path', None))
+            self.control_server.start()
 
     def initialise_variables(self):
         # initialise user name
@@ -85,9 +118,10 @@ class Main_UI(QWidget):
         # Dictionary of preparred stimuli and name of thr currently displayed stimulus
         self.prepared_stimuli = {}
         self.current_stim_params_displayed = ''
+        self.selected_stim = None  # stim selected in the list of loaded stims, set by the GUI thread
 
-        # Flag to cycle through multiple stims if playing >1 stim at the same time
-        self.playing_stim_num = 0
+        # Background luminosity and delay set in the GUI, published when a widget is edited [see Utils/params_snapshot.py]
+        self.params_buffer = Snapshot_buffer(Params_snapshot(bg_luminosity=int(self.settings['default_bg']), delay=0))
 
         # Stim parameters that should not be desplayed in the GUI [by name]
         self.ignored_params = ['name', 'units', 'type', 'modality', 'Stim type']
@@ -95,12 +129,45 @@ class Main_UI(QWidget):
         # Flags to handle stim generation
         """
         stim on            - stim currently being played
-        stim               - reference to stimulus object
-        stim_frames        - array of frames that are used to update stim
-        stim_frame_number  - keep track of progess when looping through stim_frames
+        compositor         - plays the stims of the segment being played, each one is a layer with its own frame
+                             schedule and z order [see Utils/compositor.py]
+        stim_pool          - psychopy stimulus objects created when the window starts and reused by all stims
+        tiled_output       - other displays showing the stims in lock-step with the main window [see
+                             Utils/tiled_output.py]
+        plays_audio        - audio stims are played by the main window [not by the tiles]
+        stim_stream        - Playlist of Stream_segment with the stims to play, set when a stim is launched
+        playing_stim       - Stream_segment [or Layered_segment] currently being played
+        stim_frame_number  - keep track of progess when looping through the frames of the current stim
+        lock_to_flip_time  - if True the frame to show is picked from the time of the last flip relative to the onset
+                             of the stim, so frames that were dropped are skipped instead of delaying the rest
+        stim_onset_time    - time of the flip that showed the first frame of the current stim [psychopy clock]
+        skipped_frames     - number of frames of the current stim that were skipped to keep up with the clock
         """
         self.stim_on = False
-        self.stim, self.audio_stim, self.stim_frames, self.stim_frame_number = None, None, False, False
+        self.compositor, self.stim_pool, self.stim_stream = None, None, None
+        self.tiled_output, self.plays_audio = None, True
+        self.trigger_queue = Trigger_queue.from_settings(self.settings)  # all triggers go through here
+        self.stim_log_queue = queue.Queue()  # stims launched, written to the stim log by stim_log_loop
+        self.control_server = None  # lets other processes control the stims [Utils/control_server.py]
+        self.sync_output = None  # writes sync bytes when stims appear and disappear [Utils/sync_output.py]
+        self.render_process = None  # set if the psychopy window is drawn by another process [Utils/render_process.py]
+        self.lock_to_flip_time = bool(self.settings.get('lock_to_flip_time', False))
+        self.stim_onset_time, self.last_flip_time, self.skipped_frames = None, None, 0
+        self.playing_stim, self.stim_frame_number = None, 0
+
+        # Geometry of the monitor used to calculate stim frames, set when psychopy starts
+        self.monitor_geometry = None
+
+        # Cache of calculated stim frames, so that a stim that is launched again doesn't need to be recalculated
+        self.frames_cache = Frames_cache(self.settings.get('frames_cache_folder', None),
+                                         max_memory_items=int(self.settings.get('frames_cache_memory_items', 32)),
+                                         max_disk_mb=int(self.settings.get('frames_cache_size_mb', 500)))
+
+        # Loaded stims whose frames have already been calculated in the background: name -> (key, params, schedule)
+        self.armed_stims = {}
+
+        # Last values pushed to psychopy [background, square color, stim radius...], to only push the ones that change
+        self.frame_state = Frame_state()
 
         # Keep track of how long it takes to draw on the psyspy window
         self.last_draw, self.draws = 0, []
@@ -130,9 +197,16 @@ class Main_UI(QWidget):
                                     'Draw duration avg': [],
                                     'Draw duration std': [],
                                     'Number frames per stim': [],
-                                    'Number dropped frames': []}
+                                    'Number dropped frames': [],
+                                    'Number skipped frames': []}
         self.tests_done, self.number_of_tests = 0, 250
 
+        # Trigger to photon latency benchmark [see Utils/latency_benchmark.py], None if it is not running
+        if self.settings.get('latency_benchmark', False):
+            self.latency_recorder = Latency_recorder(int(self.settings.get('latency_benchmark_trials', 300)))
+        else:
+            self.latency_recorder = None
+
         # flag for arduino status
         self.use_arduino = self.settings['use_arduino']
         self.arduino_comm = self.settings['arduino_comm']
@@ -143,11 +217,12 @@ class Main_UI(QWidget):
             self.arduino_mode = 'read' # ? Command is used to send commands to the arduino through the USB, read to read stuff sent from the arduino through the USB
         
         self.arduino_status = False  # Used in read mode
-        self.arduino_prev_value = 0  # Used in read mode
+        self.arduino_reader = None  # Used in read mode, set when the serial port is opened
         self.arduino_background_colors = dict(background=int(self.settings['default_bg']), shelter=0)  # Used in read mode
         self.arduino_command = self.settings['arduino_command']  # Used in command mode
 
-        self.ignore_UI_luminosity = False   # if true arduino sets the background luminosity, not the user
+        # if true arduino sets the background luminosity, not the user
+        self.ignore_UI_luminosity = bool(self.settings.get('ignore_UI_luminosity', False))
 
         print("""
             Use arduino: {}
@@ -166,8 +241,10 @@ class Main_UI(QWidget):
         from psychopy import visual, logging  # This needs to be here, it can't be outside the threat the window is created from
         print('First psychopy import took: {}'.format((time.clock()-t)*1000))
 
-        # Create monitor object
-        monitor, screen_number = monitor_def(self.settings)
+        # Create monitor object. The geometry is all the stimuli calculator needs, so frames can be computed
+        # without touching the psychopy window
+        self.monitor_geometry = Monitor_geometry.from_settings(self.settings)
+        monitor, screen_number = monitor_def(self.settings, geometry=self.monitor_geometry)
 
         # Get params to create a window from settings
         size = self.settings['wnd_PxSize']  # Get size from the settings (specified in GUI_cfg.yml
@@ -177,8 +254,10 @@ class Main_UI(QWidget):
             size = (size.split(',')[0], size.split(',')[1])
 
         col = map_color_scale(int(self.settings['default_bg']))  # Get default background color and update bg widget
+        bg_luminosity = int(map_color_scale(col, reversed=True))
         self.params_widgets_dict['Background Luminosity']['Background Luminosity'][1].setText(
-            str(int(map_color_scale(col, reversed=True))))  # Update the BG color widget
+            str(bg_luminosity))  # Update the BG color widget
+        self.params_buffer.publish(Params_snapshot(bg_luminosity, self.params_buffer.read().delay))
 
         # Create a window, get mseconds per screen refresh
         self.psypy_window = visual.Window([int(size[0]), int(size[1])], monitor=monitor, color=[col, col, col],
@@ -189,11 +268,29 @@ class Main_UI(QWidget):
         self.psypy_window.refreshThreshold = self.screenMs + 5  # ms per screen + 5 is our threshold for dropped frames
         logging.console.setLevel(logging.WARNING)
 
+        # Create the stimulus objects now, so that it doesn't happen at the onset of a stimulus
+        self.stim_pool = Stim_pool(self.psypy_window)
+        pool_units = [self.settings['unit']] + [u for u in ['cm', 'deg'] if u != self.settings['unit']]
+        self.stim_pool.prebuild(pool_units)
+        self.psypy_window.flip()
+        self.compositor = Compositor(self.stim_pool)
+
+        # Open the windows on the other displays, if any are listed in the settings
+        self.tiled_output = Tiled_output.from_settings(self.settings)
+        self.tiled_output.open(pool_units)
+
+        # Digital sync output, if a port is set in the settings
+        self.sync_output = Sync_output.from_settings(self.settings)
+
         # Get position of the square stimulus [if on]
         if self.settings['square on']:
-            self.square_pos = get_position_in_px(self.psypy_window, self.settings['square pos'],
+            self.square_pos = get_position_in_px(self.monitor_geometry, self.settings['square pos'],
                                                     self.settings['square width'])
 
+        # Now that the monitor is known, calculate the frames of the stims that were loaded before the window opened
+        for stim_name in list(self.prepared_stimuli.keys()):
+            App_control.arm_stim(self, stim_name)
+
         # Update status
         self.ready = 'Ready'
 
@@ -218,154 +315,23 @@ class Main_UI(QWidget):
         else:
             lum = int(lum)
 
-        # update the window color
-        lum = map_color_scale(lum)
-        prev_lum = self.psypy_window.color[0]
-        if not prev_lum == lum:  # only update the background color if we actually changed it
+        # update the window color, only if we actually changed it
+        if self.frame_state.changed('bg', lum):
+            lum = map_color_scale(lum)
             self.psypy_window.setColor([lum, lum, lum])
 
-    def stim_creator(self, stim=None):
+    def stim_creator(self):
         """
-        Creates and initialises stimuli, including the LDR square.
-        If the stimuli have been already created, update their properties accordingly (e.g. change radius of expanding
-        loom).
+        Updates the stimuli being played with their values for the current frame [the renderer of each layer of the
+        compositor creates the psychopy stimulus at the first frame], and draws the LDR square. The stimuli are drawn
+        in the main loop.
         """
-        # Need to import from psychopy here or it gives an error. Takes <<1 ms
-        from psychopy import visual, core, sound
-
-        # Create the visual stimuli
-        if self.stim_on:
-            if stim is None:
-                selected_stim = self.loaded_stims_list.currentItem()
-                if selected_stim is None:
-                    selected_stim = self.current_stim_params_displayed
-                else:
-                    selected_stim = selected_stim.text()
-                if not '.wav' in selected_stim:
-                    params = self.prepared_stimuli[selected_stim]
-                else:
-                    params = dict(type='audio')
-                frames = self.stim_frames
-            else:
-                if 'delay' in stim:
-                    params = dict(type='delay')
-                else:
-                    params = self.prepared_stimuli[stim.split('__')[1]]
-                    if isinstance(params, str):
-                        params = dict(type='audio')
-                frames = self.stim_frames[stim]
-
-            # Create a LOOM
-            if 'loom' == params['type'].lower():
-                pos = frames[0]
-                radii = frames[1]
-
-                color = int(params['color'])
-                if color < 0: color=0
-                elif color > 255: color=255
-
-                if self.stim is None:
-                    self.stim_timer = time.clock()  # Time lifespan of the stim
-                    self.stim = visual.Circle(self.psypy_window, radius=float(params['start_size']), edges=64,
-                                                units=params['units'], pos=pos, fillColorSpace='rgb255',
-                                                lineColorSpace='rgb255',
-                                                lineColor=color, fillColor=color)
-                self.stim.radius = radii[self.stim_frame_number]
-
-            # Create SPOT to LOOM
-            if 'spot_loom' == params['type'].lower():
-                if self.stim is None:
-                    self.stim_timer = time.clock()  # Time lifespan of the stim
-                    self.stim = visual.Circle(self.psypy_window, radius=float(frames[2, 0]), edges=64,
-                                                units=params['units'], pos=(frames[0, 0], frames[1, 0]),
-                                                lineColor='#000000', fillColor='#000000')
-                self.stim.pos = (frames[0, self.stim_frame_number], frames[1, self.stim_frame_number])
-                self.stim.radius = frames[2, self.stim_frame_number]
-
-            # Create a GRATING
-            if 'grating' in params['type'].lower():
-                pos = frames[0]
-                size = frames[1]
-                phases = frames[-1]
-                ori = frames[2]
-                fg_col = frames[3]
-
-                if self.stim is None:
-                    self.stim_timer = time.clock()  # Time lifespan of the stim
-                    self.stim = visual.GratingStim(win=self.psypy_window, size=size, pos=pos, ori=ori, color=fg_col,
-                                                    sf=params['spatial frequency'], units=params['units'], interpolate=True)
-                self.stim.phase = phases[self.stim_frame_number]
-
-            # play AUDIO
-            if 'audio' in params['type'].lower():
-                if self.stim_frame_number == 0:
-                    # from psychopy import sound
-                    self.stim_timer = time.clock()  # Time lifespan of the stim
-                    try:
-                        if stim is None:
-                            self.audio_stim = sound.Sound(self.prepared_stimuli[selected_stim])
-                        else:
-                            try:
-                                self.audio_stim = sound.Sound(self.prepared_stimuli[stim.split('__')[1]])
-                            except:
-                                self.audio_stim = sound.Sound(self.prepared_stimuli[stim])
-                        self.audio_stim.hamming = False
-                        vol = self.settings['Volume']
-                        self.audio_stim.volume = vol
-                        self.audio_stim.play()
-                    except:
-                        print('At the moment cannot play more than one audio stim at the same time')
-
-            # Play complex fear conditioning stimulus
-            if 'fearcond_copmlex' in params['type'].lower():
-                try:
-                    grating_params = self.stim_frames[0].iloc[self.stim_frame_number]
-                except:
-                    return
-
-                if grating_params.blackout_on:
-                    self.bg_luminosity = 0
-                else:
-                    self.bg_luminosity = self.settings['default_bg']
-                self.change_bg_lum()
-
-                if grating_params.grating_on:
-                    self.stim_timer = time.clock()  # Time lifespan of the stim
-                    if not  params['flash_screen']:
-                        if self.stim is None:
-                            # We need to create the stim
-                            self.trialClock = core.Clock()
-                            self.stim = visual.GratingStim(win=self.psypy_window, size=self.stim_frames[2],
-                                                            pos=self.stim_frames[1], ori=grating_params.grating_orientation,
-                                                            color=map_color_scale(grating_params.grating_contrast),
-                                                            sf=params['spatial frequency'], units=params['units'],
-                                                            interpolate=True)
-                        else:
-                            self.stim.ori = grating_params.grating_orientation
-                            if grating_params.grating_direction < 0:
-                                self.stim.ori += 180
-
-                            self.stim.color = map_color_scale(grating_params.grating_contrast)
-                            t = self.trialClock.getTime()
-                            self.stim.phase = t*round(int(params['Velocity']))
-                    else:
-                        self.bg_luminosity = grating_params.blackout_on
-                        self.change_bg_lum()
-
-                else:
-                    if self.stim is not None:
-                        self.stim = None
-
-                if grating_params.ultrasound_on:
-                    if self.audio_stim is None:
-                        self.audio_stim = sound.Sound(params['audiostim'])
-                        vol = self.settings['Volume']
-                        self.audio_stim.volume = vol
-                        self.audio_stim.play()
-
-            # play DELAY
-            if 'delay' in params['type'].lower():
-                pass  # at the moment the code doesn't require any changes when we are producing the delay
+        # Create or update the visual stimuli
+        if self.stim_on and self.playing_stim is not None:
+            self.compositor.update(self, self.stim_frame_number)
+            self.tiled_output.update(self.stim_frame_number, self.bg_luminosity)
+        else:
+            self.tiled_output.update(None, self.bg_luminosity)
 
         # Create the square for Light Dependant Resistors [change color depending of if other stims are on or not
         if self.settings['square on']:
@@ -375,170 +341,221 @@ class Main_UI(QWidget):
                 col = -map_color_scale(self.settings['square default col'])
 
             if self.square is None:
+                from psychopy import visual  # Need to import from psychopy here or it gives an error
                 self.square = visual.Rect(self.psypy_window, width=self.settings['square width'],
                                         height=self.settings['square width'], pos=self.square_pos, units='cm',
                                         lineColor=[col, col, col], fillColor=[col, col, col])
-            else:
+                self.frame_state.changed('square color', col)
+            elif self.frame_state.changed('square color', col):
                 self.square.setFillColor([col, col, col])
             self.square.draw()
 
+    def load_next_stim(self):
+        """
+        Get the next stim from the playlist and get ready to play it.
+        Returns False if there are no more stims to play
+        """
+        segment = next(self.stim_stream, None)
+        while segment is not None and not segment.n_frames:
+            segment = next(self.stim_stream, None)  # nothing to play
+        if segment is None:
+            return False
+
+        self.playing_stim = segment
+        self.compositor.add_layers(segment.layers)
+        self.tiled_output.load_segment(segment, self.frames_cache.get_schedule, self.screenMs)
+        self.stim_frame_number = 0
+        self.stim_onset_time, self.skipped_frames = None, 0
+        self.stim_timer = time.clock()
+        self.psypy_window.recordFrameIntervals = True  # Record if we drop frames during stim generation
+        return True
+
+    def frame_number_from_flip_time(self):
+        """
+        Set stim_frame_number to the frame that should be shown at the next flip given the time elapsed since the
+        onset of the stim. If frames were dropped the ones that should have been shown meanwhile are skipped, so that
+        the stim stays locked to the clock instead of being stretched
+        """
+        if not self.stim_frame_number or self.stim_onset_time is None or self.last_flip_time is None:
+            return  # onset not shown yet
+        expected = int(round((self.last_flip_time - self.stim_onset_time) * 1000 / self.screenMs)) + 1
+        expected = min(expected, self.playing_stim.n_frames - 1)  # always show the last frame
+        if expected > self.stim_frame_number:
+            self.skipped_frames += expected - self.stim_frame_number
+            self.stim_frame_number = expected
+
     def stim_manager(self):
         """
         When the launch button gets called:
-        * The stimulus frames get calculated (e.g. for looms the number of frames it will take to expand and the radii at all steps)
+        * A playlist with the stimuli to play is compiled, with the frames of each stimulus
+            (e.g. for looms the number of frames it will take to expand and the radii at all steps)
         * This function creates the stimulus object
-        * Everytime stim_manager is called it loops over the stimulus frames and updates it
-        * When all frames have been played, the window is cleaned
+        * Everytime stim_manager is called it updates the stimulus with the values for the next frame of its schedule
+        * When all frames have been played, the window is cleaned and the next stimulus in the playlist is loaded
         """
         if self.stim_on:
-            if isinstance(self.stim_frames, bool):
-                """" if it is we havent generated the stim frames yet
-                This is due to the fact that the frames are generated in another thread and the
+            if self.stim_stream is None:
+                """" if it is we havent launched the stim yet
+                This is due to the fact that the stims are launched in another thread and the
                 that might have not been done by the time that stim_manager is called in the main loop
-                Just exit the function to avoid problems. Alternatively it could be an audio stim, in which case
-                just play the .wav file """
+                Just exit the function to avoid problems. """
                 return
 
-            # If stim is just being created, start clock to time its duration
-            if not self.stim_frame_number:
-                self.psypy_window.recordFrameIntervals = True  # Record if we drop frames during stim generation
+            # If stim is just being created, get its frames and start clock to time its duration
+            if self.playing_stim is None:
+                if not self.load_next_stim():
+                    self.end_stims()
+                    return
+
                 self.ready = 'Busy'
                 # Update status label
                 App_control.update_status_label(self)
-                # Initialise variable to keep track of progress during stim updates
-                self.stim_frame_number = 0
 
-            # Create or update the stimulus object
-            if not isinstance(self.stim_frames, dict):
-                self.stim_creator()
-            else:
-                stim_name = sorted(list(self.stim_frames.keys()))[self.playing_stim_num]
-                self.stim_creator(stim_name)
+            # Pick the frame that should be on screen at the next flip, skipping those we didn't have time to show
+            if self.lock_to_flip_time:
+                self.frame_number_from_flip_time()
+
+            # Create or update the stimulus object with its values for this frame
+            self.stim_creator()
+            if self.latency_recorder is not None and self.stim_frame_number == 0:
+                self.latency_recorder.first_frame_drawn()
+            if self.sync_output is not None:
+                self.sync_output.on_frame(self.psypy_window, self.stim_frame_number)
 
             # Keep track of our progress as we update the stim
             self.stim_frame_number += 1
 
             # At conclusion of the stimulus...
-            if not isinstance(self.stim_frames, dict):
-                if isinstance(self.stim_frames[-1], int):
-                    self.stim_frames = list(self.stim_frames)
-                    self.stim_frames[-1] = np.linspace(0,self.stim_frames[-1], self.stim_frames[-1]-1)
-                if self.stim_frame_number == len(self.stim_frames[-1]):
-                    # the last elemnt in stim frames is as long as the duration of the stim
-                    self.psypy_window.flip()  # Flip here to make sure that last frame lasts as long as the others
-
-                    # Keep track of stim lifespan
-                    elapsed = time.clock() - self.stim_timer
-                    print('     ... stim duration: {}'.format(round(elapsed * 1000),2))
-
-                    # Keep track of time it took to update (draw) each frame
-                    self.draws = np.array(self.psypy_window.frameIntervals)
-                    print('     ... number of exp frames {}, number of intervals {}'.format(round(self.stim_frame_number,2),
-                                                                                    len(self.psypy_window.frameIntervals)))
-                    self.psypy_window.frameIntervals = []
-                    self.psypy_window.recordFrameIntervals = False
-
-                    all_draws, avg_draw, std_draw = self.draws.copy(), np.mean(self.draws), np.std(self.draws)
-                    print('     ... avg time between draws: {}, std {}'.format(round(avg_draw*1000,2), round(std_draw,1)))
-                    self.draws = []
-
-                    if self.benchmarking:
-                        # Store results
-                        print('----->>> {} frames where dropped'.format(self.psypy_window.nDroppedFrames))
-                        self.benchmark_results['Stim name'] = self.current_stim_params_displayed
-                        self.benchmark_results['Monitor name'] = self.psypy_window.monitor.name
-                        self.benchmark_results['Number dropped frames'].append(self.psypy_window.nDroppedFrames)
-                        self.benchmark_results['Ms per frame'] = self.screenMs
-                        self.benchmark_results['Stim duration'].append(elapsed)
-                        self.benchmark_results['Draw duration all'].append(all_draws)
-                        self.benchmark_results['Draw duration avg'].append(avg_draw)
-                        self.benchmark_results['Draw duration std'].append(std_draw)
-                        self.benchmark_results['Number frames per stim'].append(len(self.stim_frames[-1]))
-
-                        self.tests_done += 1
-
-                    # After everything is done, clean up
-                    self.stim, self.audio_stim = None, None
-                    self.stim_frames = False
-                    self.stim_frame_number = False
-                    self.stim_on = False
-
-                    # Update status label
-                    self.ready = 'Ready'
-                    App_control.update_status_label(self)
-
-            else:
-                # if we are playing multiple stims in a row the way the stim managare handles is different from
-                # single stims
-                stim_name = sorted(list(self.stim_frames.keys()))[self.playing_stim_num]
-                if self.stim_frame_number == len(self.stim_frames[stim_name][-1]):
-
-                    self.psypy_window.flip()
-                    self.stim = None
-                    self.stim_frame_number = 0
-                    self.playing_stim_num += 1
-
-                    if self.playing_stim_num >= len(list(self.stim_frames.keys())):  # played all stims
-                        # After everything is done, clean up
-                        self.stim = None
-                        self.audio_stim = None
-                        self.stim_frames = False
-                        self.stim_frame_number = False
-                        self.stim_on = False
-                        self.playing_stim_num = 0
-                        # Update status label
-                        self.ready = 'Ready'
-                        App_control.update_status_label(self)
+            if self.stim_frame_number >= self.playing_stim.n_frames:
+                # Flip here to make sure that last frame lasts as long as the others
+                self.tiled_output.flip(playing=True)
+                self.after_flip(self.psypy_window.flip())
+
+                # Keep track of stim lifespan
+                elapsed = time.clock() - self.stim_timer
+                print('     ... stim duration: {}'.format(round(elapsed * 1000),2))
+
+                # Keep track of time it took to update (draw) each frame
+                self.draws = np.array(self.psypy_window.frameIntervals)
+                print('     ... number of exp frames {}, number of intervals {}'.format(round(self.stim_frame_number,2),
+                                                                                len(self.psypy_window.frameIntervals)))
+                self.psypy_window.frameIntervals = []
+                self.psypy_window.recordFrameIntervals = False
+
+                all_draws, avg_draw, std_draw = self.draws.copy(), np.mean(self.draws), np.std(self.draws)
+                print('     ... avg time between draws: {}, std {}'.format(round(avg_draw*1000,2), round(std_draw,1)))
+                if self.lock_to_flip_time:
+                    print('     ... frames skipped to keep up with the clock: {}'.format(self.skipped_frames))
+                self.draws = []
+
+                if self.benchmarking:
+                    # Store results
+                    print('----->>> {} frames where dropped'.format(self.psypy_window.nDroppedFrames))
+                    self.benchmark_results['Stim name'] = self.current_stim_params_displayed
+                    self.benchmark_results['Monitor name'] = self.psypy_window.monitor.name
+                    self.benchmark_results['Number dropped frames'].append(self.psypy_window.nDroppedFrames)
+                    self.benchmark_results['Ms per frame'] = self.screenMs
+                    self.benchmark_results['Stim duration'].append(elapsed)
+                    self.benchmark_results['Draw duration all'].append(all_draws)
+                    self.benchmark_results['Draw duration avg'].append(avg_draw)
+                    self.benchmark_results['Draw duration std'].append(std_draw)
+                    self.benchmark_results['Number frames per stim'].append(self.playing_stim.n_frames)
+                    self.benchmark_results['Number skipped frames'].append(self.skipped_frames)
+
+                    self.tests_done += 1
+
+                self.tiled_output.print_flip_issue_time()
+                self.trigger_queue.print_summary()
+                if self.sync_output is not None:
+                    self.sync_output.print_summary()
+
+                # Get the next stim in the playlist ready, or clean up if we are done
+                self.compositor.clear()
+                self.tiled_output.clear()
+                if self.sync_output is not None:
+                    self.sync_output.on_next_flip(self.psypy_window, OFFSET)  # the next flip clears the stim
+                if not self.load_next_stim():
+                    self.end_stims()
         else:
             # Call stim creator anyway so that we can update the color of the LDR sqare if one is present
             self.stim_creator()
 
+    def end_stims(self):
+        """ After everything is done, clean up """
+        self.compositor.clear()
+        self.tiled_output.clear()
+        self.stim_stream, self.playing_stim, self.stim_frame_number = None, None, 0
+        self.stim_on = False
+
+        # Update status label
+        self.ready = 'Ready'
+        App_control.update_status_label(self)
+
     ####################################################################################################################
     """  NI BOARD and Arduino functions  """
     ####################################################################################################################
 
-    def arduino_loop(self):
-        """[This loop keeps reading the signals coming from arduino and changes the background luminance accordingly]
+    def start_arduino_reader(self):
         """
-        while True:
-            self.arduino_manager()
+            Check that the arduino signal can be handled for this user, then start reading it: a thread keeps reading
+            from the arduino and the render loop handles the edges it detects [see arduino_manager].
+            If it can't be handled the arduino isn't read, the render loop doesn't stop
+        """
+        if self.user not in ('Yaara', 'Sarah'):
+            print('User: {}  --- not recognised, the arduino signal will not be read'.format(self.user))
+            return
+        if self.user == 'Yaara' and not self.ignore_UI_luminosity:
+            print('For the code to work properly the UI luminosity needs to be overridden [ignore_UI_luminosity in '
+                  'GUI_cfg.yml], the arduino signal will not be read')
+            return
+
+        if self.arduino_comm.link is not None:
+            self.arduino_reader = self.arduino_comm.link  # the arduino sends the edges as EVENT frames
+        else:
+            self.arduino_reader = Arduino_reader(self.arduino_comm.ser,
+                                                 threshold=self.settings.get('arduino_threshold', 1))
+            self.arduino_reader.start()
+
+        if self.user == 'Yaara':
+            # Start from the background luminance, the arduino toggles it to the shelter one and back
+            self.arduino_status = False
+            self.set_arduino_bg_luminosity()
+
+    def set_arduino_bg_luminosity(self):
+        """ Set the background luminance that matches the status of the arduino signal [Yaara] """
+        if self.arduino_status:
+            self.bg_luminosity = self.arduino_background_colors['shelter']
+        else:
+            self.bg_luminosity = self.arduino_background_colors['background']
+        if self.render_process is not None:
+            self.render_process.set_bg(self.bg_luminosity)
 
     def arduino_manager(self):
             """
-                The following code handles the change of the background luminance based on a signal received from the arduino
-                This code was developed for and used by Yaara
+                Called by the render loop once per frame: handles the edges of the arduino signal detected since the
+                last frame [see Utils/arduino_reader.py].
+                For Yaara each rising edge toggles the background luminance, for Sarah it launches a stim.
+                Events that can't be handled are printed and skipped, they must not stop the render loop
             """
-            if not self.ignore_UI_luminosity and self.user == 'Yaara':
-                raise ValueError('For the code to work properly the UI luminosity needs to be overridden')
-            
-            try:
-                val = int(self.arduino_comm.read_value())
-                print(val)
-            except:
+            if self.arduino_reader is None:
                 return
 
+            for event in self.arduino_reader.get_events():
+                try:
+                    if event.edge != RISING:
+                        continue
 
-            if self.user == 'Yaara':
-                if val == 1 and self.arduino_prev_value != val:
-                    self.arduino_prev_value = val
-                    self.arduino_status = not self.arduino_status
-                    print('Changed to {}'.format(self.arduino_status))
-                elif val == 0 and self.arduino_prev_value:
-                    self.arduino_prev_value = 0
-
-                if self.arduino_status:
-                    self.bg_luminosity = self.arduino_background_colors['shelter']
-                else:
-                    self.bg_luminosity = self.arduino_background_colors['background']
-
-            elif self.user == 'Sarah':
-                if val == 1 and self.ready == 'Ready': # ? if we recieve the signal and we are not currently running a stimulus, launcha a stim
-                    App_control.launch_stim(self)
-            else:
-                raise ValueError('User: {}  --- not recognised'.format(self.user))
+                    if self.user == 'Yaara':
+                        self.arduino_status = not self.arduino_status
+                        print('Changed to {}'.format(self.arduino_status))
+                        self.set_arduino_bg_luminosity()
 
+                    elif self.user == 'Sarah':
+                        # launch a stim, the trigger queue drops it [or keeps it for later] if a stim is running
+                        App_control.launch_stim(self, source='arduino', trigger_ns=event.t_ns)
+                except Exception as e:
+                    print('Could not handle arduino event {}: {}'.format(event, e))
 
-        
 
     ####################################################################################################################
     """    MAIN LOOP  """
@@ -561,7 +578,7 @@ class Main_UI(QWidget):
 
         while True:  # Keep looping in sync with the screen refresh rate, check the params and update stuff
             if self.benchmarking:
-                if self.ready == 'Ready':
+                if self.ready == 'Ready' and not self.trigger_queue.has_pending():
                     if self.tests_done >= self.number_of_tests:
                         self.benchmarking = False
                         self.stim_on = False
@@ -574,11 +591,17 @@ class Main_UI(QWidget):
                         self.psypy_window.flip()
 
                         print('\nTest {}'.format(self.tests_done))
-                        App_control.launch_stim(self)
+                        App_control.launch_stim(self, source='benchmark')
+
+            # Handle the signals received from the arduino since the last frame
+            self.arduino_manager()
+
+            # Start a stim if one was triggered
+            self.handle_triggers()
 
-            # Update parameters
-            if self.ready == 'Ready':
-                App_control.read_from_params_widgets(self)
+            # Update parameters [published by the GUI thread when they are edited]
+            if self.ready == 'Ready' and not self.ignore_UI_luminosity:
+                self.bg_luminosity = self.params_buffer.read().bg_luminosity
 
             # Update background
             self.change_bg_lum()
@@ -586,34 +609,114 @@ class Main_UI(QWidget):
             # Generate, update and clean up stimuli
             self.stim_manager()
 
-            # Draw stims and update psychopy window
+            # Draw stims and update psychopy window [the LDR square is drawn by stim_creator]
             try:
-                if self.settings['square on'] and self.square is not None:
-                    self.square.draw()
+                self.compositor.draw()
+                self.tiled_output.draw()
 
-                if self.stim is not None:
-                    self.stim.draw()
+                self.tiled_output.flip(playing=self.stim_on)  # tiles don't wait for the refresh, the main window does
 
-                self.psypy_window.flip()
+                self.after_flip(self.psypy_window.flip())
             except:
                 print('Didnt flip')
 
+    def handle_triggers(self):
+        """ Called by the render loop at the start of each frame: play the next trigger in the queue, if a stim can
+        be played now [see Utils/trigger_queue.py] """
+        now_ns = timestamp_ns()
+        trigger = self.trigger_queue.next_trigger(busy=self.stim_on or self.ready != 'Ready', now_ns=now_ns)
+        if trigger is not None:
+            launched = trigger.play(self, trigger.source, trigger.t_ns, trigger.stim_name)
+            self.trigger_queue.played(bool(launched), now_ns)
+
+    def after_flip(self, flip_time):
+        """
+        Keep track of when the frames of the stim are shown
+
+        :param flip_time: time of the flip returned by window.flip() [psychopy clock]
+        """
+        self.last_flip_time = flip_time
+        if self.stim_onset_time is None and self.playing_stim is not None and self.stim_frame_number:
+            self.stim_onset_time = flip_time  # first frame of the stim has just been shown
+
+        # If the latency benchmark is running, record the time at which the first frame of a stim was shown
+        if self.latency_recorder is not None and self.latency_recorder.flipped() and self.latency_recorder.done:
+            plotting_worker = Worker(plot_latency_results, self.latency_recorder)
+            self.threadpool.start(plotting_worker)
+            self.latency_recorder = None
+
+    def render_process_loop(self):
+        """
+        When the psychopy window is drawn by a separate process, keep reading the telemetry it sends back [see
+        Utils/render_process.py] to update the status of the GUI and keep track of the stims played
+        """
+        while True:
+            self.arduino_manager()
+            self.handle_triggers()
+            for kind, t_ns, value, payload in self.render_process.read_telemetry():
+                if kind == READY:
+                    self.screenMs = value
+                    self.monitor_geometry = Monitor_geometry.from_settings(self.settings)
+                    self.ready = 'Ready'
+                    App_control.update_status_label(self)
+                    print('Render process ready, mS per frame: {}'.format(round(value, 2)))
+
+                elif kind == ONSET:
+                    print('     ... {} shown {} ms after the trigger'.format(payload.decode(), round(value, 2)))
+                    if self.latency_recorder is not None:
+                        self.latency_recorder.first_frame_drawn()
+                        if self.latency_recorder.flipped(flip_ns=t_ns) and self.latency_recorder.done:
+                            plotting_worker = Worker(plot_latency_results, self.latency_recorder)
+                            self.threadpool.start(plotting_worker)
+                            self.latency_recorder = None
+                    App_control.update_status_label(self)
+
+                elif kind == END:
+                    print('     ... {} done, {} frames where dropped'.format(payload.decode(), int(value)))
+                    self.trigger_queue.print_summary()
+                    self.ready = 'Ready'
+                    App_control.update_status_label(self)
+
+                elif kind == BG:
+                    self.bg_luminosity = int(value)  # set by the GUI, the arduino or a stim being played
+
+                elif kind == ERROR:
+                    print('Render process: {}'.format(payload.decode()))
+                    if self.ready == 'Busy':
+                        self.ready = 'Ready'
+                        App_control.update_status_label(self)
+            time.sleep(0.001)
+
+    def stim_log_loop(self):
+        """
+        Write the stims launched to the stims log. The render loop only puts them in a queue [see
+        App_control.log_stim], so that there is no disk I/O between a trigger and the onset of the stim
+        """
+        while True:
+            stim_count, params = self.stim_log_queue.get()
+            try:
+                with open(self.stim_log_path, 'a') as outfile:
+                    yaml.dump({"Stim {}".format(stim_count): params}, outfile, default_flow_style=False)
+            except Exception as e:
+                print('Could not write stim {} to the log: {}'.format(stim_count, e))
+
     ####################################################################################################################
     """    MANTIS COMMS LOOP  """
     ####################################################################################################################
     def mantis_loop(self):
         """
         Set up mantis server comms.
-        Then keep looping and receive commands from mantis, parse them correctly.
+        Then keep receiving commands from mantis [from all the clients connected], parse them correctly.
         if the correct message is received a stimulus is triggered by MantisComms
         """
         # Set up mantis comms
-        self.mantis_coms = MantisComms(self)
+        self.mantis_coms = MantisComms(self, port=int(self.settings.get('mantis_port', 8079)),
+                                       max_clients=int(self.settings.get('mantis_max_clients', 4)),
+                                       detector_settings=self.settings.get('mantis_detector', None))
         print("Mantis comms started")
 
-        # Keep looping and reading data
-        while True:
-            self.mantis_coms.receive()
+        # Keep serving the clients
+        self.mantis_coms.run()
 
 ####################################################################################################################
 ####################################################################################################################
@@ -7,7 +7,12 @@ import numpy as np
 import yaml
 import datetime
 import warnings
-from Utils.Utils import Stimuli_calculator, get_files, get_list_widget_items, load_yaml, get_param_val, get_param_label
+from Utils.Utils import Worker, Stimuli_calculator, get_files, get_list_widget_items, load_yaml, get_param_val, \
+    get_param_label
+from Utils.frame_cache import Frames_cache
+from Utils.stim_stream import Stream_segment, Layered_segment, Playlist, compile_playlist
+from Utils.params_snapshot import Params_snapshot, parse_int
+from Utils.latency_benchmark import timestamp_ns
 
 ####################################################################################################################
 """    DEFINE THE LAYOUT AND LOOKS OF THE GUI  """
@@ -42,6 +47,8 @@ class App_layout():
         self.laoded_stims_label = QLabel('Loaded stims')
         self.loaded_stims_list = QListWidget()
         self.loaded_stims_list.currentItemChanged.connect(lambda: App_control.update_params_widgets)
+        self.loaded_stims_list.currentItemChanged.connect(
+            lambda current, previous: App_control.select_loaded_stim(self, current))
         self.loaded_stims_list.itemDoubleClicked.connect(lambda: App_control.remove_loaded_stim_from_widget_list(self))
 
         # current open stim
@@ -70,6 +77,11 @@ class App_layout():
         param = {self.delay_label.text(): [self.delay_label, self.delay_edit]}
         self.params_widgets_dict[self.delay_label.text()] = param
 
+        # When the user edits a parameter, publish the new values for the render loop
+        self.bg_edit.textEdited.connect(lambda: App_control.read_from_params_widgets(self))
+        self.delay_edit.textEdited.connect(lambda: App_control.read_from_params_widgets(self))
+        self.set_bg_signal.connect(lambda bg_luminosity: App_control.set_bg_luminosity(self, bg_luminosity))
+
         # arduino btn
         if self.use_arduino and not self.arduino_slave_mode:  # only show the trigger arduino button if relevant
             self.arduino_btn = QPushButton(text='Trigger Arduino')
@@ -79,6 +91,10 @@ class App_layout():
         self.launch_btn = QPushButton(text='Launch')
         self.launch_btn.clicked.connect(lambda: App_control.launch_stim(self))
 
+        # Launch together btn: play all loaded stims at the same time
+        self.launch_together_btn = QPushButton(text='Launch together')
+        self.launch_together_btn.clicked.connect(lambda: App_control.launch_stims_together(self))
+
         # Load and save btn
         self.load_btn = QPushButton(text='Load')
         self.load_btn.clicked.connect(lambda: App_control.load_stim_params_from_list_widget(self))
@@ -123,6 +139,7 @@ class App_layout():
             entry = QLineEdit('Empty edit')
             entry.setObjectName('ParamValue')
             entry.setAlignment(Qt.AlignCenter | Qt.AlignVCenter)
+            entry.textEdited.connect(lambda: App_control.read_from_params_widgets(self))
 
             # Add them to the dictionary
             param = {lbl.text(): [lbl, entry]}
@@ -148,6 +165,8 @@ class App_layout():
 
         self.grid.addWidget(self.launch_btn, 14, 2, 1, 2)
         self.launch_btn.setObjectName('LaunchBtn')
+        self.grid.addWidget(self.launch_together_btn, 15, 2, 1, 2)
+        self.launch_together_btn.setObjectName('LaunchBtn')
 
         # Load and save btn
         self.grid.addWidget(self.load_btn, 15, 0, 1, 1)
@@ -302,17 +321,19 @@ class App_control():
     @staticmethod
     def read_from_params_widgets(main):
         """
-        Loops over the params widgets and reads their values.
-        Stores the values in the dictionary of the currently displayed stimulus
+        Called [in the GUI thread] when a parameter widget is edited. Loops over the params widgets and reads their
+        values: background luminosity and delay are published as a new Params_snapshot for the render loop, the stim
+        params replace the dictionary of the currently displayed stimulus with an edited copy
         :return:
         """
+        current = main.params_buffer.read()
+        bg_luminosity, delay = current.bg_luminosity, current.delay
         for param_name, param in main.params_widgets_dict.items():
             if param_name == 'Background Luminosity':
-                if not main.ignore_UI_luminosity:
-                    main.bg_luminosity = get_param_val(param, string=True)
+                bg_luminosity = parse_int(get_param_val(param, string=True), default=bg_luminosity)
 
             elif param_name == 'Delay':
-                main.stim_delay = get_param_val(param)
+                delay = parse_int(get_param_val(param, string=True), default=delay)
 
             else:
                 if not main.current_stim_params_displayed is None:
@@ -320,7 +341,28 @@ class App_control():
                     value = get_param_val(param, string=True)
                     if len(label) > 1 and main.current_stim_params_displayed and \
                             '.wav' not in main.current_stim_params_displayed:
-                        main.prepared_stimuli[main.current_stim_params_displayed][label] = value
+                        stim_params = main.prepared_stimuli[main.current_stim_params_displayed]
+                        if label not in stim_params.keys() or str(stim_params[label]) != value:
+                            if label in stim_params.keys() and main.monitor_geometry is not None:
+                                # The cached frames are out of date
+                                main.frames_cache.invalidate(stim_params, main.screenMs, main.monitor_geometry)
+                            stim_params = dict(stim_params)
+                            stim_params[label] = value
+                            main.prepared_stimuli[main.current_stim_params_displayed] = stim_params
+                            App_control.arm_stim(main, main.current_stim_params_displayed)
+
+        if (bg_luminosity, delay) != tuple(current):
+            main.params_buffer.publish(Params_snapshot(bg_luminosity, delay))
+            if main.render_process is not None and bg_luminosity != current.bg_luminosity \
+                    and not main.ignore_UI_luminosity:
+                main.render_process.set_bg(bg_luminosity)
+
+    @staticmethod
+    def set_bg_luminosity(main, bg_luminosity):
+        """ Set the background luminosity as if it had been typed in its widget [GUI thread only, from other threads
+        emit main.set_bg_signal] """
+        main.bg_edit.setText(str(bg_luminosity))
+        App_control.read_from_params_widgets(main)
 
     @staticmethod
     def update_params_widgets(main, stim_name):
@@ -375,6 +417,12 @@ class App_control():
         except:
             print('Couldnt load parameters from file {}'.format(stim_name))
 
+    @staticmethod
+    def select_loaded_stim(main, item):
+        """ Keep track of the stim selected in the list of loaded stims, so that the stim to launch can be looked up
+        from any thread without touching the widgets """
+        main.selected_stim = item.text() if item is not None else None
+
     @staticmethod
     def load_stim_params_from_list_widget(main):
         """
@@ -390,6 +438,7 @@ class App_control():
             App_control.update_params_widgets(main, file)  # Update the widgets with new paramaters
             main.loaded_stims_list.addItem(file)  # Add the file to the widget list
             main.current_stim_params_displayed = file  # Set the currently displayed stim accordingly
+            App_control.arm_stim(main, file)  # Calculate the stim frames in the background
 
     @staticmethod
     def load_audio_file_from_list_widget(main):
@@ -403,6 +452,7 @@ class App_control():
             main.prepared_stimuli[file] = file_long  # store the path to the file
             main.loaded_stims_list.addItem(file)  # Add the file to the widget list
             main.current_stim_params_displayed = file  # Set the currently displayed stim accordingly
+            App_control.arm_stim(main, file)  # Read the file duration in the background
 
     @staticmethod
     def remove_loaded_stim_from_widget_list(main):
@@ -416,6 +466,7 @@ class App_control():
                 sel = main.loaded_stims_list.currentItem().text()
                 if sel in main.prepared_stimuli.keys():
                     del main.prepared_stimuli[sel]
+                main.armed_stims.pop(sel, None)
 
                 # Clean up widgets
                 for param, wdgets in main.params_widgets_dict.items():
@@ -510,90 +561,251 @@ class App_control():
 
     # LAUNCH btn function
     @staticmethod
-    def launch_stim(main):
-        def get_wav_duration(filepath):
-            f = sf.SoundFile(filepath)
-            ms = (len(f)/f.samplerate)*1000
-            return ms
-            
-        if main.ready == 'Ready':
-            if main.current_stim_params_displayed:
-                main.stim_on = True
-                selected_stim = main.loaded_stims_list.currentItem()
-                if selected_stim is None:
-                    selected_stim = main.current_stim_params_displayed
-                else:
-                    selected_stim = selected_stim.text()
-
-                if 'deleted' in selected_stim:
-                    pass
-                elif not '.wav' in selected_stim:  # its a visual stim
-                    # get params and call stim generator to calculate stim frames
-                    params = main.prepared_stimuli[selected_stim]
-                    calcuated_stim = Stimuli_calculator(main.psypy_window, params, main.screenMs)
-                    main.stim_frames = calcuated_stim.stim_frames
-                else:
-                    duration_ms = get_wav_duration(main.prepared_stimuli[selected_stim])
-                    params = dict(type='audio', duration=duration_ms)
-                    calculated_stim = Stimuli_calculator(main.psypy_window, params, main.screenMs)
-                    main.stim_frames = calculated_stim.stim_frames
+    def get_wav_duration(filepath):
+        f = sf.SoundFile(filepath)
+        ms = (len(f)/f.samplerate)*1000
+        return ms
+
+    @staticmethod
+    def get_stim_params(main, stim_name):
+        """ Params of a loaded stim [for wav files: the path to the file and its duration] """
+        if not '.wav' in stim_name:  # its a visual stim
+            return main.prepared_stimuli[stim_name]
+        else:
+            filepath = main.prepared_stimuli[stim_name]
+            return dict(type='audio', duration=App_control.get_wav_duration(filepath), filepath=filepath)
 
-                params['stim_count'] = main.stim_count
-                params['stim_name'] = selected_stim
-                now = datetime.datetime.now()
-                params['stim_start'] = now.strftime("%H:%M")
+    @staticmethod
+    def calculate_stim(main, stim_name):
+        """ Get the params of a loaded stim and calculate its frame schedule [or get it from the frames cache if it
+        has been calculated already] """
+        params = App_control.get_stim_params(main, stim_name)
+        return params, main.frames_cache.get_schedule(params, main.screenMs, main.monitor_geometry)
 
+    @staticmethod
+    def arm_stim(main, stim_name):
+        """
+        Calculate the frame schedule of a loaded stim in a background thread, so that when the stim is launched
+        it is ready to be played. Stims loaded before psychopy is ready are armed when the window is created.
+        With a render process the params are sent to it, and it calculates the frames
+        """
+        if main.render_process is not None and stim_name in main.prepared_stimuli.keys():
+            main.render_process.arm(stim_name, App_control.get_stim_params(main, stim_name))
+            return
+        if main.monitor_geometry is None or stim_name not in main.prepared_stimuli.keys():
+            return
+        arming_worker = Worker(App_control.arm_stim_worker, main, stim_name)
+        main.threadpool.start(arming_worker)
 
-                with open(main.stim_log_path, 'a') as outfile:
-                    yaml.dump({"Stim {}".format(main.stim_count):params}, outfile, default_flow_style=False)
+    @staticmethod
+    def arm_stim_worker(main, stim_name):
+        if not '.wav' in stim_name:
+            # Get the key before calculating, if the params are edited meanwhile the key won't match anymore
+            key = Frames_cache.make_key(main.prepared_stimuli[stim_name], main.screenMs, main.monitor_geometry)
+        else:
+            key = main.prepared_stimuli[stim_name]
+        params, schedule = App_control.calculate_stim(main, stim_name)
+        if main.tiled_output is not None:
+            # the schedules of the other displays, from the same params and duration
+            main.tiled_output.arm(params, schedule, main.frames_cache.get_schedule, main.screenMs)
+        main.armed_stims[stim_name] = (key, params, schedule)
 
-                main.stim_count += 1
+    @staticmethod
+    def is_armed(main, stim_name):
+        """ True if the frame schedule of a loaded stim has been calculated and its params haven't changed since """
+        armed = main.armed_stims.get(stim_name, None)
+        if armed is None:
+            return False
+        if '.wav' in stim_name:
+            return armed[0] == main.prepared_stimuli.get(stim_name, None)
+        return armed[0] == Frames_cache.make_key(main.prepared_stimuli[stim_name], main.screenMs, main.monitor_geometry)
 
+    @staticmethod
+    def prepare_stim(main, stim_name):
+        """
+        Get the params and frame schedule of a loaded stim, ready to be played. If the stim has been armed and its
+        params haven't changed since, this is just a look up.
+        """
+        if App_control.is_armed(main, stim_name):
+            key, params, schedule = main.armed_stims[stim_name]
+            if '.wav' not in stim_name and Stimuli_calculator.is_random(params):
+                # A different stimulus each time: use this one and get the next one ready
+                del main.armed_stims[stim_name]
+                App_control.arm_stim(main, stim_name)
+            return params, schedule
 
+        # Not armed [or out of date]: calculate it now
+        return App_control.calculate_stim(main, stim_name)
 
     @staticmethod
-    def launch_all_stims(main):
-        """ for each stim calculates the frames and passes them to Main for the execution of the stims """
-        def get_wav_duration(filepath):
-            f = sf.SoundFile(filepath)
-            ms = (len(f)/f.samplerate)*1000
-            return ms
-
-        if main.ready == 'Ready' and main.current_stim_params_displayed:
-            stims_to_play = []
-            # Get stims
-            for stim_id in range(main.loaded_stims_list.count()):
-                item = main.loaded_stims_list.item(stim_id)
-                stims_to_play.append(item.text())
-
-            # Get durations
-            all_frames = {}
-            for idx, stim in enumerate(stims_to_play):
-                if 'deleted' in stim:
-                    continue
-                elif '.wav' in stim:
-                    duration_ms = get_wav_duration(main.prepared_stimuli[stim])
-                    params = dict(type='audio', duration=duration_ms)
-                    calcuated_stim = Stimuli_calculator(main.psypy_window, params, main.screenMs)
-                    stim_frames = calcuated_stim.stim_frames
-                else:
-                    # get params and call stim generator to calculate stim frames
-                    params = main.prepared_stimuli[stim]
-                    calcuated_stim = Stimuli_calculator(main.psypy_window, params, main.screenMs)
-                    stim_frames = calcuated_stim.stim_frames
+    def record_trigger(main, source, trigger_ns):
+        """ Tell the latency benchmark [if it is running] that a stim has been triggered """
+        if main.latency_recorder is not None:
+            main.latency_recorder.trigger(source, trigger_ns)
 
-                all_frames['{}__{}'.format(idx, stim)] = stim_frames
+    @staticmethod
+    def launch_stim(main, source='GUI', trigger_ns=None, stim_name=None):
+        """
+        Trigger a stim: it is put in the trigger queue and played by the render loop at the start of the next frame
+        [see Utils/trigger_queue.py]. Can be called from any thread. Returns False if the trigger will most likely
+        be dropped
+
+        :param source: what triggered the stim [GUI, arduino, mantis...], used by the latency benchmark
+        :param trigger_ns: timestamp of when the trigger was received [see Utils/latency_benchmark.py], if None the
+                            time at which this function is called is used
+        :param stim_name: name of the loaded stim to play, if None the one selected in the GUI now [not when the
+                            trigger is taken out of the queue]
+        """
+        if stim_name is None:
+            stim_name = main.selected_stim or main.current_stim_params_displayed
+        if not stim_name or stim_name not in main.prepared_stimuli.keys():
+            return False
+        return App_control.queue_trigger(main, source, trigger_ns, stim_name, App_control.play_stim)
 
-                # Prep delay
-                if main.stim_delay:
-                    params = dict(type='delay', duration=main.stim_delay)
-                    calcuated_delay = Stimuli_calculator(main.psypy_window, params, main.screenMs)
-                    delay_frames = calcuated_delay.stim_frames
-                    all_frames['{}z__delay'.format(idx)] = delay_frames
+    @staticmethod
+    def queue_trigger(main, source, trigger_ns, stims_names, play):
+        """
+        Put a trigger in the queue. If some of the stims to play haven't been armed [or their params have changed
+        since] they are calculated in a background thread first, and the trigger is put in the queue when they are
+        ready: the render loop never calculates the frames of a stim. Returns False if the trigger will most likely be
+        dropped
+
+        :param stims_names: name of the stim to play, or list of names
+        :param play: function that plays the stim[s], see Utils/trigger_queue.py
+        """
+        if trigger_ns is None:
+            trigger_ns = timestamp_ns()
+        if main.render_process is None and main.monitor_geometry is not None:
+            names = stims_names if isinstance(stims_names, list) else [stims_names]
+            to_arm = [stim_name for stim_name in dict.fromkeys(names) if not App_control.is_armed(main, stim_name)]
+            if to_arm:
+                arming_worker = Worker(App_control.arm_and_queue_worker, main, to_arm, source, trigger_ns,
+                                       stims_names, play)
+                main.threadpool.start(arming_worker)
+                return main.trigger_queue.accepting
+        return main.trigger_queue.put(source, trigger_ns, stims_names, play)
 
-            main.stim_frames = all_frames
+    @staticmethod
+    def arm_and_queue_worker(main, to_arm, source, trigger_ns, stims_names, play):
+        for stim_name in to_arm:
+            try:
+                App_control.arm_stim_worker(main, stim_name)
+            except Exception as e:
+                print('Could not calculate {}, not launching it: {}'.format(stim_name, e))
+                return
+        main.trigger_queue.put(source, trigger_ns, stims_names, play)
+
+    @staticmethod
+    def play_stim(main, source, trigger_ns, stim_name):
+        """ Start playing a stim, called by the render loop when it takes a trigger from the queue. Returns True if
+        the stim was launched """
+        if main.ready != 'Ready' or stim_name not in main.prepared_stimuli.keys():
+            return False
+
+        if main.render_process is not None:
+            # The render process has the stim frames already [see arm_stim], just tell it to play them
+            main.ready = 'Busy'
+            App_control.record_trigger(main, source, trigger_ns)
+            main.render_process.trigger(stim_name, trigger_ns)
+            params = dict(App_control.get_stim_params(main, stim_name))  # for the log, once the stim is triggered
+        else:
+            # get params and call stim generator to calculate stim frames, then pass them to the render loop
+            params, schedule = App_control.prepare_stim(main, stim_name)
+            params = dict(params)  # a copy to add the log info to
+            App_control.record_trigger(main, source, trigger_ns)
+            main.stim_stream = Playlist([Stream_segment(stim_name, params, schedule)])
             main.stim_on = True
 
+        App_control.log_stim(main, stim_name, params)
+        return True
+
+    @staticmethod
+    def log_stim(main, stim_name, params):
+        """ Add a stim to the stims log: it is written to the file by a background thread [see
+        Main_UI.stim_log_loop], never by the render loop """
+        params['stim_count'] = main.stim_count
+        params['stim_name'] = stim_name
+        now = datetime.datetime.now()
+        params['stim_start'] = now.strftime("%H:%M")
+        main.stim_log_queue.put((main.stim_count, params))
+        main.stim_count += 1
+
+    @staticmethod
+    def get_loaded_stims_names(main):
+        """ Names of the stims in the list of loaded stims, in order [GUI thread only: it reads the list widget] """
+        names = []
+        for stim_id in range(main.loaded_stims_list.count()):
+            stim_name = main.loaded_stims_list.item(stim_id).text()
+            if 'deleted' in stim_name or stim_name not in main.prepared_stimuli.keys():
+                continue
+            names.append(stim_name)
+        return names
+
+    @staticmethod
+    def launch_all_stims(main):
+        """ Play all the loaded stims one after the other [through the trigger queue, see launch_stim] """
+        stims_names = App_control.get_loaded_stims_names(main)
+        if stims_names:
+            App_control.queue_trigger(main, 'GUI', None, stims_names, App_control.play_all_stims)
+
+    @staticmethod
+    def play_all_stims(main, source, trigger_ns, stims_names):
+        """ Play the stims one after the other. They are compiled into a playlist, in the order in which they were
+         listed when they were launched, with a delay segment between stims if a delay is set [see compile_playlist] """
+        if main.render_process is not None:
+            print('Playing a sequence of stims is not supported with a render process yet')
+            return False
+        stims_names = [name for name in stims_names if name in main.prepared_stimuli.keys()]
+        if main.ready != 'Ready' or not stims_names:
+            return False
+
+        playlist = compile_playlist(stims_names,
+                                    lambda stim_name: App_control.prepare_stim(main, stim_name),
+                                    lambda params: main.frames_cache.get_schedule(params, main.screenMs,
+                                                                                  main.monitor_geometry),
+                                    delay=main.params_buffer.read().delay)
+        playlist.describe(main.screenMs)
+        main.stim_stream = playlist
+        App_control.record_trigger(main, source, trigger_ns)
+        main.stim_on = True
+        return True
+
+    @staticmethod
+    def launch_stims_together(main):
+        """ Play all the loaded stims at the same time [through the trigger queue, see launch_stim] """
+        stims_names = App_control.get_loaded_stims_names(main)
+        if stims_names:
+            App_control.queue_trigger(main, 'GUI', None, stims_names, App_control.play_stims_together)
+
+    @staticmethod
+    def play_stims_together(main, source, trigger_ns, stims_names):
+        """ Play the stims at the same time, each one is a layer of the compositor [see Utils/compositor.py]. Stims
+        are drawn in the order in which they were listed when they were launched [the last one on top], unless they
+        have a 'z' param """
+        if main.render_process is not None:
+            print('Playing stims together is not supported with a render process yet')
+            return False
+        if main.ready != 'Ready':
+            return False
+
+        layers = []
+        for stim_id, stim_name in enumerate(stims_names):
+            if stim_name not in main.prepared_stimuli.keys():
+                continue
+            params, schedule = App_control.prepare_stim(main, stim_name)
+            try:
+                z = float(params.get('z', stim_id))
+            except ValueError:
+                z = stim_id
+            layers.append((Stream_segment(stim_name, params, schedule, z=z), z))
+        if not layers:
+            return False
+
+        main.stim_stream = Playlist([Layered_segment(' + '.join([seg.name for seg, z in layers]), layers)])
+        App_control.record_trigger(main, source, trigger_ns)
+        main.stim_on = True
+        return True
+
     @staticmethod
     def arduino_command(main):
         main.arduino_comm.send_command(main.arduino_command)
@@ -1,22 +1,61 @@
-import socket
+import asyncio
+import struct
 import App_UI
 import sys
 import glob
 import serial
 import platform
 import numpy as np
+from Utils.mantis_data import TEXT_ACTION, BINARY_ACTION, BINARY_DTYPE, parse_text_data, parse_binary_data, \
+    Sweep_buffer
+from Utils.online_detector import Online_detector
+from Utils.serial_protocol import Serial_link
+from Utils.latency_benchmark import timestamp_ns
 
 """
 CLASS TO HANDLE COMMS WITH MANTIS
+
+Mantis connects to a TCP server on the stim PC and sends packets made of a 16 bytes header [@ACTION@CHID@SIZE@, e.g.
+@INIT@001@00353@] followed by SIZE bytes of data. After the header the server replies 'size', after the data it
+replies to the action [e.g. 'INIT ok.', or the average of the data as a little endian double for DATA packets].
+The server runs an asyncio event loop in its own thread: each packet is read with readexactly, so a header or data
+split over several TCP segments [or several packets in one segment] never desyncs the stream, several clients can
+be connected at the same time and a client that disconnects can reconnect. Stims are triggered through the trigger
+queue [see Utils/trigger_queue.py], so the socket loop never waits for the GUI. See Utils/fake_mantis.py to test the
+server without Mantis.
+The samples can be sent as text [DATA packets] or as raw floats [BDAT packets, see Utils/mantis_data.py], which are
+read without any conversion straight into the sweep buffer of the client.
 """
 
 
+HEADER_SIZE = 16
+
+
+class Mantis_connection():
+    def __init__(self, reader, writer, sweep_size, detector=None):
+        """ State of one client connected to the server """
+        self.reader, self.writer = reader, writer
+        self.address = writer.get_extra_info('peername')
+        self.sweep = Sweep_buffer(sweep_size)
+        self.detector = detector  # decides when to trigger a stim, if None each chunk triggers one
+
+    def __repr__(self):
+        return 'Mantis client {}'.format(self.address)
+
+
 class MantisComms():
-    def __init__(self, Main):
+    def __init__(self, Main, host='localhost', port=8079, max_clients=4, data_timeout=2, binary_dtype=BINARY_DTYPE,
+                 detector_settings=None):
         """
-        Set up server communication with mantis.
+        Set up server communication with mantis. The server starts listening when run() is called
 
         :param Main reference to App_Main class
+        :param host, port: where the server listens
+        :param max_clients: connections after the first max_clients are closed straight away
+        :param data_timeout: max time [s] between a header and its data, after it the client is disconnected
+        :param binary_dtype: numpy dtype of the samples in BDAT packets
+        :param detector_settings: params of the Online_detector of each client [see Utils/online_detector.py], if
+            None a stim is triggered for each chunk of data
         """
 
         # Hardcoded information about the data received. Useful for
@@ -24,93 +63,166 @@ class MantisComms():
         # TODO: read this info from Mantis
         self.chunkSize = 50
         self.sweepSize = int(0.5 * 25000 / 10)
-        self.sweepArray = np.zeros(self.sweepSize)
-        self.sweepInfo = [self.chunkSize, self.sweepSize, self.sweepArray]
-        self.chunkCounter = 0
-
-        # Setup sockets
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind(('localhost', 8079))
-        self.server.listen(1)
-        try:
-            self.conn, self.addr = self.server.accept()  # use the same TCP/IP refnum for the experiment
-        except:
-            raise Warning('Could not establish communication with Mantis')
+        self.fs = 25000
+        self.detector_settings = detector_settings
+
+        self.host, self.port = host, port
+        self.max_clients = max_clients
+        self.data_timeout = data_timeout
+        self.binary_dtype = binary_dtype
+        self.clients = []
+        self.loop, self.server = None, None
 
         # Reference the stim trigger function
         self.stim_trigger_func = App_UI.App_control.launch_stim
         # Referernce to Main App class instance for stim trigger
         self.app_main = Main
 
-    def receive(self):
-        # 1st TCP packet: The default 16byte Mantis header  ACTION/CHID/DATASIZE/ e.g @INIT@001@00353@
-        cmnd = self.conn.recv(16)
-        # convert 'command' type to a normal python string
-        MantisHeader = str(cmnd)
-        # all strings from Mantis are @ separated so we make it a list
-        Header_list = MantisHeader.split('@')
-        # delete first dummy element before first @ python autoappends characters here
-        # Header_list.pop()
-        # delete last dummy element after last @  python autoappends characters here too
-        # Header_list.pop(0)
+        # Stats
+        self.packets_received, self.clients_refused = 0, 0
+
+    ####################################################################################################################
+    """    SERVER   """
+    ####################################################################################################################
+
+    def run(self):
+        """ Start the server and keep serving the clients until stop() is called [it blocks: run it in a thread] """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_server())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            for client in list(self.clients):
+                client.writer.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    def stop(self):
+        """ Can be called from any thread """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def start_server(self, max_backoff=30):
+        """ Start listening, if the port can't be used [e.g. it is still in use] try again later and later """
+        backoff = 0.5
+        while True:
+            try:
+                self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+                print('Mantis server listening on {}:{}'.format(self.host, self.port))
+                return
+            except OSError as e:
+                print('Could not start Mantis server: {}, trying again in {}s'.format(e, backoff))
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+
+    async def handle_client(self, reader, writer):
+        """ Keep receiving the packets of a client until it disconnects """
+        if len(self.clients) >= self.max_clients:
+            self.clients_refused += 1
+            print('Too many Mantis clients, closing connection from {}'.format(writer.get_extra_info('peername')))
+            writer.close()
+            return
+
+        client = Mantis_connection(reader, writer, self.sweepSize,
+                                   Online_detector.from_settings(self.detector_settings, self.fs))
+        self.clients.append(client)
+        print('{} connected'.format(client))
+        try:
+            while True:
+                await self.receive(client)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print('{} disconnected'.format(client))
+        except asyncio.TimeoutError:
+            print('{} timed out sending data, disconnecting'.format(client))
+        except ValueError as e:
+            print('{} sent a malformed packet, disconnecting: {}'.format(client, e))
+        finally:
+            if client.detector is not None:
+                client.detector.print_latency_summary(str(client))
+            self.clients.remove(client)
+            writer.close()
+
+    ####################################################################################################################
+    """    PACKETS   """
+    ####################################################################################################################
+
+    @staticmethod
+    def parse_header(header):
+        """ Split a header [e.g. b'@INIT@001@00353@'] in action, channel id and size of the data """
+        if len(header) != HEADER_SIZE or not header.startswith(b'@'):
+            raise ValueError('Bad header {}'.format(header))
+        # all strings from Mantis are @ separated, the first and last elements are empty
+        Header_list = header.decode('ascii', errors='replace').split('@')
+        if len(Header_list) < 4:
+            raise ValueError('Bad header {}'.format(header))
         # the first element is the action to be performed on the data
         action = Header_list[1]
         # the second element indicates the channel number that is transmitted
         ch_id = Header_list[2]
         # the third header element indicates the size of data for the next packet
-        size = Header_list[3]
-        size = float(size)
-        size = int(size)
-        # print(size)
-        self.conn.sendall(b'size')
+        size = int(float(Header_list[3]))
+        return action, ch_id, size
+
+    async def receive(self, client):
+        # 1st TCP packet: The default 16byte Mantis header  ACTION/CHID/DATASIZE/ e.g @INIT@001@00353@
+        header = await client.reader.readexactly(HEADER_SIZE)
+        trigger_ns = timestamp_ns()  # when the packet arrived, for the latency benchmark
+        action, ch_id, size = self.parse_header(header)
+        client.writer.write(b'size')
 
         # 2nd TCP packet: wait to read the exact length of data that the Mantis Header indicated
-        cmnd = self.conn.recv(size)
+        data = await asyncio.wait_for(client.reader.readexactly(size), self.data_timeout)
+        data_ns = timestamp_ns()  # the detector latency is measured from here
+        self.packets_received += 1
 
         # actions
         # Do the initialization action by parsing the command send by Mantis each time an experiment starts
-        if 'INIT' in str(action):
-
-            # delete the 'INIT' tag from the list- this list contains all the initialization data
-            # Header_list.pop(0)
-            # assume the first element in the list is the sampling frequency and so on
-            # fs=Header_list[0]
-            # fs=float(fs)
-            # print(fs)
-            self.conn.sendall(b'INIT ok.')  # feedback to Mantis that the initialization was successful
-
-        # Do the lay action
-        elif 'PLAY' in str(cmnd):
-            self.conn.sendall(cmnd)
+        if 'INIT' in action:
+            # the first element in the list is the sampling frequency
+            try:
+                fs = float(data.split(b'@')[1])
+                if client.detector is not None:
+                    client.detector.set_sampling_rate(fs)
+            except (IndexError, ValueError):
+                pass
+            client.writer.write(b'INIT ok.')  # feedback to Mantis that the initialization was successful
 
-        # Do the quit action
-        elif 'QUIT' in str(cmnd):
-            self.conn.sendall(b'QUIT ok.')
-
-        # The data sent by Mantis in runtime has the prefix 'DATA'
-        elif 'DATA' in str(action):
-            MantisData = str(cmnd)
-            Mantis_list = MantisData.split('@')
-            # delete the 'DATA' prefix from the list to cast to nparray
-            Mantis_list.pop(0)
-            Mantis_list.pop()
-            array = np.asarray(Mantis_list)
-            # convert to float nparray for online analysis
-            array = array.astype(np.float)
+        # The data sent by Mantis in runtime has the prefix 'DATA' [as text] or 'BDAT' [as binary]. Dispatch on the
+        # action first: raw floats can contain any bytes, e.g. b'PLAY'
+        elif TEXT_ACTION in action or BINARY_ACTION in action:
+            if BINARY_ACTION in action:
+                array = parse_binary_data(data, self.binary_dtype)
+            else:
+                array = parse_text_data(data)
 
             # Keep track of chuncks received to build sweeps
-            if self.chunkCounter < (self.sweepSize - self.chunkSize):
-                self.chunkCounter += self.chunkSize
-            else:
-                self.chunkCounter = 0
+            client.sweep.add_chunk(array)
 
-            # call function for data processing
-            self.stim_trigger_func(self.app_main)
+            # call function for data processing: closed loop, trigger a stim if the detector says so
+            if client.detector is None or client.detector.process(array, arrival_ns=data_ns):
+                self.trigger_stim(trigger_ns)
 
             # TODO: Mantis currently needs to receive something back so we send this
-            avg = sum(array) / len(array)
+            avg = np.mean(array) if len(array) else 0.0
             # returns little endian DBL float 8 byte that Mantis can read and plot
-            self.conn.sendall(avg)
+            client.writer.write(struct.pack('<d', avg))
+
+        # Do the play action [the command can be the action or the text of the data]
+        elif 'PLAY' in action or b'PLAY' in data:
+            client.writer.write(data)
+
+        # Do the quit action
+        elif 'QUIT' in action or b'QUIT' in data:
+            client.writer.write(b'QUIT ok.')
+
+        # If the client isn't reading the replies wait for it, without holding up the other clients
+        await client.writer.drain()
+
+    def trigger_stim(self, trigger_ns):
+        """ Put a trigger in the queue, it doesn't wait for the stim to be launched """
+        self.stim_trigger_func(self.app_main, source='mantis', trigger_ns=trigger_ns)
 
 
 class SerialComms():
@@ -132,8 +244,17 @@ class SerialComms():
         }
     
     """
-    def __init__(self, port_name=None):
-        self.baud = 9600
+    TEXT_BAUD, FRAMED_BAUD = 9600, 500000  # at 9600 baud ~80 frames/s get through, at 500000 a few thousands
+
+    def __init__(self, port_name=None, framed=False, baud=None):
+        """
+        :param port_name: serial port of the arduino, if None the user is asked to pick one
+        :param framed: use the framed binary protocol [see Utils/serial_protocol.py] instead of lines of text
+        :param baud: baud rate, it must match the arduino sketch. If None 9600 for text, 500000 for the framed protocol
+        """
+        if baud is None:
+            baud = self.FRAMED_BAUD if framed else self.TEXT_BAUD
+        self.baud = int(baud)
         # Get the port name
         if port_name is None:
             # If the name of the port is not give, get available ports
@@ -144,6 +265,12 @@ class SerialComms():
         # Set up serial communication
         self.setup_ser()
 
+        # With the framed protocol commands are queued and sent by the link's threads
+        self.link = None
+        if framed:
+            self.link = Serial_link(self.ser)
+            self.link.start()
+
     def get_available_ports(self):
         """ Lists serial port names
 
@@ -188,24 +315,26 @@ class SerialComms():
             print('Could not start serial communication')
 
     def send_command(self, command):
-        """ Send bytes to arduino """
+        """ Send bytes to arduino [with the framed protocol it is queued and this doesn't wait, returns the sequence
+        number of the command] """
+        if self.link is not None:
+            return self.link.send_command(command)
         if self.ser.isOpen():
-            self.ser.flushInput()  # flush input buffer, discarding all its contents
-            self.ser.flushOutput()  # flush output buffer, aborting current output
-            # and discard all that is in buffer
-
-            # send bytes
+            # send bytes, nothing is flushed: data sent or received before the command isn't lost
             self.ser.write(command.encode())
-            print('Sent Command: ', command)
         else:
             print("cannot open serial port ")
 
     def read_value(self):
-        """ Read bytes from arduinoo """
-        self.ser.flushInput()
-        self.ser.flushOutput()
+        """ Read a line of bytes from arduinoo """
         return self.ser.readline()
 
+    def close(self):
+        if self.link is not None:
+            self.link.print_round_trip_summary()
+            self.link.stop()
+        self.ser.close()
+
 if __name__ == "__main__":
     comm = SerialComms()
     comm.get_available_ports()
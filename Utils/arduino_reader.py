@@ -0,0 +1,86 @@
+import queue
+import threading
+from collections import namedtuple
+
+from Utils.latency_benchmark import timestamp_ns
+
+
+"""
+EVENT DRIVEN ARDUINO READER
+
+A thread that keeps reading what the arduino sends through the serial port [one value per line, see SerialComms]
+and turns it into events: each time the value crosses the threshold an Arduino_event is put in a queue, with the
+time at which the line arrived. The render loop takes the events from the queue once per frame [see
+Main_UI.arduino_manager], so an edge is acted upon at most one frame after it arrives.
+The thread blocks on the serial port until there is something to read, so it doesn't use any CPU in between events,
+and nothing is flushed: every line is read and every edge ends up in the queue.
+"""
+
+
+RISING, FALLING = 'rising', 'falling'
+
+Arduino_event = namedtuple('Arduino_event', 'edge value t_ns')
+
+
+class Arduino_reader(threading.Thread):
+    def __init__(self, ser, threshold=1, events=None, read_timeout=0.5):
+        """
+        :param ser: open serial.Serial [e.g. SerialComms.ser]
+        :param threshold: values >= threshold are high, lower values are low
+        :param events: queue.Queue where the events are put, if None a new one is created
+        :param read_timeout: max time [s] a read waits for data, only used to check if the thread has been stopped
+        """
+        super(Arduino_reader, self).__init__(daemon=True)
+        self.ser = ser
+        self.ser.timeout = read_timeout
+        self.threshold = threshold
+        self.events = events if events is not None else queue.Queue()  # unbounded: edges are never dropped
+
+        self.level = False  # high [True] or low [False], the line starts low
+        self.n_lines, self.n_edges, self.n_bad_lines = 0, 0, 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        partial = b''  # end of the last chunk read, if it wasn't a full line
+        while not self.stopped.is_set():
+            try:
+                chunk = self.ser.read(max(1, self.ser.in_waiting))  # blocks until at least one byte arrives
+            except Exception as e:
+                print('Stopped reading from arduino: {}'.format(e))
+                return
+            if not chunk:  # read timed out
+                continue
+            t_ns = timestamp_ns()  # all the lines in the chunk arrived by now
+
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                self.parse_line(line, t_ns)
+
+    def parse_line(self, line, t_ns):
+        """ Put an event in the queue if the value in the line is on the other side of the threshold """
+        try:
+            value = float(line.strip())
+        except ValueError:
+            self.n_bad_lines += 1
+            return
+        self.n_lines += 1
+
+        level = value >= self.threshold
+        if level != self.level:
+            self.events.put(Arduino_event(RISING if level else FALLING, value, t_ns))
+            self.n_edges += 1
+        self.level = level
+
+    def get_events(self):
+        """ All the events received since the last call, oldest first [it doesn't wait] """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def stop(self, timeout=1):
+        self.stopped.set()
+        self.join(timeout)
@@ -153,6 +153,27 @@ def plot_benchmark_results(results):
 
 
 
+def plot_latency_results(recorder):
+    """ Histogram of the trigger to photon latencies for each trigger source [see Utils/latency_benchmark.py] """
+    summary = recorder.summary()
+    if not summary:
+        return
+
+    f, axarr = plt.subplots(len(summary), 1, facecolor=[0.1, 0.1, 0.1], squeeze=False)
+    f.tight_layout()
+    for ax, (source, res) in zip(axarr[:, 0], sorted(summary.items())):
+        latencies = np.array(recorder.latencies[source], dtype=np.float64) / 1e6
+        ax.set(facecolor=[0.2, 0.2, 0.2], xlabel='ms',
+               title='{} - trigger to photon latency, mean {:.2f} ms, jitter {:.2f} ms'.format(source, res['mean'],
+                                                                                            res['jitter']))
+        ax.hist(latencies, bins=50, color=[0.8, 0.4, 0.4], alpha=0.75)
+        ax.axvline(res['median'], color=[.6, .6, .6], label='median')
+        legend = ax.legend(frameon=True)
+        legend.get_frame().set_facecolor([0.1, 0.1, 0.1])
+
+    plt.show()
+
+
 if __name__=="__main__":
     read_ldr_data()
 
@@ -0,0 +1,176 @@
+import numpy as np
+
+from Utils.frame_schedules import Loom_schedule, Spot_loom_schedule
+from Utils.frame_state import Frame_state
+from Utils.renderers import resolve_renderer
+
+
+"""
+COMPOSITOR: PLAY SEVERAL STIMULI AT THE SAME TIME
+
+Each stimulus being played is a layer with its own frame schedule and a z order [layers with a higher z are drawn on
+top]. All the layers of a segment of the playlist share the same frame number, each one is shown until its own
+schedule runs out. Layers are drawn in z order, but layers next to each other that are compatible [looms and spots
+in the same units] are batched together and drawn with a single call to an ElementArrayStim, so a stimulus made of
+several looms costs about the same as a single loom.
+"""
+
+
+# Schedules that can be batched together, they need a circle_at(frame_number) method
+BATCHABLE_SCHEDULES = (Loom_schedule, Spot_loom_schedule)
+
+
+class Layer():
+    def __init__(self, segment, z=0):
+        """
+        One stimulus played by the compositor
+
+        :param segment: Stream_segment with the stim to play
+        :param z: z order of the layer
+        """
+        self.segment = segment
+        self.schedule = segment.schedule
+        self.n_frames = segment.n_frames
+        self.z = z
+        resolve_renderer(self.schedule)
+
+        self.stim, self.audio_stim, self.trial_clock = None, None, None  # set by the renderer
+        self.state = Frame_state()  # last values pushed to the stim object
+
+    def release_stim(self, pool):
+        """ Put the stimulus object back in the pool """
+        if self.stim is not None:
+            pool.release(self.stim)
+            self.stim = None
+
+
+class Circles_batch():
+    def __init__(self, layers, units):
+        """
+        Layers with circles [looms, spots] that are drawn with a single ElementArrayStim
+
+        :param layers: list of Layer, in z order
+        :param units: units of all the layers
+        """
+        self.layers = layers
+        self.units = units
+        self.stim = None  # taken from the pool at the first frame
+
+        # One row per element of the ElementArrayStim
+        self.xys = np.zeros((len(layers), 2))
+        self.sizes = np.zeros((len(layers), 2))
+        self.colors = np.zeros((len(layers), 3))
+        self.opacities = np.zeros(len(layers))
+        self.padded = None  # same as above, one row per element of the pooled ElementArrayStim
+        self.state = Frame_state()  # last values pushed to the ElementArrayStim
+
+    def update(self, pool, frame_number):
+        if self.stim is None:
+            self.stim = pool.acquire('circle_array', self.units)
+            self.state = Frame_state()
+
+            # Unused elements of the pooled ElementArrayStim stay transparent
+            n_elements = len(self.stim.opacities)
+            self.padded = {name: np.zeros((n_elements, ) + values.shape[1:]) for name, values in
+                           (('xys', self.xys), ('sizes', self.sizes), ('colors', self.colors),
+                            ('opacities', self.opacities))}
+
+        for idx, layer in enumerate(self.layers):
+            if frame_number < layer.n_frames:
+                pos, radius, color = layer.schedule.circle_at(frame_number)
+                self.xys[idx] = pos
+                self.sizes[idx] = 2 * radius
+                self.colors[idx] = color
+                self.opacities[idx] = 1
+            else:
+                self.opacities[idx] = 0  # this layer is done
+
+        for name, values in (('xys', self.xys), ('sizes', self.sizes), ('colors', self.colors),
+                             ('opacities', self.opacities)):
+            if self.state.changed(name, values):
+                padded = self.padded[name]
+                padded[:len(values)] = values  # in place, no new array at each frame
+                setattr(self.stim, name, padded)
+
+    def draw(self):
+        if self.stim is not None:
+            self.stim.draw()
+
+    def release(self, pool):
+        if self.stim is not None:
+            pool.release(self.stim)
+            self.stim = None
+
+
+class Compositor():
+    def __init__(self, pool):
+        """
+        :param pool: Stim_pool the stimulus objects are taken from
+        """
+        self.pool = pool
+        self.batch_size = pool.BATCH_SIZE  # max number of layers drawn with a single call
+        self.layers = []  # in z order
+        self.draw_list = []  # Layer and Circles_batch in the order in which they are drawn
+
+    def __len__(self):
+        return len(self.layers)
+
+    def add_layers(self, segments):
+        """
+        Add the layers of a segment of the playlist
+
+        :param segments: list of (Stream_segment, z)
+        """
+        for segment, z in segments:
+            self.layers.append(Layer(segment, z))
+        self.layers.sort(key=lambda layer: layer.z)  # stable: layers with the same z are drawn in the order given
+        self.make_draw_list()
+
+    def make_draw_list(self):
+        """ Group compatible layers that are next to each other in z order into batches """
+        for item in self.draw_list:
+            if isinstance(item, Circles_batch):
+                item.release(self.pool)
+
+        self.draw_list, run = [], []
+        for layer in self.layers + [None]:
+            batchable = layer is not None and isinstance(layer.schedule, BATCHABLE_SCHEDULES)
+            if run and (not batchable or layer.schedule.units != run[0].schedule.units or
+                        len(run) == self.batch_size):
+                if len(run) > 1:
+                    self.draw_list.append(Circles_batch(run, run[0].schedule.units))
+                else:
+                    self.draw_list.append(run[0])
+                run = []
+
+            if batchable:
+                run.append(layer)
+            elif layer is not None:
+                self.draw_list.append(layer)
+
+    def update(self, main, frame_number):
+        """ Update all the layers with their values for a frame, layers whose schedule is over are hidden """
+        for item in self.draw_list:
+            if isinstance(item, Circles_batch):
+                item.update(self.pool, frame_number)
+            elif frame_number < item.n_frames:
+                item.schedule.renderer(main, item, frame_number)
+            else:
+                item.release_stim(self.pool)
+
+    def draw(self):
+        for item in self.draw_list:
+            if isinstance(item, Circles_batch):
+                item.draw()
+            elif item.stim is not None:
+                item.stim.draw()
+
+    def clear(self):
+        """ Remove all the layers and put their stimulus objects back in the pool """
+        for item in self.draw_list:
+            if isinstance(item, Circles_batch):
+                item.release(self.pool)
+            else:
+                item.release_stim(self.pool)
+                item.audio_stim = None
+        self.layers, self.draw_list = [], []
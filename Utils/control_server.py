@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+from collections import namedtuple
+import numpy as np
+
+from Utils.latency_benchmark import timestamp_ns
+
+
+"""
+LOCAL CONTROL SERVER
+
+Lets other processes on the stim PC [tracking, acquisition...] drive the stimuli: a UDP socket on the loopback
+interface [or a unix datagram socket] that receives small binary messages and acknowledges each one of them.
+Each datagram is one message, so there is no framing to get wrong:
+    request: type [1 byte] | sequence number [4 bytes] | client timestamp [8 bytes] | payload
+    ack:     type | sequence number | client timestamp | time received [8 bytes] | time acknowledged [8 bytes] |
+             status [1 byte] | payload
+with little endian numbers. The client timestamp is sent back as it is, so the client can measure the round trip
+with its own clock, the two server times [perf_counter_ns] tell how long the server took to handle the message.
+Messages:
+    * ARM: payload is the name of a loaded stim, its frames are calculated and it becomes the one TRIGGER plays
+    * TRIGGER: play the stim named in the payload, or the armed one if the payload is empty
+    * SET_BG: payload is the background luminosity [1 byte, 0-255], it is set as if it was typed in the GUI
+    * STATUS: the ack payload is a JSON with the state of the GUI
+Status of the ack: OK, BUSY [the trigger will most likely be dropped, e.g. a stim is already playing, see
+Utils/trigger_queue.py] or ERROR [the payload says why].
+Control_client sends the messages and waits for their acks, run this module to measure the round trip times:
+    python -m Utils.control_server --port 8090 --rate 1000
+"""
+
+
+REQUEST = struct.Struct('<BIq')
+ACK = struct.Struct('<BIqqqB')
+MAX_DATAGRAM = 4096
+
+ARM, TRIGGER, SET_BG, STATUS = 1, 2, 3, 4
+OK, BUSY, ERROR = 0, 1, 2
+
+Ack = namedtuple('Ack', 'status rtt_ms server_ms payload')
+
+
+class Control_server():
+    def __init__(self, handlers, host='127.0.0.1', port=8090, unix_path=None, read_timeout=0.5):
+        """
+        :param handlers: dict message type -> function(payload, received_ns) returning (status, payload)
+        :param host, port: UDP address, on the loopback interface by default
+        :param unix_path: if given a unix datagram socket is used instead of UDP [not on windows]
+        :param read_timeout: max time [s] the server waits for a message, only used to check if it has been stopped
+        """
+        self.handlers = handlers
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(unix_path)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind((host, port))
+        self.sock.settimeout(read_timeout)
+        self.address = self.sock.getsockname()
+        self.unix_path = unix_path
+
+        self.n_messages, self.n_errors = 0, 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @classmethod
+    def for_main(cls, main, host='127.0.0.1', port=8090, unix_path=None):
+        """ Server that controls the GUI """
+        from App_UI import App_control
+        armed = dict(name=None)
+
+        def arm(payload, received_ns):
+            stim_name = payload.decode()
+            if stim_name not in main.prepared_stimuli.keys():
+                return ERROR, 'No loaded stim called {}'.format(stim_name).encode()
+            App_control.arm_stim(main, stim_name)
+            armed['name'] = stim_name
+            return OK, b''
+
+        def trigger(payload, received_ns):
+            stim_name = payload.decode() or armed['name']
+            if stim_name is not None and stim_name not in main.prepared_stimuli.keys():
+                return ERROR, 'No loaded stim called {}'.format(stim_name).encode()
+            if App_control.launch_stim(main, source='network', trigger_ns=received_ns, stim_name=stim_name):
+                return OK, b''
+            return BUSY, main.ready.encode() if main.ready else b''
+
+        def set_bg(payload, received_ns):
+            # the GUI thread updates the widget and publishes it, so the next edit of a widget doesn't undo it
+            main.set_bg_signal.emit(int(payload[0]))
+            return OK, b''
+
+        def status(payload, received_ns):
+            # bg_luminosity is the one on the screen [kept up to date by the render loop, or by the telemetry of the
+            # render process], bg_setting the one last set in the GUI
+            return OK, json.dumps(dict(ready=main.ready, armed=armed['name'], stim_count=main.stim_count,
+                                       bg_luminosity=main.bg_luminosity,
+                                       bg_setting=main.params_buffer.read().bg_luminosity,
+                                       loaded=list(main.prepared_stimuli.keys())), default=str).encode()
+
+        return cls({ARM: arm, TRIGGER: trigger, SET_BG: set_bg, STATUS: status}, host, port, unix_path)
+
+    def start(self):
+        self.thread.start()
+        print('Control server listening on {}'.format(self.address))
+
+    def stop(self, timeout=1):
+        self.stopped.set()
+        self.thread.join(timeout)
+        self.sock.close()
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            received_ns = timestamp_ns()
+            if len(data) < REQUEST.size or not address:
+                self.n_errors += 1
+                continue
+
+            kind, seq, client_ns = REQUEST.unpack_from(data)
+            self.n_messages += 1
+            try:
+                status, payload = self.handlers[kind](data[REQUEST.size:], received_ns)
+            except KeyError:
+                status, payload = ERROR, 'Unknown message type {}'.format(kind).encode()
+            except Exception as e:
+                status, payload = ERROR, str(e).encode()
+            if status == ERROR:
+                self.n_errors += 1
+
+            ack = ACK.pack(kind, seq, client_ns, received_ns, timestamp_ns(), status) + payload[:MAX_DATAGRAM - ACK.size]
+            try:
+                self.sock.sendto(ack, address)
+            except OSError as e:
+                print('Could not acknowledge message {}: {}'.format(seq, e))
+
+
+class Control_client():
+    def __init__(self, host='127.0.0.1', port=8090, unix_path=None, timeout=1.0):
+        """ Sends messages to a Control_server and waits for their acks """
+        if unix_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.client_path = '{}.client{}'.format(unix_path, os.getpid())
+            if os.path.exists(self.client_path):
+                os.remove(self.client_path)
+            self.sock.bind(self.client_path)  # so that the server can reply
+            self.server = unix_path
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.client_path = None
+            self.server = (host, port)
+        self.sock.settimeout(timeout)
+        self.seq = 0
+        self.round_trips = []  # ms
+        self.n_timeouts = 0
+
+    def close(self):
+        self.sock.close()
+        if self.client_path is not None and os.path.exists(self.client_path):
+            os.remove(self.client_path)
+
+    def send(self, kind, payload=b''):
+        """ Send a message and wait for its ack, returns an Ack or None if it didn't arrive in time """
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        sent_ns = timestamp_ns()
+        self.sock.sendto(REQUEST.pack(kind, self.seq, sent_ns) + payload, self.server)
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except socket.timeout:
+                self.n_timeouts += 1
+                return None
+            now = timestamp_ns()
+            kind_, seq, client_ns, received_ns, acked_ns, status = ACK.unpack_from(data)
+            if seq != self.seq:
+                continue  # the ack of a message that had timed out
+            rtt_ms = (now - client_ns) / 1e6
+            self.round_trips.append(rtt_ms)
+            return Ack(status, rtt_ms, (acked_ns - received_ns) / 1e6, data[ACK.size:])
+
+    def arm(self, stim_name):
+        return self.send(ARM, stim_name.encode())
+
+    def trigger(self, stim_name=''):
+        return self.send(TRIGGER, stim_name.encode())
+
+    def set_bg(self, bg_luminosity):
+        return self.send(SET_BG, bytes([int(bg_luminosity) & 0xFF]))
+
+    def status(self):
+        ack = self.send(STATUS)
+        return json.loads(ack.payload.decode()) if ack is not None and ack.status == OK else None
+
+    def print_round_trips(self):
+        if self.round_trips:
+            rtt = np.array(self.round_trips)
+            print('{} messages, round trip median {:.3f} ms, 95% {:.3f} ms, max {:.3f} ms, {} timed out'.format(
+                len(rtt), np.median(rtt), np.percentile(rtt, 95), np.max(rtt), self.n_timeouts))
+
+
+def loopback_harness(port=8090, unix_path=None, rate=1000, n_messages=5000, server=True):
+    """
+    Send STATUS messages at a given rate and report the round trip times. If server is True a server that
+    acknowledges everything [without a GUI] is started in this process, to measure the transport alone
+    """
+    if server:
+        echo = lambda payload, received_ns: (OK, b'')
+        control_server = Control_server({ARM: echo, TRIGGER: echo, SET_BG: echo, STATUS: echo}, port=port,
+                                        unix_path=unix_path)
+        control_server.start()
+
+    client = Control_client(port=port, unix_path=unix_path)
+    start = time.perf_counter()
+    for i in range(n_messages):
+        client.send(STATUS)
+        wait = start + (i + 1) / rate - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+    client.print_round_trips()
+    client.close()
+    if server:
+        control_server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the round trip time of the control server messages')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--unix', default=None, help='path of a unix socket, instead of UDP')
+    parser.add_argument('--rate', type=float, default=1000, help='messages per second')
+    parser.add_argument('--n', type=int, default=5000, help='number of messages')
+    parser.add_argument('--gui', action='store_true', help='send the messages to the GUI instead of a local server')
+    args = parser.parse_args()
+
+    loopback_harness(args.port, args.unix, args.rate, args.n, server=not args.gui)
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import tty
+import argparse
+import threading
+
+from Utils.serial_protocol import Frame_parser, Serial_link, encode_frame, COMMAND, ACK, EVENT, EVENT_PAYLOAD
+from Utils.arduino_reader import RISING, FALLING
+
+
+"""
+FAKE ARDUINO ON A PSEUDO TERMINAL
+
+An arduino that speaks the framed serial protocol [see Utils/serial_protocol.py] on a pseudo terminal, so the serial
+comms can be tested without the board: open port_name with serial.Serial as if it was the arduino's port. It
+acknowledges each command and can send events [changes of level of an input] at a given rate.
+loopback_check runs a Serial_link against it and checks that every command is acknowledged and every event received,
+it exits with an error if they aren't [e.g. to check the serial comms before an experiment].
+Only works on linux and mac [pseudo terminals]:
+    python -m Utils.fake_arduino --rate 1000
+    python -m Utils.fake_arduino --check
+"""
+
+
+class Fake_arduino():
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)  # no echo or line editing: the bytes go through as they are
+        self.port_name = os.ttyname(self.slave)
+
+        self.parser = Frame_parser()
+        self.write_lock = threading.Lock()  # acks and events are written from different threads
+        self.commands = []  # payloads of the commands received
+        self.event_seq, self.level = 0, 0
+        self.start_time = time.perf_counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        os.close(self.slave)  # the master read returns
+        self.thread.join(1)
+        os.close(self.master)
+
+    def write(self, frame):
+        with self.write_lock:
+            os.write(self.master, frame)
+
+    def run(self):
+        """ Acknowledge the commands received """
+        while not self.stopped.is_set():
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            for kind, seq, payload in self.parser.feed(data):
+                if kind == COMMAND:
+                    self.commands.append(payload)
+                    self.write(encode_frame(ACK, seq))
+
+    def send_event(self, level=None):
+        """ The level of the input changed [toggles it if level is None] """
+        self.level = (1 - self.level) if level is None else level
+        micros = int((time.perf_counter() - self.start_time) * 1e6) & 0xFFFFFFFF
+        self.write(encode_frame(EVENT, self.event_seq, EVENT_PAYLOAD.pack(self.level, micros)))
+        self.event_seq = (self.event_seq + 1) & 0xFFFF
+
+    def send_events(self, rate=1000, n_events=1000):
+        """ Toggle the input rate times per second """
+        start = time.perf_counter()
+        for i in range(n_events):
+            self.send_event()
+            wait = start + (i + 1) / rate - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+
+def loopback_check(n_commands=200, n_events=200, rate=1000, timeout=2.0):
+    """
+    Round trip through a pseudo terminal: a Serial_link sends commands to a Fake_arduino, which acknowledges them and
+    sends events. Returns True if all the commands were acknowledged and all the events received, in order
+    """
+    import serial
+    arduino = Fake_arduino()
+    arduino.start()
+    link = Serial_link(serial.Serial(arduino.port_name, 500000))
+    link.start()
+
+    events_thread = threading.Thread(target=arduino.send_events, args=(rate, n_events), daemon=True)
+    events_thread.start()
+    start = time.perf_counter()
+    for i in range(n_commands):
+        link.send_command('p')
+        wait = start + (i + 1) / rate - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+    events_thread.join()
+
+    # wait for the last acks and events to arrive
+    events = []
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and (link.n_acks < n_commands or len(events) < n_events):
+        events.extend(link.get_events())
+        time.sleep(0.01)
+    events.extend(link.get_events())
+
+    link.print_round_trip_summary()
+    link.stop()
+    link.ser.close()
+    arduino.stop()
+
+    edges = [event.edge for event in events]
+    expected_edges = [RISING if i % 2 == 0 else FALLING for i in range(n_events)]  # the input toggles from low
+    ok = link.n_acks == n_commands and edges == expected_edges and len(arduino.commands) == n_commands \
+        and not link.commands_lost and not link.events_lost and not link.bad_frames
+    print('Loopback check {}: {}/{} commands acknowledged, {}/{} events received'.format(
+        'passed' if ok else 'FAILED', link.n_acks, n_commands, len(events), n_events))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake arduino on a pseudo terminal')
+    parser.add_argument('--rate', type=float, default=0, help='events per second, 0 to only acknowledge commands')
+    parser.add_argument('--check', action='store_true', help='run the loopback check of the serial comms and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if loopback_check(rate=args.rate or 1000) else 1)
+
+    arduino = Fake_arduino()
+    arduino.start()
+    print('Fake arduino on {}'.format(arduino.port_name))
+    try:
+        while True:
+            if args.rate:
+                arduino.send_events(args.rate, int(args.rate))
+            else:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        arduino.stop()
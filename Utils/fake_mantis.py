@@ -0,0 +1,127 @@
+import time
+import socket
+import struct
+import argparse
+import numpy as np
+
+from Utils.mantis_data import TEXT_ACTION, BINARY_ACTION, encode_text_data, encode_binary_data
+
+
+"""
+FAKE MANTIS CLIENT
+
+Connects to the Mantis server of the GUI [see MantisComms in Utils/Comms.py] and sends packets like Mantis does: an
+INIT packet, then DATA packets with chunks of samples at a given rate. Used to test the server without the
+acquisition PC, e.g. to check that a high rate stream doesn't stall the stimulus PC:
+    python -m Utils.fake_mantis --rate 500 --duration 10 --binary
+"""
+
+
+HEADER_SIZE = 16
+
+
+class Fake_mantis():
+    def __init__(self, host='localhost', port=8079, channel=1, connect_timeout=5):
+        self.host, self.port = host, port
+        self.channel = channel
+        self.sock = None
+        self.connect_timeout = connect_timeout
+        self.round_trips = []  # time between sending a packet and getting its reply [ms]
+
+    def connect(self):
+        """ Connect to the server, trying again until connect_timeout [the server might still be starting] """
+        start = time.time()
+        while True:
+            try:
+                self.sock = socket.create_connection((self.host, self.port))
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return
+            except OSError:
+                if time.time() - start > self.connect_timeout:
+                    raise
+                time.sleep(0.1)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Server closed the connection')
+            data += chunk
+        return data
+
+    @staticmethod
+    def make_header(action, channel, size):
+        header = '@{}@{:03d}@{:05d}@'.format(action, channel, size).encode()
+        if len(header) != HEADER_SIZE:
+            raise ValueError('Header {} is not {} bytes long'.format(header, HEADER_SIZE))
+        return header
+
+    def send_packet(self, action, data, reply_size):
+        """ Send a header and its data, returns the reply of the server to the data """
+        start = time.perf_counter()
+        self.sock.sendall(self.make_header(action, self.channel, len(data)))
+        if self.recv_exactly(4) != b'size':
+            raise ValueError('Server did not acknowledge the header')
+        self.sock.sendall(data)
+        reply = self.recv_exactly(reply_size)
+        self.round_trips.append((time.perf_counter() - start) * 1000)
+        return reply
+
+    def init(self):
+        return self.send_packet('INIT', b'@25000@', 8)
+
+    def send_data(self, samples, binary=False):
+        """ Send a chunk of samples [as text or as raw floats], returns the average sent back by the server """
+        if binary:
+            reply = self.send_packet(BINARY_ACTION, encode_binary_data(samples), 8)
+        else:
+            reply = self.send_packet(TEXT_ACTION, encode_text_data(samples), 8)
+        return struct.unpack('<d', reply)[0]
+
+    def quit(self):
+        return self.send_packet('QUIT', b'QUIT', 8)
+
+    def stream(self, rate=100, duration=5, chunk_size=50, binary=False, verbose=True):
+        """
+        Send DATA packets of chunk_size random samples, rate packets per second for duration seconds. Returns the
+        number of packets per second that were actually sent
+        """
+        n_packets = int(rate * duration)
+        chunks = np.random.randn(min(n_packets, 1000), chunk_size)
+        self.round_trips = []
+        start = time.perf_counter()
+        for i in range(n_packets):
+            self.send_data(chunks[i % len(chunks)], binary=binary)
+            wait = start + (i + 1) / rate - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        elapsed = time.perf_counter() - start
+        if verbose:
+            print('Sent {} packets in {}s [{} per second], round trip: median {} ms, max {} ms'.format(
+                n_packets, round(elapsed, 2), round(n_packets / elapsed), round(np.median(self.round_trips), 3),
+                round(np.max(self.round_trips), 3)))
+        return n_packets / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send fake Mantis packets to the GUI')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8079)
+    parser.add_argument('--rate', type=float, default=100, help='DATA packets per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds')
+    parser.add_argument('--chunk', type=int, default=50, help='samples per packet')
+    parser.add_argument('--binary', action='store_true', help='send the samples as raw floats [BDAT packets]')
+    args = parser.parse_args()
+
+    mantis = Fake_mantis(args.host, args.port)
+    mantis.connect()
+    print(mantis.init())
+    mantis.stream(args.rate, args.duration, args.chunk, binary=args.binary)
+    print(mantis.quit())
+    mantis.close()
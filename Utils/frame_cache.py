@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from Utils.stimuli_calculator import Stimuli_calculator, as_monitor_geometry
+from Utils.frame_schedules import Frame_schedule
+
+
+"""
+CLASS TO CACHE THE FRAME SCHEDULES COMPUTED BY Stimuli_calculator
+
+Frames are stored under a key computed from the normalised stim params, the ms per screen refresh and the monitor
+geometry. There are two tiers:
+    * memory: LRU dictionary with the last N stimuli used
+    * disk: one .npz file per stimulus in the cache folder, the oldest files are deleted when the folder gets too big
+"""
+
+# Bump this whenever the format of the frames returned by Stimuli_calculator changes, so that old entries are ignored
+CACHE_VERSION = 5
+
+# Params added to the stim params dictionary when a stim is launched, they don't affect the frames
+BOOKKEEPING_PARAMS = ['stim_count', 'stim_name', 'stim_start']
+
+
+class Frames_cache():
+    def __init__(self, cache_folder=None, max_memory_items=32, max_disk_mb=500):
+        """
+        :param cache_folder: folder where the .npz files are saved. If None only the memory tier is used
+        :param max_memory_items: number of stimuli kept in memory
+        :param max_disk_mb: max size of the cache folder in MB
+        """
+        self.cache_folder = cache_folder
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()  # frames can be requested by the GUI, arduino and mantis threads
+
+        # Keep track of how the cache is doing
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+        if self.cache_folder is not None and not os.path.isdir(self.cache_folder):
+            os.makedirs(self.cache_folder)
+
+    ################################################################################################################
+    """  KEYS  """
+    ################################################################################################################
+
+    @staticmethod
+    def normalise_params(params):
+        """ Params loaded from YAML can be int or str, once edited in the GUI they are always str: compare them as str """
+        return {str(k): str(v).strip() for k, v in params.items() if k not in BOOKKEEPING_PARAMS}
+
+    @staticmethod
+    def make_key(params, screenMs, monitor):
+        monitor = as_monitor_geometry(monitor)
+        description = dict(version=CACHE_VERSION,
+                           params=Frames_cache.normalise_params(params),
+                           screenMs=repr(float(screenMs)),
+                           monitor=[monitor.name, list(monitor.size_pix), repr(monitor.width), repr(monitor.distance)])
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get_disk_path(self, key):
+        return os.path.join(self.cache_folder, '{}.npz'.format(key))
+
+    ################################################################################################################
+    """  GET and PUT  """
+    ################################################################################################################
+
+    def get_schedule(self, params, screenMs, monitor):
+        """
+        Returns the frame schedule for a stimulus, computing it with Stimuli_calculator only if it is not cached.
+        The schedule returned is shared with the cache: its arrays must not be modified in place.
+        """
+        if Stimuli_calculator.is_random(params):
+            # a different stimulus every time, nothing to cache
+            return Stimuli_calculator(monitor, params, screenMs).schedule
+
+        key = self.make_key(params, screenMs, monitor)
+        schedule = self.get(key)
+        if schedule is None:
+            self.misses += 1
+            schedule = Stimuli_calculator(monitor, params, screenMs).schedule
+            self.put(key, schedule)
+        return schedule
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.hits += 1
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        if self.cache_folder is None or not os.path.isfile(self.get_disk_path(key)):
+            return None
+
+        try:
+            schedule = self.load(self.get_disk_path(key))
+            os.utime(self.get_disk_path(key))  # mark as recently used for eviction
+        except Exception as e:
+            print('Could not load cached frames {}: {}'.format(key, e))
+            return None
+
+        self.disk_hits += 1
+        self.add_to_memory(key, schedule)
+        return schedule
+
+    def put(self, key, schedule):
+        self.add_to_memory(key, schedule)
+        if self.cache_folder is not None:
+            try:
+                self.save(self.get_disk_path(key), schedule)
+                self.evict_from_disk()
+            except Exception as e:
+                print('Could not save frames to cache: {}'.format(e))
+
+    def add_to_memory(self, key, schedule):
+        with self.lock:
+            self.memory[key] = schedule
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_items:
+                self.memory.popitem(last=False)
+
+    def invalidate(self, params, screenMs, monitor):
+        """ Remove the entry for a set of params, e.g. when one of them is edited in the GUI """
+        key = self.make_key(params, screenMs, monitor)
+        with self.lock:
+            if key in self.memory:
+                del self.memory[key]
+        if self.cache_folder is not None and os.path.isfile(self.get_disk_path(key)):
+            try:
+                os.remove(self.get_disk_path(key))
+            except OSError:
+                pass
+
+    def evict_from_disk(self):
+        """ Delete the least recently used files until the cache folder is smaller than the max size """
+        files = [os.path.join(self.cache_folder, f) for f in os.listdir(self.cache_folder) if f.endswith('.npz')]
+        files = [(os.path.getmtime(f), os.path.getsize(f), f) for f in files]
+        total = sum([f[1] for f in files])
+        for mtime, size, f in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(f)
+                total -= size
+            except OSError:
+                pass
+
+    ################################################################################################################
+    """  SAVE and LOAD  """
+    ################################################################################################################
+
+    @staticmethod
+    def save(filepath, schedule):
+        """ Save the arrays of a frame schedule [see Frame_schedule.to_arrays] """
+        # Write to a temporary file first so that a crash never leaves half a file in the cache
+        tmp_path = filepath + '.tmp.npz'
+        np.savez(tmp_path, **schedule.to_arrays())
+        os.replace(tmp_path, filepath)
+
+    @staticmethod
+    def load(filepath):
+        with np.load(filepath, allow_pickle=False) as data:
+            return Frame_schedule.from_arrays({k: data[k] for k in data.files})
@@ -0,0 +1,251 @@
+import numpy as np
+
+
+"""
+FRAME SCHEDULES: WHAT TO SHOW AT EACH FRAME OF A STIMULUS
+
+Stimuli_calculator returns one schedule per stimulus. Each type of stimulus has its own schedule class holding the
+number of frames, the values that change from frame to frame in contiguous arrays and the values that stay constant,
+already parsed from the stim params. When the stimulus is played the renderer for its schedule is resolved once [see
+Utils/renderers.py] so that the render loop only needs to call schedule.renderer(main, schedule, frame_number).
+"""
+
+
+class Grating_phases():
+    def __init__(self, n_frames, periods_per_frame):
+        """
+        Phases of a drifting grating. Behaves like an array of n_frames phases but each phase is calculated when it
+        is needed as frame number * periods per frame, so it takes no memory and no time to build however long the
+        grating is, and the phase of a frame doesn't depend on the phases before it.
+
+        :param n_frames: number of frames in the stimulus
+        :param periods_per_frame: how much the phase advances at each frame [velocity * seconds per frame]
+        """
+        self.n_frames = int(n_frames)
+        self.periods_per_frame = float(periods_per_frame)
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.phase(np.arange(self.n_frames)[idx])
+        if isinstance(idx, np.ndarray):
+            if np.any(idx >= self.n_frames) or np.any(idx < -self.n_frames):
+                raise IndexError('Frame number out of range')
+            return self.phase(np.where(idx < 0, idx + self.n_frames, idx))
+
+        if idx < 0:
+            idx += self.n_frames
+        if idx < 0 or idx >= self.n_frames:
+            raise IndexError('Frame number {} out of range'.format(idx))
+        return float(self.phase(idx))
+
+    def __iter__(self):
+        for idx in range(self.n_frames):
+            yield self[idx]
+
+    def phase(self, frame_number):
+        # phases are periodic, keep them in [0, 1) to avoid losing precision on long stimuli
+        return np.mod(frame_number * self.periods_per_frame, 1.0)
+
+
+####################################################################################################################
+####################################################################################################################
+"""    SCHEDULES   """
+####################################################################################################################
+####################################################################################################################
+
+
+class Frame_schedule():
+    __slots__ = ('n_frames', 'renderer')
+
+    def __init__(self, n_frames):
+        self.n_frames = int(n_frames)
+        self.renderer = None  # function that draws the stimulus, set when the stimulus is played
+
+    def __len__(self):
+        return self.n_frames
+
+    def __iter__(self):
+        """ Iterate over the state of the stimulus at each frame """
+        for frame_number in range(self.n_frames):
+            yield self.frame_state(frame_number)
+
+    def frame_state(self, frame_number):
+        """ What changes from one frame to the next, used for streaming the frames """
+        return None
+
+    ################################################################################################################
+    """  SAVE and LOAD [used by Frames_cache]  """
+    ################################################################################################################
+
+    @classmethod
+    def get_slots(cls):
+        slots = []
+        for klass in reversed(cls.__mro__):
+            slots.extend(getattr(klass, '__slots__', ()))
+        return [s for s in slots if s != 'renderer']
+
+    def to_arrays(self):
+        """ Returns a dictionary of arrays from which the schedule can be rebuilt with from_arrays """
+        arrays, kinds = {}, []
+        for name in self.get_slots():
+            value = getattr(self, name)
+            if value is None:
+                kinds.append('none')
+                continue
+            elif isinstance(value, Grating_phases):
+                kinds.append('grating_phases')
+                value = [value.n_frames, value.periods_per_frame]
+            elif isinstance(value, np.ndarray):
+                kinds.append('array')
+            elif isinstance(value, (tuple, list)):
+                kinds.append('tuple')
+            else:
+                kinds.append('scalar')
+            arrays[name] = np.asarray(value)
+        arrays['__schedule__'] = np.array(type(self).__name__)
+        arrays['__kinds__'] = np.array(kinds)
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        cls = SCHEDULE_TYPES[str(arrays['__schedule__'])]
+        schedule = cls.__new__(cls)
+        schedule.renderer = None
+        for name, kind in zip(cls.get_slots(), arrays['__kinds__']):
+            if kind == 'none':
+                value = None
+            elif kind == 'grating_phases':
+                value = Grating_phases(arrays[name][0], arrays[name][1])
+            elif kind == 'array':
+                value = arrays[name]
+            elif kind == 'tuple':
+                value = tuple(arrays[name].tolist())
+            else:
+                value = arrays[name].item()
+            setattr(schedule, name, value)
+        return schedule
+
+
+class Loom_schedule(Frame_schedule):
+    __slots__ = ('pos', 'radii', 'start_size', 'color', 'units')
+
+    def __init__(self, pos, radii, start_size, color, units):
+        """
+        :param pos: position of the centre of the loom
+        :param radii: radius of the loom at each frame
+        :param start_size: radius when the loom is created
+        :param color: loom color [0-255]
+        :param units: units of pos and radii
+        """
+        radii = np.ascontiguousarray(radii, dtype=np.float64)
+        super().__init__(len(radii))
+        self.pos = (float(pos[0]), float(pos[1]))
+        self.radii = radii
+        self.start_size = float(start_size)
+        self.color = min(max(int(color), 0), 255)
+        self.units = units
+
+    def frame_state(self, frame_number):
+        return self.radii[frame_number]
+
+    def circle_at(self, frame_number):
+        """ Position, radius and rgb255 color of the loom at a frame, used to draw several looms at once """
+        return self.pos, self.radii[frame_number], (self.color, self.color, self.color)
+
+
+class Spot_loom_schedule(Frame_schedule):
+    __slots__ = ('positions', 'radii', 'units')
+
+    def __init__(self, positions, radii, units):
+        """
+        :param positions: N frames x 2 array with the x, y position of the spot at each frame
+        :param radii: radius of the spot at each frame
+        :param units: units of positions and radii
+        """
+        radii = np.ascontiguousarray(radii, dtype=np.float64)
+        super().__init__(len(radii))
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64)
+        self.radii = radii
+        self.units = units
+
+    def frame_state(self, frame_number):
+        return self.positions[frame_number], self.radii[frame_number]
+
+    def circle_at(self, frame_number):
+        """ Position, radius and rgb255 color of the spot at a frame, used to draw several spots at once """
+        return self.positions[frame_number], self.radii[frame_number], (0, 0, 0)
+
+
+class Grating_schedule(Frame_schedule):
+    __slots__ = ('pos', 'size', 'orientation', 'color', 'spatial_frequency', 'units', 'phases')
+
+    def __init__(self, pos, size, orientation, color, spatial_frequency, units, phases):
+        """
+        :param pos: position of the grating
+        :param size: size of the grating
+        :param orientation: orientation of the grating
+        :param color: foreground color [psychopy -1 to 1 scale]
+        :param spatial_frequency: spatial frequency
+        :param units: units of pos, size and spatial frequency
+        :param phases: phase at each frame [Grating_phases]
+        """
+        super().__init__(len(phases))
+        self.pos = tuple(pos)
+        self.size = tuple(size)
+        self.orientation = orientation
+        self.color = color
+        self.spatial_frequency = float(spatial_frequency)
+        self.units = units
+        self.phases = phases
+
+    def frame_state(self, frame_number):
+        return self.phases[frame_number]
+
+
+class Fearcond_schedule(Frame_schedule):
+    __slots__ = ('timeline', 'pos', 'size', 'spatial_frequency', 'units', 'velocity', 'flash_screen', 'audiostim')
+
+    def __init__(self, timeline, pos, size, spatial_frequency, units, velocity, flash_screen, audiostim):
+        """
+        :param timeline: structured array with the state of each element of the stimulus at each frame
+                        [see FEARCOND_TIMELINE_DTYPE]
+        :param pos: position of the grating
+        :param size: size of the grating
+        :param spatial_frequency: spatial frequency of the grating
+        :param units: units of pos, size and spatial frequency
+        :param velocity: velocity of the grating
+        :param flash_screen: if True the screen flashes instead of showing the grating
+        :param audiostim: path to the ultrasound audio file
+        """
+        super().__init__(len(timeline))
+        self.timeline = np.ascontiguousarray(timeline)
+        self.pos = tuple(pos)
+        self.size = tuple(size)
+        self.spatial_frequency = float(spatial_frequency)
+        self.units = units
+        self.velocity = velocity
+        self.flash_screen = bool(flash_screen)
+        self.audiostim = audiostim
+
+    def frame_state(self, frame_number):
+        return self.timeline[frame_number]
+
+
+class Audio_schedule(Frame_schedule):
+    __slots__ = ('filepath', )
+
+    def __init__(self, n_frames, filepath):
+        """ The audio file is played at the first frame, nothing else is created for the duration of the file """
+        super().__init__(n_frames)
+        self.filepath = filepath
+
+
+class Delay_schedule(Frame_schedule):
+    __slots__ = ()
+
+
+SCHEDULE_TYPES = {cls.__name__: cls for cls in [Loom_schedule, Spot_loom_schedule, Grating_schedule,
+                                                 Fearcond_schedule, Audio_schedule, Delay_schedule]}
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+"""
+KEEP TRACK OF WHAT IS ON THE PSYCHOPY WINDOW
+
+Setting a property of a psychopy stimulus [e.g. its radius or color] or of the window is not free: psychopy
+recalculates vertices, colors or textures each time. Most frames only change one property, and when no stimulus is
+being played nothing changes at all, so the render loop remembers the last value pushed to psychopy for each property
+and only pushes a new one when it is different.
+"""
+
+
+_UNSET = object()
+
+
+class Frame_state():
+    def __init__(self):
+        self.values = {}  # name of the property -> last value pushed to psychopy
+
+    def changed(self, name, value):
+        """
+        Returns True if a value is different from the last one pushed for a property [and remembers it]. The caller
+        is expected to push the value to psychopy when True is returned
+
+        :param name: name of the property [e.g. 'bg', 'square color', 'radius']
+        :param value: value for this frame
+        """
+        previous = self.values.get(name, _UNSET)
+        if previous is not _UNSET:
+            if isinstance(value, np.ndarray) or isinstance(previous, np.ndarray):
+                if np.array_equal(previous, value):
+                    return False
+            elif previous == value:
+                return False
+
+        if isinstance(value, np.ndarray):
+            # the caller might change the array in place: keep a copy, in the array kept for the last value if it fits
+            if isinstance(previous, np.ndarray) and previous.shape == value.shape and previous.dtype == value.dtype:
+                np.copyto(previous, value)
+                return True
+            value = value.copy()
+        self.values[name] = value
+        return True
+
+    def forget(self, *names):
+        """ Forget the values of some properties, e.g. when a different stimulus object is used """
+        for name in names:
+            self.values.pop(name, None)
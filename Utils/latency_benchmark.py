@@ -0,0 +1,137 @@
+import os
+import time
+import datetime
+import threading
+import yaml
+import numpy as np
+
+
+"""
+TRIGGER TO PHOTON LATENCY BENCHMARK
+
+Measures the time between a stimulus being triggered and the first frame of the stimulus being shown on the screen.
+A timestamp is taken where the trigger enters the app [the GUI launch button, the arduino reading loop, the mantis
+comms] and another one right after the first window.flip() that shows the stimulus. The latencies are grouped by
+trigger source so that the distributions [and their jitter] can be compared across hundreds of trials.
+"""
+
+
+if hasattr(time, 'perf_counter_ns'):
+    timestamp_ns = time.perf_counter_ns
+else:  # python < 3.7
+    def timestamp_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+class Latency_recorder():
+    def __init__(self, number_of_trials=300, report_every=50, results_folder=os.path.join('.', 'Tests Results')):
+        """
+        :param number_of_trials: number of trials after which the results are reported and saved for the last time
+        :param report_every: print a summary of the results every N trials
+        :param results_folder: folder where the results are saved
+        """
+        self.number_of_trials = number_of_trials
+        self.report_every = report_every
+        self.results_folder = results_folder
+
+        self.latencies = {}  # trigger source -> list of latencies in ns
+        self.pending = None  # (source, trigger timestamp) of the stim that is waiting to be shown
+        self.onset_drawn = False  # set when the first frame of the pending stim has been drawn, before the flip
+        self.trials_done = 0
+
+        self.lock = threading.Lock()  # triggers come from the GUI, arduino and mantis threads
+
+    ################################################################################################################
+    """  RECORDING  """
+    ################################################################################################################
+
+    def trigger(self, source, trigger_ns=None):
+        """
+        Called when a stim is launched
+
+        :param source: what triggered the stim [e.g. 'GUI', 'arduino', 'mantis']
+        :param trigger_ns: timestamp of when the trigger entered the app, if None it is taken now
+        """
+        if trigger_ns is None:
+            trigger_ns = timestamp_ns()
+        with self.lock:
+            self.pending = (source, trigger_ns)
+            self.onset_drawn = False
+
+    def first_frame_drawn(self):
+        """ Called by the render loop when the first frame of a stim has been drawn """
+        with self.lock:
+            if self.pending is not None:
+                self.onset_drawn = True
+
+    def flipped(self, flip_ns=None):
+        """
+        Called by the render loop right after each window flip. Returns True when a trial has been recorded
+
+        :param flip_ns: timestamp of the flip, if None it is taken now
+        """
+        if not self.onset_drawn:
+            return False
+
+        if flip_ns is None:
+            flip_ns = timestamp_ns()
+        with self.lock:
+            source, trigger_ns = self.pending
+            self.pending, self.onset_drawn = None, False
+            self.latencies.setdefault(source, []).append(flip_ns - trigger_ns)
+            self.trials_done += 1
+            trials_done = self.trials_done
+
+        if trials_done % self.report_every == 0 or trials_done == self.number_of_trials:
+            self.print_summary()
+            self.save()
+        return True
+
+    @property
+    def done(self):
+        return self.trials_done >= self.number_of_trials
+
+    ################################################################################################################
+    """  RESULTS  """
+    ################################################################################################################
+
+    def summary(self):
+        """ Latency and jitter [in ms] for each trigger source """
+        with self.lock:
+            latencies = {source: np.array(lat, dtype=np.float64) / 1e6 for source, lat in self.latencies.items()}
+
+        summary = {}
+        for source, lat in latencies.items():
+            if not len(lat):
+                continue
+            summary[source] = dict(trials=int(len(lat)),
+                                   mean=float(np.mean(lat)),
+                                   median=float(np.median(lat)),
+                                   jitter=float(np.std(lat)),
+                                   min=float(np.min(lat)),
+                                   max=float(np.max(lat)),
+                                   p5=float(np.percentile(lat, 5)),
+                                   p95=float(np.percentile(lat, 95)))
+        return summary
+
+    def print_summary(self):
+        print('\n     ... trigger to photon latency after {} trials [ms]'.format(self.trials_done))
+        for source, res in sorted(self.summary().items()):
+            print('     ... {:>10}: n {:>4}, mean {:6.2f}, median {:6.2f}, jitter {:5.2f}, range {:6.2f}-{:6.2f},'
+                  ' 5-95% {:6.2f}-{:6.2f}'.format(source, res['trials'], res['mean'], res['median'], res['jitter'],
+                                                 res['min'], res['max'], res['p5'], res['p95']))
+
+    def save(self, name=None):
+        """ Save the summary and all the latencies [ms] as a .yml file in the results folder """
+        if name is None:
+            name = 'latency_{}'.format(datetime.datetime.today().strftime('%d%b%Y_%H%M'))
+        with self.lock:
+            latencies = {source: [l / 1e6 for l in lat] for source, lat in self.latencies.items()}
+
+        try:
+            if not os.path.isdir(self.results_folder):
+                os.makedirs(self.results_folder)
+            with open(os.path.join(self.results_folder, name + '.yml'), 'w') as outfile:
+                yaml.dump(dict(summary=self.summary(), latencies=latencies), outfile, default_flow_style=False)
+        except Exception as e:
+            print('Could not save latency results: {}'.format(e))
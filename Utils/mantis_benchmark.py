@@ -0,0 +1,108 @@
+import time
+import argparse
+import threading
+import numpy as np
+
+from Utils.mantis_data import parse_text_data, parse_binary_data, encode_text_data, encode_binary_data, Sweep_buffer
+from Utils.fake_mantis import Fake_mantis
+
+
+"""
+MANTIS DATA THROUGHPUT BENCHMARK
+
+How many chunks of samples per second can be handled, as text [DATA packets] and as raw floats [BDAT packets]:
+    * parsing: decode the payload of a chunk, add it to a sweep and average it [what MantisComms does for each chunk]
+    * stream: send chunks to a running Mantis server with Utils/fake_mantis.py, at higher and higher sample rates until
+      the server can't keep up [the fake client waits for the reply to a chunk before sending the next one]
+The sample rates are compared to the acquisition rate of Mantis [25 kHz].
+    python -m Utils.mantis_benchmark --chunk 50
+    python -m Utils.mantis_benchmark --stream --local
+"""
+
+
+ACQUISITION_RATE = 25000  # samples per second
+
+
+def benchmark_parsing(chunk_sizes=(10, 50, 250, 1000, 5000), n_chunks=20000, sweep_size=1250):
+    """ Chunks per second that are parsed, added to a sweep and averaged, for each chunk size and format """
+    print('\nParsing throughput [acquisition rate: {} samples/s]'.format(ACQUISITION_RATE))
+    print('{:>8} {:>8} {:>14} {:>16} {:>10}'.format('chunk', 'format', 'chunks/s', 'samples/s', 'x 25 kHz'))
+
+    results = {}
+    for chunk_size in chunk_sizes:
+        samples = np.random.randn(chunk_size)
+        payloads = dict(text=(encode_text_data(samples), parse_text_data),
+                        binary=(encode_binary_data(samples), parse_binary_data))
+        for fmt, (payload, parse) in payloads.items():
+            sweep = Sweep_buffer(sweep_size)
+            n = n_chunks if fmt == 'binary' else max(n_chunks // 10, 100)  # text is much slower
+            start = time.perf_counter()
+            for i in range(n):
+                chunk = parse(payload)
+                sweep.add_chunk(chunk)
+                np.mean(chunk)
+            elapsed = time.perf_counter() - start
+
+            chunks_per_s = n / elapsed
+            results[(chunk_size, fmt)] = chunks_per_s * chunk_size
+            print('{:>8} {:>8} {:>14,.0f} {:>16,.0f} {:>10.1f}'.format(chunk_size, fmt, chunks_per_s,
+                                                                    chunks_per_s * chunk_size,
+                                                                    chunks_per_s * chunk_size / ACQUISITION_RATE))
+    return results
+
+
+def benchmark_stream(host='localhost', port=8079, chunk_size=50, binary=True, duration=2, max_rate=ACQUISITION_RATE*64):
+    """
+    Stream chunks to a Mantis server at 25 kHz, 50 kHz, 100 kHz... until the server doesn't keep up [less than 95% of
+    the target rate]. Returns the highest sample rate that was sustained
+    """
+    mantis = Fake_mantis(host, port)
+    mantis.connect()
+    mantis.init()
+
+    print('\nStream throughput, {} samples per chunk as {}'.format(chunk_size, 'binary' if binary else 'text'))
+    print('{:>12} {:>12} {:>14} {:>14}'.format('target/s', 'samples/s', 'median rtt ms', 'max rtt ms'))
+    sustained, rate = 0, ACQUISITION_RATE
+    while rate <= max_rate:
+        chunks_per_s = mantis.stream(rate / chunk_size, duration, chunk_size, binary=binary, verbose=False)
+        achieved = chunks_per_s * chunk_size
+        print('{:>12,.0f} {:>12,.0f} {:>14.3f} {:>14.3f}'.format(rate, achieved, np.median(mantis.round_trips),
+                                                                np.max(mantis.round_trips)))
+        if achieved < 0.95 * rate:
+            break
+        sustained = rate
+        rate *= 2
+    mantis.quit()
+    mantis.close()
+
+    print('Highest sample rate sustained: {:,.0f} samples/s [{}x the acquisition rate]'.format(
+        sustained, round(sustained / ACQUISITION_RATE, 1)))
+    return sustained
+
+
+def start_local_server(port):
+    """ Start a Mantis server in this process that doesn't trigger any stim """
+    from Utils.Comms import MantisComms
+    server = MantisComms(None, port=port)
+    server.stim_trigger_func = lambda main, source, trigger_ns: None
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the parsing and streaming of Mantis data')
+    parser.add_argument('--chunk', type=int, default=50, help='samples per chunk for the stream benchmark')
+    parser.add_argument('--stream', action='store_true', help='also stream chunks to a Mantis server')
+    parser.add_argument('--local', action='store_true', help='start the Mantis server in this process')
+    parser.add_argument('--text', action='store_true', help='stream the chunks as text instead of binary')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8079)
+    args = parser.parse_args()
+
+    benchmark_parsing()
+    if args.stream:
+        if args.local:
+            server = start_local_server(args.port)
+        benchmark_stream(args.host, args.port, args.chunk, binary=not args.text)
+        if args.local:
+            server.stop()
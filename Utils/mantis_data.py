@@ -0,0 +1,69 @@
+import numpy as np
+
+
+"""
+PARSING OF THE DATA SENT BY MANTIS
+
+DATA packets carry the samples as text: 'DATA@0.1234@-0.5678@...@'. BDAT packets carry the same samples as raw little
+endian floats [float64 by default], which are read with np.frombuffer: the samples are a view of the bytes received,
+nothing is converted or copied until they are added to the sweep of the client.
+The chunks of samples of each client are copied in a preallocated ring buffer the size of a sweep: when it is full
+the sweep is complete, it is copied in last_sweep and the ring starts again from the beginning.
+"""
+
+
+TEXT_ACTION, BINARY_ACTION = 'DATA', 'BDAT'
+BINARY_DTYPE = '<f8'
+
+
+def parse_text_data(data):
+    """ Samples of a DATA packet [drop the 'DATA' prefix and the empty element after the last @] """
+    return np.array(data.split(b'@')[1:-1], dtype=np.float64)
+
+
+def parse_binary_data(data, dtype=BINARY_DTYPE):
+    """ Samples of a BDAT packet, a read only view of data """
+    dtype = np.dtype(dtype)
+    if len(data) % dtype.itemsize:
+        raise ValueError('BDAT packet of {} bytes is not a whole number of {} samples'.format(len(data), dtype))
+    return np.frombuffer(data, dtype=dtype)
+
+
+class Sweep_buffer():
+    def __init__(self, size):
+        """
+        :param size: number of samples in a sweep
+        """
+        self.samples = np.zeros(size)
+        self.position = 0  # where the next chunk goes
+        self.last_sweep = np.zeros(size)  # the last complete sweep
+        self.n_sweeps = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add_chunk(self, chunk):
+        """ Copy a chunk of samples at position, when the sweep is full it starts again. Returns True if a sweep was
+        completed """
+        completed = False
+        while len(chunk):
+            n = min(len(chunk), len(self.samples) - self.position)
+            self.samples[self.position:self.position + n] = chunk[:n]
+            self.position += n
+            chunk = chunk[n:]
+            if self.position == len(self.samples):
+                self.last_sweep[:] = self.samples
+                self.n_sweeps += 1
+                self.position = 0
+                completed = True
+        return completed
+
+
+def encode_binary_data(samples, dtype=BINARY_DTYPE):
+    """ Payload of a BDAT packet [used by Utils/fake_mantis.py] """
+    return np.ascontiguousarray(samples, dtype=dtype).tobytes()
+
+
+def encode_text_data(samples):
+    """ Payload of a DATA packet [used by Utils/fake_mantis.py] """
+    return ('DATA@' + '@'.join('{:.4f}'.format(s) for s in samples) + '@').encode()
@@ -0,0 +1,170 @@
+import numpy as np
+
+from Utils.latency_benchmark import timestamp_ns
+
+
+"""
+ONLINE DETECTOR FOR CLOSED LOOP STIMULATION
+
+Looks at each chunk of samples sent by Mantis as soon as it arrives and decides if a stim should be triggered:
+    * threshold: a sample is above the threshold [below it if direction is 'falling']
+    * crossing: the signal crosses the threshold [the last sample of the previous chunk is included, so crossings
+      between two chunks are not missed]
+    * rate: the number of crossings in the last window_ms [a sliding window across chunks] reaches min_rate per second
+After a trigger no other trigger is detected for refractory_ms.
+Each chunk is processed with a few numpy operations on the whole chunk and nothing is allocated per sample: the
+crossings of the rate detector are kept in a preallocated ring. The time between a chunk arriving and the decision
+being made is recorded for each chunk, so it can be checked against the latency budget of the experiment.
+"""
+
+
+MODES = ('threshold', 'crossing', 'rate')
+
+
+class Online_detector():
+    def __init__(self, mode='crossing', threshold=1.0, direction='rising', fs=25000, window_ms=100, min_rate=20,
+                 refractory_ms=1000, latency_budget_ms=1, max_events=4096, n_latencies=10000):
+        """
+        :param mode: threshold, crossing or rate
+        :param threshold: value of the signal
+        :param direction: 'rising' to detect samples above the threshold, 'falling' for samples below it
+        :param fs: sampling frequency of the signal [Hz]
+        :param window_ms: length of the sliding window of the rate detector
+        :param min_rate: crossings per second in the window that trigger a stim [rate detector]
+        :param refractory_ms: time after a trigger during which no other trigger is detected
+        :param latency_budget_ms: decisions that take longer than this are counted as over budget
+        :param max_events: max number of crossings kept for the rate detector
+        :param n_latencies: number of decision latencies kept for the summary
+        """
+        if mode not in MODES:
+            raise ValueError('Unrecognised detector mode: {}, use one of {}'.format(mode, MODES))
+        if direction not in ('rising', 'falling'):
+            raise ValueError('Unrecognised direction: {}'.format(direction))
+        self.mode = mode
+        self.sign = 1.0 if direction == 'rising' else -1.0  # falling signals are flipped to detect them as rising
+        self.threshold = self.sign * float(threshold)
+        self.min_rate = min_rate
+        self.latency_budget_ns = int(latency_budget_ms * 1e6)
+        self.set_sampling_rate(fs, window_ms, refractory_ms)
+
+        self.n_samples = 0  # samples processed so far, the index of a sample is counted from the first one
+        self.last_sample = None  # last sample of the previous chunk
+        self.last_trigger = None  # index of the sample that caused the last trigger
+        self.n_triggers = 0
+
+        self.events = np.full(max_events, np.iinfo(np.int64).min, dtype=np.int64)  # indices of the last crossings
+        self.n_events = 0
+
+        self.latencies = np.zeros(n_latencies, dtype=np.int64)  # time from chunk arrival to decision [ns]
+        self.n_decisions, self.over_budget = 0, 0
+
+    @classmethod
+    def from_settings(cls, detector_settings, fs=25000):
+        """ Detector from the mantis_detector settings in GUI_cfg.yml, None if no mode is set """
+        if not detector_settings or not detector_settings.get('mode', None):
+            return None
+        return cls(fs=fs, **detector_settings)
+
+    def set_sampling_rate(self, fs, window_ms=None, refractory_ms=None):
+        """ Sampling frequency changed [e.g. when Mantis sends INIT] """
+        if window_ms is None:
+            window_ms = self.window_samples * 1000 / self.fs
+        if refractory_ms is None:
+            refractory_ms = self.refractory_samples * 1000 / self.fs
+        self.fs = float(fs)
+        self.window_samples = max(1, int(round(window_ms * self.fs / 1000)))
+        self.refractory_samples = int(round(refractory_ms * self.fs / 1000))
+        self.min_events = max(1, int(np.ceil(self.min_rate * window_ms / 1000)))
+
+    ####################################################################################################################
+    """    DETECTION   """
+    ####################################################################################################################
+
+    def crossings(self, chunk):
+        """ Indices [in the chunk] of the samples at which the signal crosses the threshold """
+        if self.last_sample is None:
+            below = chunk[:-1] < self.threshold
+            return np.flatnonzero(below & (chunk[1:] >= self.threshold)) + 1
+        below = np.empty(len(chunk), dtype=bool)
+        below[0] = self.last_sample < self.threshold
+        np.less(chunk[:-1], self.threshold, out=below[1:])
+        return np.flatnonzero(below & (chunk >= self.threshold))
+
+    def process(self, chunk, arrival_ns=None):
+        """
+        Process a chunk of samples, returns True if a stim should be triggered
+
+        :param chunk: numpy array of samples, the ones that follow the previous chunk
+        :param arrival_ns: when the chunk arrived [timestamp_ns], used to measure the latency of the decision
+        """
+        if not len(chunk):
+            return False
+        if self.sign < 0:
+            chunk = -chunk
+        first_index = self.n_samples
+
+        if self.mode == 'threshold':
+            idx = np.flatnonzero(chunk >= self.threshold)
+        else:
+            idx = self.crossings(chunk)
+
+        trigger_at = None  # index of the sample that causes a trigger
+        if self.mode == 'rate':
+            if len(idx):
+                self.add_events(idx + first_index)
+            window_start = first_index + len(chunk) - self.window_samples
+            if np.count_nonzero(self.events >= window_start) >= self.min_events:
+                trigger_at = first_index + len(chunk) - 1
+        elif len(idx):
+            trigger_at = first_index + int(idx[0])
+            if self.last_trigger is not None and trigger_at < self.last_trigger + self.refractory_samples:
+                # the first one is too close to the last trigger, is there one later in the chunk?
+                later = idx[idx + first_index >= self.last_trigger + self.refractory_samples]
+                trigger_at = first_index + int(later[0]) if len(later) else None
+
+        if trigger_at is not None and self.last_trigger is not None and \
+                trigger_at < self.last_trigger + self.refractory_samples:
+            trigger_at = None
+        if trigger_at is not None:
+            self.last_trigger = trigger_at
+            self.n_triggers += 1
+
+        self.n_samples += len(chunk)
+        self.last_sample = chunk[-1]
+        if arrival_ns is not None:
+            self.record_latency(timestamp_ns() - arrival_ns)
+        return trigger_at is not None
+
+    def add_events(self, indices):
+        """ Add the indices of crossings to the ring of events """
+        indices = indices[-len(self.events):]
+        positions = (self.n_events + np.arange(len(indices))) % len(self.events)
+        self.events[positions] = indices
+        self.n_events += len(indices)
+
+    ####################################################################################################################
+    """    LATENCY   """
+    ####################################################################################################################
+
+    def record_latency(self, latency_ns):
+        self.latencies[self.n_decisions % len(self.latencies)] = latency_ns
+        self.n_decisions += 1
+        if latency_ns > self.latency_budget_ns:
+            self.over_budget += 1
+
+    def latency_summary(self):
+        """ Time from the arrival of a chunk to the decision [us] over the last decisions """
+        latencies = self.latencies[:min(self.n_decisions, len(self.latencies))] / 1e3
+        if not len(latencies):
+            return {}
+        return dict(decisions=int(self.n_decisions), triggers=int(self.n_triggers), median=float(np.median(latencies)),
+                    p95=float(np.percentile(latencies, 95)), max=float(np.max(latencies)),
+                    over_budget=int(self.over_budget))
+
+    def print_latency_summary(self, name=''):
+        summary = self.latency_summary()
+        if summary:
+            print('     ... {} detector: {} chunks, {} triggers, decision latency median {:.1f} us, 95% {:.1f} us, '
+                  'max {:.1f} us, {} over the {} ms budget'.format(name, summary['decisions'], summary['triggers'],
+                                                                   summary['median'], summary['p95'], summary['max'],
+                                                                   summary['over_budget'], self.latency_budget_ns / 1e6))
@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+
+"""
+SNAPSHOTS OF THE PARAMETERS SET IN THE GUI
+
+The render loop runs in its own thread and must not touch the Qt widgets. When a parameter widget is edited [Qt
+textEdited signal, in the GUI thread] the values of the widgets are parsed into a new snapshot, which is immutable, and
+published to a double buffer. The render thread reads the front snapshot, which is swapped with a single assignment so
+it never sees a half-edited set of parameters.
+The params of each loaded stim are handled the same way: an edit replaces the params dictionary in prepared_stimuli
+with an edited copy instead of changing it in place [see App_control.read_from_params_widgets].
+"""
+
+
+# Parameters of the GUI used by the render loop, already parsed
+Params_snapshot = namedtuple('Params_snapshot', ['bg_luminosity', 'delay'])
+
+
+class Snapshot_buffer():
+    def __init__(self, snapshot):
+        """
+        Double buffer of Params_snapshot: the GUI thread writes to the back buffer, then swaps it with the front one
+
+        :param snapshot: initial snapshot
+        """
+        self.buffers = [snapshot, snapshot]
+        self.front = 0
+
+    def publish(self, snapshot):
+        back = 1 - self.front
+        self.buffers[back] = snapshot
+        self.front = back  # the swap: readers see either the old or the new snapshot, never something in between
+
+    def read(self):
+        return self.buffers[self.front]
+
+
+def parse_int(text, default=0):
+    """ Parse the text of a widget as an int, while the user is typing the text might not be a number yet """
+    try:
+        return int(text)
+    except ValueError:
+        if not text.strip():
+            return 0
+        return default
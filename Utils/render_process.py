@@ -0,0 +1,309 @@
+import json
+import time
+import queue
+import threading
+import multiprocessing
+from collections import deque
+
+from Utils.shared_ring import Shared_ring
+from Utils.latency_benchmark import timestamp_ns
+from Utils.stimuli_calculator import Stimuli_calculator, Monitor_geometry, get_position_in_px, map_color_scale
+from Utils.frame_cache import Frames_cache
+from Utils.stim_stream import Stream_segment
+from Utils.tiled_output import Tile, Psychopy_backend
+from Utils.sync_output import Sync_output, OFFSET
+
+
+"""
+RENDER LOOP IN ITS OWN PROCESS
+
+When render_process is set in GUI_cfg.yml the psychopy window is created and drawn by a separate process, so the
+timing of the flips doesn't depend on what the GUI, arduino and mantis threads are doing [they all share the GIL].
+The GUI process sends commands [arm a stim with its params, trigger it, change the background] through a shared
+memory ring buffer and the render process sends back telemetry [ready, stim onset, end of a stim with the number of
+dropped frames, errors, background] through another one [see Utils/shared_ring.py]. Telemetry that doesn't fit in the
+ring [e.g. the GUI isn't reading it] is kept by the render process and sent again at the next frame [Telemetry_outbox].
+The frames of the stims armed are calculated by a thread of the render process [Arming_thread], every edit of a param
+in the GUI re-arms the stim and the flips can't wait for that: the new frames replace the old ones when they are ready.
+The render process only imports what is needed to calculate and draw the frames: no Qt.
+"""
+
+
+# Commands: GUI -> render process
+ARM, TRIGGER, SET_BG, QUIT = 1, 2, 3, 4
+
+# Telemetry: render process -> GUI
+READY, ONSET, END, ERROR, BG = 10, 11, 13, 14, 15
+
+
+class Render_process():
+    def __init__(self, settings, backend=None):
+        """
+        GUI side of the render process
+
+        :param settings: settings from GUI_cfg.yml
+        :param backend: backend used to create the window [see Utils/tiled_output.py], defaults to psychopy
+        """
+        self.commands = Shared_ring(capacity=int(settings.get('render_process_ring_size', 256)))
+        self.telemetry = Shared_ring(capacity=int(settings.get('render_process_ring_size', 256)) * 4)
+        self.lock = threading.Lock()  # commands are sent from the GUI, arduino and mantis threads of this process
+
+        self.process = multiprocessing.Process(target=render_process_main,
+                                               args=(settings, self.commands.buffer, self.telemetry.buffer, backend),
+                                               daemon=True)
+        self.screenMs = None  # set when the render process is ready
+
+    def start(self):
+        self.process.start()
+
+    def stop(self, timeout=2):
+        self.send(QUIT)
+        self.process.join(timeout)
+
+    def send(self, kind, value=0.0, payload=b'', t_ns=None):
+        if t_ns is None:
+            t_ns = timestamp_ns()
+        with self.lock:
+            if not self.commands.push(kind, t_ns, value, payload):
+                print('Render process command queue is full, command {} dropped'.format(kind))
+                return False
+        return True
+
+    def arm(self, stim_name, params):
+        """ Send the params of a stim, the render process calculates its frames """
+        return self.send(ARM, payload=json.dumps(dict(name=stim_name, params=params), default=str).encode())
+
+    def trigger(self, stim_name, trigger_ns=None):
+        return self.send(TRIGGER, payload=stim_name.encode(), t_ns=trigger_ns)
+
+    def set_bg(self, bg_luminosity):
+        return self.send(SET_BG, value=float(bg_luminosity))
+
+    def read_telemetry(self):
+        """ List of (kind, t_ns, value, payload) sent by the render process since the last call """
+        return self.telemetry.pop_all()
+
+
+####################################################################################################################
+####################################################################################################################
+"""    RENDER PROCESS   """
+####################################################################################################################
+####################################################################################################################
+
+
+class Arming_thread():
+    def __init__(self, frames_cache, screenMs, geometry):
+        """
+        Calculates the frames of the stims armed in the render process, so that the render loop doesn't. Only the
+        latest params of each stim are calculated: if a stim is armed several times while the thread is busy [e.g.
+        the user is typing in a params box] only the last params are used
+
+        :param frames_cache: Frames_cache of the render process
+        :param screenMs: ms per frame
+        :param geometry: Monitor_geometry of the window
+        """
+        self.frames_cache, self.screenMs, self.geometry = frames_cache, screenMs, geometry
+        self.requests = {}  # stim name -> params, waiting to be calculated
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.results = queue.Queue()  # (stim name, params, schedule, error)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=1):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join(timeout)
+
+    def arm(self, stim_name, params):
+        """ Calculate the frames of a stim [it doesn't wait for them] """
+        with self.lock:
+            self.requests[stim_name] = params
+            self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            if self.stopped:
+                return
+            with self.lock:
+                requests, self.requests = self.requests, {}
+                self.wake.clear()
+            for stim_name, params in requests.items():
+                try:
+                    schedule = self.frames_cache.get_schedule(params, self.screenMs, self.geometry)
+                    self.results.put((stim_name, params, schedule, None))
+                except Exception as e:
+                    self.results.put((stim_name, params, None, e))
+
+    def get_armed(self):
+        """ Stims calculated since the last call as (stim name, params, schedule, error) [it doesn't wait] """
+        armed = []
+        while True:
+            try:
+                armed.append(self.results.get_nowait())
+            except queue.Empty:
+                return armed
+
+
+class Telemetry_outbox():
+    def __init__(self, ring, max_errors=64):
+        """
+        Sends the telemetry of the render process. If the ring is full [the GUI is slow or not reading it] the
+        messages are kept, in order, and sent again at each frame: READY, ONSET, END and BG are never dropped [the
+        GUI would stay busy or show the wrong background], errors are only kept up to max_errors
+
+        :param ring: Shared_ring of the telemetry
+        :param max_errors: max number of ERROR messages waiting to be sent
+        """
+        self.ring, self.max_errors = ring, max_errors
+        self.pending = deque()  # (kind, t_ns, value, payload) waiting for space in the ring
+        self.dropped_errors = 0
+
+    def push(self, kind, t_ns, value=0.0, payload=b''):
+        if kind == ERROR and sum(1 for message in self.pending if message[0] == ERROR) >= self.max_errors:
+            self.dropped_errors += 1
+            print('Render process telemetry is full, {} errors dropped'.format(self.dropped_errors))
+            return
+        if kind == BG:
+            # Only the latest background matters
+            self.pending = deque(message for message in self.pending if message[0] != BG)
+        self.pending.append((kind, t_ns, value, payload))
+        self.flush()
+
+    def flush(self):
+        """ Send the messages waiting, in order, until the ring is full. Returns True if none is left """
+        while self.pending:
+            if not self.ring.push(*self.pending[0]):
+                return False
+            self.pending.popleft()
+        return True
+
+
+####################################################################################################################
+####################################################################################################################
+"""    RENDER PROCESS MAIN   """
+####################################################################################################################
+####################################################################################################################
+
+
+def render_process_main(settings, commands_buffer, telemetry_buffer, backend=None):
+    """
+    Main function of the render process: create the window, then keep flipping it in sync with the screen refresh,
+    executing the commands received from the GUI at each frame
+
+    :param settings: settings from GUI_cfg.yml
+    :param commands_buffer: shared memory of the commands ring
+    :param telemetry_buffer: shared memory of the telemetry ring
+    :param backend: backend used to create the window, defaults to psychopy
+    """
+    commands, telemetry = Shared_ring(buffer=commands_buffer), Telemetry_outbox(Shared_ring(buffer=telemetry_buffer))
+
+    if backend is None:
+        backend = Psychopy_backend(units=settings['unit'], fullscreen=settings['fullscreen'], wait_blanking=True)
+    geometry = Monitor_geometry.from_settings(settings)
+
+    # Renderers are given the window as a Tile: it has all they need [pool of stims, compositor, background...]
+    wnd = Tile('render process', geometry, settings)
+    wnd.plays_audio = True
+    wnd.open(backend)
+    screenMs = backend.ms_per_frame(wnd.psypy_window)
+    wnd.stim_pool.prebuild(list(dict.fromkeys([settings['unit'], 'cm', 'deg'])))
+
+    square, square_cols = None, None
+    if settings['square on']:
+        square = backend.create_square(wnd.psypy_window, settings['square width'],
+                                       get_position_in_px(geometry, settings['square pos'], settings['square width']))
+        col = map_color_scale(settings['square default col'])
+        square_cols = {True: [col, col, col], False: [-col, -col, -col]}
+
+    frames_cache = Frames_cache(settings.get('frames_cache_folder', None),
+                                max_memory_items=int(settings.get('frames_cache_memory_items', 32)),
+                                max_disk_mb=int(settings.get('frames_cache_size_mb', 500)))
+    sync_output = Sync_output.from_settings(settings)
+    arming = Arming_thread(frames_cache, screenMs, geometry)
+    arming.start()
+    armed = {}  # stim name -> (params, schedule)
+    segment, frame_number, trigger_ns, last_flip, dropped = None, 0, 0, None, 0
+    ui_bg_luminosity = wnd.bg_luminosity  # set in the GUI, stims can change the background while they are played
+    bg_sent = None  # background luminosity last sent to the GUI
+    telemetry.push(READY, timestamp_ns(), screenMs)
+
+    while True:
+        # Send the telemetry that didn't fit in the ring at the previous frames
+        telemetry.flush()
+
+        # Swap in the stims whose frames have been calculated since the last frame
+        for stim_name, params, schedule, error in arming.get_armed():
+            if error is None:
+                armed[stim_name] = (params, schedule)
+            else:
+                telemetry.push(ERROR, timestamp_ns(), payload='Could not arm {}: {}'.format(
+                    stim_name, error).encode()[:1024])
+
+        # Execute the commands received since the last frame
+        for kind, t_ns, value, payload in commands.pop_all():
+            if kind == ARM:
+                message = json.loads(payload.decode())
+                arming.arm(message['name'], message['params'])
+            elif kind == TRIGGER:
+                stim_name = payload.decode()
+                if segment is not None or stim_name not in armed:
+                    telemetry.push(ERROR, timestamp_ns(), payload='Could not trigger {}'.format(stim_name).encode())
+                    continue
+                params, schedule = armed[stim_name]
+                segment = Stream_segment(stim_name, params, schedule)
+                wnd.compositor.add_layers(segment.layers)
+                frame_number, trigger_ns, dropped = 0, t_ns, 0
+                wnd.stim_timer = time.perf_counter()
+            elif kind == SET_BG:
+                ui_bg_luminosity = value
+                if segment is None:
+                    wnd.bg_luminosity = value
+            elif kind == QUIT:
+                arming.stop()
+                wnd.compositor.clear()
+                if sync_output is not None:
+                    sync_output.close()
+                wnd.psypy_window.close()
+                return
+
+        # Update and draw
+        if segment is not None:
+            wnd.compositor.update(wnd, frame_number)
+        wnd.change_bg_lum()
+        if wnd.bg_luminosity != bg_sent:
+            bg_sent = wnd.bg_luminosity
+            telemetry.push(BG, timestamp_ns(), float(bg_sent))
+        if square is not None:
+            if wnd.frame_state.changed('square color', segment is not None):
+                square.setFillColor(square_cols[segment is not None])
+            square.draw()
+        wnd.compositor.draw()
+        if sync_output is not None and segment is not None:
+            sync_output.on_frame(wnd.psypy_window, frame_number)
+        flip_time = wnd.psypy_window.flip()
+        flip_ns = timestamp_ns()
+
+        # Telemetry
+        if segment is not None:
+            if last_flip is not None and frame_number and flip_time - last_flip > 1.5 * screenMs / 1000:
+                dropped += int(round((flip_time - last_flip) * 1000 / screenMs)) - 1
+            if frame_number == 0:
+                telemetry.push(ONSET, flip_ns, (flip_ns - trigger_ns) / 1e6, segment.name.encode())
+
+            frame_number += 1
+            if frame_number >= segment.n_frames:
+                telemetry.push(END, flip_ns, dropped, segment.name.encode())
+                wnd.compositor.clear()
+                if sync_output is not None:
+                    sync_output.on_next_flip(wnd.psypy_window, OFFSET)  # the next flip clears the stim
+                if Stimuli_calculator.is_random(segment.params):
+                    # A different stimulus each time: get the next one ready
+                    arming.arm(segment.name, segment.params)
+                wnd.bg_luminosity = ui_bg_luminosity
+                segment = None
+        last_flip = flip_time
@@ -0,0 +1,146 @@
+import time
+from Utils.frame_schedules import *
+from Utils.stimuli_calculator import map_color_scale
+
+
+"""
+FUNCTIONS TO DRAW THE STIMULI ON THE PSYCHOPY WINDOW
+
+There is one renderer per type of frame schedule. Each renderer is called once per frame with Main_UI, the layer of
+the compositor playing the stimulus [see Utils/compositor.py] and the frame number: at the first frame it takes a
+psychopy stimulus from the pool [see Utils/stim_pool.py] and configures it with the stim params, then it updates it
+with the values for the current frame. The stimulus object is kept by the layer, which draws it.
+psychopy needs to be imported in the thread that created the window, so it is imported when it is needed.
+"""
+
+
+def acquire_stim(main, layer, kind, units):
+    """ Take a stimulus object from the pool, its properties will be pushed again at the first frame """
+    layer.state.forget('radius', 'pos', 'phase')
+    return main.stim_pool.acquire(kind, units)
+
+
+def configure_grating(stim, size, pos, orientation, color, spatial_frequency):
+    """ Set the params of a grating taken from the pool """
+    stim.size = size
+    stim.pos = pos
+    stim.ori = orientation
+    stim.setColor(color, 'rgb')
+    stim.sf = spatial_frequency
+    stim.phase = 0
+
+
+def render_loom(main, layer, frame_number):
+    schedule = layer.schedule
+    if layer.stim is None:
+        main.stim_timer = time.clock()  # Time lifespan of the stim
+        layer.stim = acquire_stim(main, layer, 'circle', schedule.units)
+        layer.stim.pos = schedule.pos
+        layer.stim.setFillColor(schedule.color, 'rgb255')
+        layer.stim.setLineColor(schedule.color, 'rgb255')
+    radius = schedule.radii[frame_number]
+    if layer.state.changed('radius', radius):
+        layer.stim.radius = radius
+
+
+def render_spot_loom(main, layer, frame_number):
+    schedule = layer.schedule
+    if layer.stim is None:
+        main.stim_timer = time.clock()  # Time lifespan of the stim
+        layer.stim = acquire_stim(main, layer, 'circle', schedule.units)
+        layer.stim.setFillColor('#000000', 'hex')
+        layer.stim.setLineColor('#000000', 'hex')
+    pos, radius = schedule.positions[frame_number], schedule.radii[frame_number]
+    if layer.state.changed('pos', pos):
+        layer.stim.pos = pos
+    if layer.state.changed('radius', radius):
+        layer.stim.radius = radius
+
+
+def render_grating(main, layer, frame_number):
+    schedule = layer.schedule
+    if layer.stim is None:
+        main.stim_timer = time.clock()  # Time lifespan of the stim
+        layer.stim = acquire_stim(main, layer, 'grating', schedule.units)
+        configure_grating(layer.stim, schedule.size, schedule.pos, schedule.orientation, schedule.color,
+                          schedule.spatial_frequency)
+    phase = schedule.phases[frame_number]
+    if layer.state.changed('phase', phase):
+        layer.stim.phase = phase
+
+
+def render_audio(main, layer, frame_number):
+    schedule = layer.schedule
+    if frame_number == 0 and main.plays_audio:
+        from psychopy import sound
+        main.stim_timer = time.clock()  # Time lifespan of the stim
+        try:
+            layer.audio_stim = sound.Sound(schedule.filepath)
+            layer.audio_stim.hamming = False
+            layer.audio_stim.volume = main.settings['Volume']
+            layer.audio_stim.play()
+        except:
+            print('Could not play audio stim {}'.format(schedule.filepath))
+
+
+def render_delay(main, layer, frame_number):
+    pass  # at the moment the code doesn't require any changes when we are producing the delay
+
+
+def render_fearcond(main, layer, frame_number):
+    """ Complex fear conditioning stimulus: blackout, grating [or flashing screen] and ultrasound """
+    schedule = layer.schedule
+    grating_params = schedule.timeline[frame_number]  # one row of the timeline
+
+    if grating_params['blackout_on']:
+        main.bg_luminosity = 0
+    else:
+        main.bg_luminosity = main.settings['default_bg']
+    main.change_bg_lum()
+
+    if grating_params['grating_on']:
+        main.stim_timer = time.clock()  # Time lifespan of the stim
+        if not schedule.flash_screen:
+            if layer.stim is None:
+                # We need to get the stim from the pool
+                from psychopy import core
+                layer.trial_clock = core.Clock()
+                layer.stim = acquire_stim(main, layer, 'grating', schedule.units)
+                configure_grating(layer.stim, schedule.size, schedule.pos, grating_params['grating_orientation'],
+                                  map_color_scale(grating_params['grating_contrast']), schedule.spatial_frequency)
+            else:
+                layer.stim.ori = grating_params['grating_orientation']
+                if grating_params['grating_direction'] < 0:
+                    layer.stim.ori += 180
+
+                layer.stim.color = map_color_scale(grating_params['grating_contrast'])
+                t = layer.trial_clock.getTime()
+                layer.stim.phase = t*schedule.velocity
+        else:
+            main.bg_luminosity = grating_params['blackout_on']
+            main.change_bg_lum()
+
+    else:
+        layer.release_stim(main.stim_pool)
+
+    if grating_params['ultrasound_on'] and main.plays_audio:
+        if layer.audio_stim is None:
+            from psychopy import sound
+            layer.audio_stim = sound.Sound(schedule.audiostim)
+            layer.audio_stim.volume = main.settings['Volume']
+            layer.audio_stim.play()
+
+
+RENDERERS = {Loom_schedule: render_loom,
+             Spot_loom_schedule: render_spot_loom,
+             Grating_schedule: render_grating,
+             Audio_schedule: render_audio,
+             Delay_schedule: render_delay,
+             Fearcond_schedule: render_fearcond}
+
+
+def resolve_renderer(schedule):
+    """ Find the renderer for a schedule once, before the stimulus is played """
+    if schedule.renderer is None:
+        schedule.renderer = RENDERERS[type(schedule)]
+    return schedule.renderer
@@ -0,0 +1,235 @@
+import queue
+import struct
+import threading
+import numpy as np
+
+from Utils.latency_benchmark import timestamp_ns
+from Utils.arduino_reader import Arduino_event, RISING, FALLING
+
+
+"""
+FRAMED SERIAL PROTOCOL
+
+Binary protocol to exchange commands and events with the arduino without losing or misreading bytes. Each frame is:
+    0xAA 0x55 | kind [1 byte] | sequence number [2 bytes] | payload length [1 byte] | payload | checksum [1 byte]
+with little endian numbers and the checksum being the sum of kind, sequence number, length and payload bytes modulo 256.
+    * COMMAND: host -> arduino, e.g. the command that used to be sent as text. The arduino replies with an ACK with
+      the same sequence number
+    * ACK: arduino -> host, acknowledges the command with the same sequence number
+    * EVENT: arduino -> host, the level of an input changed [payload: level, 1 byte, and the arduino micros(), 4 bytes]
+Bytes that don't make a valid frame are skipped until the start of the next frame, frames with a valid checksum but
+a payload that doesn't fit their kind [e.g. an EVENT that is too short] are counted as bad frames and ignored.
+
+Serial_link sends and receives the frames with two threads: the commands are put in a queue [send() never blocks] and
+written by a writer thread, everything received is read by a reader thread that never flushes the port. The time at
+which each ACK arrives is recorded, so the round trip time of the commands can be measured. Events are turned into
+Arduino_event, like the ones of Arduino_reader, so Main_UI handles them in the same way.
+See Utils/fake_arduino.py for an arduino that runs on a pseudo terminal, for tests.
+"""
+
+
+SYNC = b'\xaa\x55'
+HEADER = struct.Struct('<BHB')  # kind, sequence number, payload length
+EVENT_PAYLOAD = struct.Struct('<BI')  # level, arduino micros()
+MAX_PAYLOAD = 255
+
+COMMAND, ACK, EVENT = 1, 2, 3
+
+
+def checksum(data):
+    return sum(data) & 0xFF
+
+
+def encode_frame(kind, seq, payload=b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError('Payload of {} bytes is too big, max {}'.format(len(payload), MAX_PAYLOAD))
+    body = HEADER.pack(kind, seq & 0xFFFF, len(payload)) + payload
+    return SYNC + body + bytes([checksum(body)])
+
+
+class Frame_parser():
+    def __init__(self):
+        """ Turns the bytes received, in chunks of any size, into frames """
+        self.buffer = bytearray()
+        self.bad_bytes = 0  # bytes skipped because they weren't part of a valid frame
+
+    def feed(self, data):
+        """ Add the bytes received, returns the list of complete frames as (kind, seq, payload) """
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                # keep the last byte, it might be the first byte of SYNC
+                keep = 1 if self.buffer[-1:] == SYNC[:1] else 0
+                self.bad_bytes += len(self.buffer) - keep
+                del self.buffer[:len(self.buffer) - keep]
+                return frames
+            if start:
+                self.bad_bytes += start
+                del self.buffer[:start]
+
+            if len(self.buffer) < len(SYNC) + HEADER.size:
+                return frames
+            kind, seq, length = HEADER.unpack_from(self.buffer, len(SYNC))
+            end = len(SYNC) + HEADER.size + length
+            if len(self.buffer) < end + 1:
+                return frames
+
+            body = bytes(self.buffer[len(SYNC):end])
+            if checksum(body) == self.buffer[end]:
+                frames.append((kind, seq, body[HEADER.size:]))
+                del self.buffer[:end + 1]
+            else:
+                # not a frame [or a corrupted one]: look for the next SYNC
+                self.bad_bytes += 1
+                del self.buffer[:1]
+
+
+class Serial_link():
+    def __init__(self, ser, n_round_trips=10000, ack_timeout=1.0, read_timeout=0.5):
+        """
+        :param ser: open serial.Serial [or anything with read, write, in_waiting and timeout]
+        :param n_round_trips: number of round trip times kept for the summary
+        :param ack_timeout: commands not acknowledged after this long [s] are counted as lost
+        :param read_timeout: max time [s] a read waits for data, only used to check if the link has been stopped
+        """
+        self.ser = ser
+        self.ser.timeout = read_timeout
+        self.ack_timeout_ns = int(ack_timeout * 1e9)
+
+        self.send_queue = queue.Queue()
+        self.events = queue.Queue()  # Arduino_event received, unbounded: events are never dropped
+        self.parser = Frame_parser()
+
+        self.seq = 0  # sequence number of the next command
+        self.pending = {}  # sequence number -> time at which the command was written [ns]
+        self.pending_lock = threading.Lock()
+        self.round_trips = np.zeros(n_round_trips, dtype=np.int64)  # ns
+        self.n_acks, self.commands_lost, self.events_lost = 0, 0, 0
+        self.bad_frames = 0  # frames with a payload that doesn't fit their kind
+        self.last_event_seq = None
+
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+
+    def start(self):
+        self.writer.start()
+        self.reader.start()
+
+    def stop(self, timeout=1):
+        self.stopped.set()
+        self.send_queue.put(None)  # wake up the writer
+        self.writer.join(timeout)
+        self.reader.join(timeout)
+
+    ####################################################################################################################
+    """    SENDING   """
+    ####################################################################################################################
+
+    def send(self, payload, kind=COMMAND):
+        """ Queue a frame to be sent, returns its sequence number [it doesn't wait for the frame to be written] """
+        with self.pending_lock:
+            seq = self.seq
+            self.seq = (self.seq + 1) & 0xFFFF
+        self.send_queue.put((kind, seq, payload))
+        return seq
+
+    def send_command(self, command):
+        if isinstance(command, str):
+            command = command.encode()
+        return self.send(command)
+
+    def write_loop(self):
+        while not self.stopped.is_set():
+            item = self.send_queue.get()
+            if item is None:
+                continue
+            kind, seq, payload = item
+            frame = encode_frame(kind, seq, payload)
+            if kind == COMMAND:
+                # before writing: the ACK might arrive before write() returns
+                with self.pending_lock:
+                    self.pending[seq] = timestamp_ns()
+            try:
+                self.ser.write(frame)
+            except Exception as e:
+                print('Could not write to arduino: {}'.format(e))
+
+    ####################################################################################################################
+    """    RECEIVING   """
+    ####################################################################################################################
+
+    def read_loop(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))  # blocks until at least one byte arrives
+            except Exception as e:
+                print('Stopped reading from arduino: {}'.format(e))
+                return
+            t_ns = timestamp_ns()
+            if data:
+                for kind, seq, payload in self.parser.feed(data):
+                    self.handle_frame(kind, seq, payload, t_ns)
+            self.check_lost_commands(t_ns)
+
+    def handle_frame(self, kind, seq, payload, t_ns):
+        if kind == ACK:
+            with self.pending_lock:
+                sent_ns = self.pending.pop(seq, None)
+            if sent_ns is not None:
+                self.round_trips[self.n_acks % len(self.round_trips)] = t_ns - sent_ns
+                self.n_acks += 1
+
+        elif kind == EVENT:
+            if len(payload) < EVENT_PAYLOAD.size:
+                self.bad_frames += 1
+                return
+            if self.last_event_seq is not None:
+                self.events_lost += (seq - self.last_event_seq - 1) & 0xFFFF
+            self.last_event_seq = seq
+            level, device_us = EVENT_PAYLOAD.unpack(payload[:EVENT_PAYLOAD.size])
+            self.events.put(Arduino_event(RISING if level else FALLING, level, t_ns))
+
+        else:
+            self.bad_frames += 1
+
+    def check_lost_commands(self, t_ns):
+        with self.pending_lock:
+            if not self.pending:
+                return
+            lost = [seq for seq, sent_ns in self.pending.items() if t_ns - sent_ns > self.ack_timeout_ns]
+            for seq in lost:
+                del self.pending[seq]
+        self.commands_lost += len(lost)
+
+    def get_events(self):
+        """ All the events received since the last call, oldest first [it doesn't wait] """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    ####################################################################################################################
+    """    ROUND TRIP TIMES   """
+    ####################################################################################################################
+
+    def round_trip_summary(self):
+        """ Time between a command being written and its ACK arriving [ms] """
+        rtt = self.round_trips[:min(self.n_acks, len(self.round_trips))] / 1e6
+        if not len(rtt):
+            return {}
+        return dict(acks=int(self.n_acks), median=float(np.median(rtt)), p95=float(np.percentile(rtt, 95)),
+                    max=float(np.max(rtt)), commands_lost=int(self.commands_lost), events_lost=int(self.events_lost),
+                    bad_bytes=int(self.parser.bad_bytes), bad_frames=int(self.bad_frames))
+
+    def print_round_trip_summary(self):
+        summary = self.round_trip_summary()
+        if summary:
+            print('     ... arduino: {} commands acknowledged, round trip median {:.3f} ms, 95% {:.3f} ms, max {:.3f} ms'
+                  ', {} commands and {} events lost, {} bad bytes, {} bad frames'.format(
+                      summary['acks'], summary['median'], summary['p95'], summary['max'], summary['commands_lost'],
+                      summary['events_lost'], summary['bad_bytes'], summary['bad_frames']))
@@ -0,0 +1,83 @@
+import ctypes
+import multiprocessing
+import numpy as np
+
+
+"""
+LOCK-FREE RING BUFFER IN SHARED MEMORY
+
+Used to exchange messages between the GUI process and the render process [see Utils/render_process.py]. Messages
+are fixed size records written in a circular buffer of shared memory. There is one writer and one reader per ring:
+the writer only moves the head and the reader only moves the tail, so neither ever waits for the other and no lock is
+shared between the processes. A record is written before the head is moved past it, so the reader never sees a record
+that is half written. If the ring is full the message is dropped and push returns False.
+"""
+
+
+# Byte offsets of the head and tail counters, on different cache lines
+HEAD_OFFSET, TAIL_OFFSET, HEADER_SIZE = 0, 64, 128
+
+# Max size of the payload of a message [e.g. the params of a stim as JSON]
+PAYLOAD_SIZE = 4096
+
+RECORD_DTYPE = np.dtype([('kind', np.uint8),
+                         ('t_ns', np.int64),        # timestamp [perf_counter_ns of the process that wrote it]
+                         ('value', np.float64),     # e.g. background luminosity, ms per frame
+                         ('size', np.uint16),       # size of the payload in bytes
+                         ('payload', np.uint8, (PAYLOAD_SIZE, ))], align=True)
+
+
+class Shared_ring():
+    def __init__(self, capacity=256, buffer=None):
+        """
+        :param capacity: number of messages the ring can hold
+        :param buffer: shared memory of an existing ring [in the other process], if None a new one is created
+        """
+        if buffer is None:
+            buffer = multiprocessing.RawArray(ctypes.c_uint8, HEADER_SIZE + capacity * RECORD_DTYPE.itemsize)
+        self.buffer = buffer  # pass this to the other process
+        self.capacity = (len(buffer) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+
+        self.head = np.frombuffer(buffer, dtype=np.uint64, count=1, offset=HEAD_OFFSET)
+        self.tail = np.frombuffer(buffer, dtype=np.uint64, count=1, offset=TAIL_OFFSET)
+        self.records = np.frombuffer(buffer, dtype=RECORD_DTYPE, count=self.capacity, offset=HEADER_SIZE)
+
+    def __len__(self):
+        return int(self.head[0] - self.tail[0])
+
+    def push(self, kind, t_ns=0, value=0.0, payload=b''):
+        """ Write a message, returns False if the ring is full [only one process/thread should write] """
+        head = int(self.head[0])
+        if head - int(self.tail[0]) >= self.capacity:
+            return False
+        if len(payload) > PAYLOAD_SIZE:
+            raise ValueError('Payload of {} bytes is too big, max {}'.format(len(payload), PAYLOAD_SIZE))
+
+        record = self.records[head % self.capacity]
+        record['kind'] = kind
+        record['t_ns'] = t_ns
+        record['value'] = value
+        record['size'] = len(payload)
+        record['payload'][:len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+        self.head[0] = head + 1  # publish the record
+        return True
+
+    def pop(self):
+        """ Read the oldest message as (kind, t_ns, value, payload), None if there are none [only one reader] """
+        tail = int(self.tail[0])
+        if tail == int(self.head[0]):
+            return None
+
+        record = self.records[tail % self.capacity]
+        message = (int(record['kind']), int(record['t_ns']), float(record['value']),
+                   record['payload'][:int(record['size'])].tobytes())
+        self.tail[0] = tail + 1  # free the slot
+        return message
+
+    def pop_all(self):
+        messages = []
+        message = self.pop()
+        while message is not None:
+            messages.append(message)
+            message = self.pop()
+        return messages
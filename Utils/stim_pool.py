@@ -0,0 +1,74 @@
+"""
+POOL OF PSYCHOPY STIMULUS OBJECTS
+
+Creating a psychopy stimulus sets up its vertices and textures on the graphics card. If that is done when a stimulus
+is launched, it happens on the onset frame, the one that matters the most. Instead the stimulus objects are created
+once, when the window starts, and each time a stimulus is played one of them is taken from the pool and reconfigured
+in place with the stim params [see Utils/renderers.py]. When the stimulus is done the object goes back to the pool.
+psychopy needs to be imported in the thread that created the window, so the pool must be used from that thread.
+"""
+
+
+class Stim_pool():
+    # Type of psychopy stimulus object used by each kind of stimulus
+    KINDS = ('circle', 'grating', 'circle_array')
+
+    # Number of elements of a circle_array, the max number of circles drawn with a single draw call
+    BATCH_SIZE = 32
+
+    def __init__(self, window):
+        """
+        :param window: psychopy window the stimuli are drawn on
+        """
+        self.window = window
+        self.free = {}  # (kind, units) -> list of stimulus objects ready to be used
+        self.in_use = {}  # id of the stimulus object -> (kind, units)
+
+    def build(self, kind, units):
+        """ Create a new stimulus object, all its params are set when it is acquired """
+        from psychopy import visual
+        if kind == 'circle':
+            return visual.Circle(self.window, radius=1, edges=64, units=units)
+        elif kind == 'grating':
+            return visual.GratingStim(win=self.window, units=units, interpolate=True)
+        elif kind == 'circle_array':
+            # Several circles drawn with one call, the elements that are not used are fully transparent
+            return visual.ElementArrayStim(self.window, units=units, nElements=self.BATCH_SIZE, elementTex=None,
+                                           elementMask='circle', colorSpace='rgb255', sizes=1,
+                                           opacities=0, interpolate=True)
+        else:
+            raise ValueError('Unrecognised kind of stimulus: {}'.format(kind))
+
+    def prebuild(self, units, n_per_kind=1):
+        """
+        Create the stimulus objects before any stimulus is played and draw them once [fully transparent] so that
+        everything psychopy needs for them is already on the graphics card
+
+        :param units: list of unit systems the stimuli can be in [e.g. 'cm', 'deg']
+        :param n_per_kind: number of objects to create for each kind of stimulus and unit system
+        """
+        for unit in units:
+            for kind in self.KINDS:
+                stims = self.free.setdefault((kind, unit), [])
+                while len(stims) < n_per_kind:
+                    stim = self.build(kind, unit)
+                    stim.opacity = 0
+                    stim.draw()
+                    stim.opacity = 1
+                    stims.append(stim)
+
+    def acquire(self, kind, units):
+        """ Get a stimulus object from the pool, a new one is only created if all the objects are in use """
+        stims = self.free.get((kind, units), None)
+        if stims:
+            stim = stims.pop()
+        else:
+            stim = self.build(kind, units)
+        self.in_use[id(stim)] = (kind, units)
+        return stim
+
+    def release(self, stim):
+        """ Put a stimulus object back in the pool """
+        key = self.in_use.pop(id(stim), None)
+        if key is not None:
+            self.free.setdefault(key, []).append(stim)
@@ -0,0 +1,123 @@
+import numpy as np
+
+
+"""
+PLAYLISTS OF STIMULI
+
+The stims to play are compiled into a playlist when they are launched: an ordered list of segments [one per stim or
+delay] with the frame at which each segment starts, relative to the start of the playlist. The render loop pulls the
+segments one after the other and the state of each stimulus one frame at a time, so moving on to the next stim is
+just moving to the next item in a list, whatever the number of stims queued.
+The frame schedules of the stims are calculated in the background when they are loaded [see App_control.arm_stim],
+and the stims that aren't armed when they are launched are calculated in the background before the trigger is queued
+[see App_control.queue_trigger], so compiling a playlist in the render loop is just a matter of looking them up.
+"""
+
+
+class Stream_segment():
+    def __init__(self, name, params, schedule, z=0):
+        """
+        One stimulus in a playlist
+
+        :param name: name of the stimulus [e.g. name of the YAML or wav file]
+        :param params: stim params
+        :param schedule: frame schedule calculated by Stimuli_calculator for the stimulus
+        :param z: z order of the stimulus when it is played with others [see Layered_segment]
+        """
+        self.name = name
+        self.params = params
+        self.schedule = schedule
+        self.n_frames = schedule.n_frames
+        self.layers = [(self, z)]  # what the compositor plays for this segment
+
+    def __len__(self):
+        return self.n_frames
+
+    def __iter__(self):
+        return iter(self.schedule)
+
+
+class Layered_segment():
+    def __init__(self, name, segments):
+        """
+        Several stimuli played at the same time, each one is a layer of the compositor [see Utils/compositor.py]
+
+        :param name: name of the segment
+        :param segments: list of (Stream_segment, z order)
+        """
+        self.name = name
+        self.params = {seg.name: seg.params for seg, z in segments}
+        self.layers = list(segments)
+        self.n_frames = max([seg.n_frames for seg, z in segments]) if segments else 0
+
+    def __len__(self):
+        return self.n_frames
+
+
+class Playlist():
+    def __init__(self, segments):
+        """
+        Ordered list of Stream_segment, iterating over it returns the segments in order
+
+        :param segments: list of Stream_segment in the order in which they are played
+        """
+        self.segments = list(segments)
+
+        # offsets[i] is the frame at which segment i starts, offsets[-1] the total number of frames
+        self.offsets = np.zeros(len(self.segments) + 1, dtype=np.int64)
+        np.cumsum([seg.n_frames for seg in self.segments], out=self.offsets[1:])
+
+        self.position = 0  # index of the next segment to play
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.segments):
+            raise StopIteration
+        segment = self.segments[self.position]
+        self.position += 1
+        return segment
+
+    @property
+    def n_frames(self):
+        return int(self.offsets[-1])
+
+    def segment_at(self, frame_number):
+        """ Index of the segment being played at a given frame since the start of the playlist """
+        if frame_number < 0 or frame_number >= self.n_frames:
+            raise IndexError('Frame number {} out of range'.format(frame_number))
+        return int(np.searchsorted(self.offsets, frame_number, side='right')) - 1
+
+    def describe(self, screenMs):
+        """ Print the content of the playlist """
+        print('\n     ... playlist with {} segments, {} frames [{} s]'.format(len(self), self.n_frames,
+                                                                        round(self.n_frames * screenMs / 1000, 2)))
+        for idx, seg in enumerate(self.segments):
+            print('     ... [{:>3}] frame {:>7} - {} ({} frames)'.format(idx, self.offsets[idx], seg.name,
+                                                                       seg.n_frames))
+
+
+def compile_playlist(stims_names, prepare_stim, get_schedule, delay=0):
+    """
+    Compile a list of stimuli into a Playlist
+
+    :param stims_names: list of names of the stimuli to play, in order
+    :param prepare_stim: function that given a stim name returns its params and frame schedule
+    :param get_schedule: function that given stim params returns the frame schedule, used for the delays
+    :param delay: delay between stimuli in ms, if > 0 a delay segment is added after each stimulus
+    """
+    if delay:
+        delay_params = dict(type='delay', duration=delay)
+        delay_schedule = get_schedule(delay_params)  # the same for all the delays
+
+    segments = []
+    for name in stims_names:
+        params, schedule = prepare_stim(name)
+        segments.append(Stream_segment(name, params, schedule))
+        if delay:
+            segments.append(Stream_segment('delay', delay_params, delay_schedule))
+    return Playlist(segments)
@@ -0,0 +1,536 @@
+import os
+import math
+import random
+import yaml
+import numpy as np
+
+from Utils.frame_schedules import *
+
+
+"""
+HEADLESS FRAME ENGINE: everything needed to compute the frames of a stimulus without a psychopy window.
+Nothing in here imports psychopy or Qt, so frames can be computed in worker threads/processes or ahead of time.
+"""
+
+
+####################################################################################################################
+####################################################################################################################
+"""    MONITOR GEOMETRY   """
+####################################################################################################################
+####################################################################################################################
+
+
+class Monitor_geometry():
+    # psychopy converts degrees to cm with a small angle approximation, using this factor instead of pi/180
+    deg_to_cm_factor = 0.017455
+
+    def __init__(self, name, size_pix, width, distance, screen_number=0):
+        """
+        Plain description of the monitor on which the stimuli are displayed. Holds the same information that psychopy's
+        Monitor object gets from the Screens/*.yml files and is all we need to convert between units.
+
+        :param name: name of the monitor
+        :param size_pix: (width, height) of the monitor in px
+        :param width: width of the monitor in cm
+        :param distance: distance of the mouse from the monitor in cm
+        :param screen_number: screen number on the computer
+        """
+        self.name = name
+        self.size_pix = (int(size_pix[0]), int(size_pix[1]))
+        self.width = width
+        self.distance = distance
+        self.screen_number = screen_number
+
+    def __repr__(self):
+        return 'Monitor_geometry({}, {}px, {}cm wide, {}cm away)'.format(self.name, self.size_pix, self.width,
+                                                                       self.distance)
+
+    @classmethod
+    def from_screen_params(cls, screen_params):
+        """ Create the geometry from the content of a Screens/*.yml file """
+        size = screen_params['PxSize']
+        try:
+            size = (int(size.split(', ')[0]), int(size.split(', ')[1]))
+        except:
+            size = (int(size.split(',')[0]), int(size.split(',')[1]))
+        return cls(screen_params['Name'], size, int(screen_params['Width']), int(screen_params['Distance']),
+                   screen_params['Screen number'])
+
+    @classmethod
+    def from_settings(cls, settings, screens_folder=os.path.join('.', 'Screens')):
+        """ Find the Screens/*.yml file matching the monitor name in GUI_cfg.yml and load the geometry from it """
+        filename = settings['Name']
+        setupfile = None
+        for f in os.listdir(screens_folder):
+            if filename == f.split('.')[0]:
+                setupfile = f
+                break
+        if setupfile is None:
+            raise FileNotFoundError("Could not find monitor file with name matching: {}".format(settings['Name']))
+
+        with open(os.path.join(screens_folder, setupfile), 'r') as f:
+            screen_params = yaml.load(f, Loader=yaml.FullLoader)
+        return cls.from_screen_params(screen_params)
+
+    @classmethod
+    def from_window(cls, wnd):
+        """ Read the geometry from the monitor of an existing psychopy window """
+        return cls(wnd.monitor.name, wnd.monitor.getSizePix(), wnd.monitor.getWidth(), wnd.monitor.getDistance())
+
+    @property
+    def cm_per_px(self):
+        return self.width / self.size_pix[0]
+
+    def cm2pix(self, cm):
+        # Same order of operations as psychopy.tools.monitorunittools.cm2pix
+        return np.asarray(cm) * self.size_pix[0] / float(self.width)
+
+    def deg2cm(self, degrees):
+        # Same as psychopy.tools.monitorunittools.deg2cm without flat screen correction
+        return np.asarray(degrees) * self.distance * self.deg_to_cm_factor
+
+    def deg2pix(self, degrees):
+        return self.cm2pix(self.deg2cm(degrees))
+
+    def convert(self, data, in_unit='cm', out_unit='px'):
+        """
+        Map between different units for psychopy. Most commonly used to convert a measure from pixels to degrees.
+        Works on scalars as well as on numpy arrays, so whole frame arrays can be converted in one go
+        """
+        out = 0
+        if in_unit == 'cm':
+            if out_unit == 'px':
+                out = self.cm2pix(data)
+            if out_unit == 'deg' or out_unit == 'degs':
+                conv_fact = self.deg2pix(1)*self.cm_per_px
+                out = data*(1/conv_fact)
+        if in_unit == 'deg' or in_unit == 'degs':
+            if out_unit == 'px':
+                out = self.deg2pix(data)
+            else:  # out cm
+                out = self.deg2pix(data)
+                out *= self.cm_per_px
+        if in_unit == 'px' or in_unit == 'pix':
+            if out_unit == 'deg' or out_unit == 'degs':
+                px_per_deg = self.deg2pix(1)
+                out = data / px_per_deg
+            else:  # out in cm
+                out = data * self.cm_per_px
+        return out
+
+    def get_position_in_px(self, location, square_side, return_scree_size=False):
+        """
+        In psychopy the centre of the window is pos 0,0. For us is more convenient if the top left corner is 0, 0
+        so we need to map from our coordinate space to psychopys one
+
+        :param location: which corner of the screen are we interested in
+        :param square_side: side of the square to place in the corner, in cm
+        """
+        screen_size_px = self.size_pix
+        screen_width_cm = self.width
+        half_width_cm = screen_width_cm/2
+
+        screen_height_cm = (screen_width_cm/screen_size_px[0])*screen_size_px[1]
+        half_height_cm = screen_height_cm/2
+
+        half_side_cm = int(square_side/2)
+
+        x_translate, y_translate = -half_width_cm+half_side_cm, half_height_cm-half_side_cm
+
+        # Go from our mapping to psychopy location
+        if location == 'top left':
+            mappedloc = (x_translate, y_translate)
+        elif location == 'top right':
+            mappedloc = (-x_translate, y_translate)
+        elif location == 'bottom right':
+            mappedloc = (-x_translate, -y_translate)
+        else:  # location == 'bottom left'
+            mappedloc = (x_translate, -y_translate)
+
+        if not return_scree_size:
+            return int(mappedloc[0]), int(mappedloc[1])
+        else:
+            return int(mappedloc[0]), int(mappedloc[1]), screen_width_cm, screen_height_cm
+
+
+def as_monitor_geometry(monitor):
+    """ Accept either a Monitor_geometry or a psychopy window and return the geometry """
+    if isinstance(monitor, Monitor_geometry):
+        return monitor
+    return Monitor_geometry.from_window(monitor)
+
+
+def unit_converter(monitor, data, in_unit='cm', out_unit='px'):
+    """
+    Map between different units for psychopy. Most commonly used to convert a measure from pixels to degrees
+    :param monitor: Monitor_geometry or psychopy window
+    """
+    return as_monitor_geometry(monitor).convert(data, in_unit=in_unit, out_unit=out_unit)
+
+
+def get_position_in_px(monitor, location, square_side, return_scree_size=False):
+    """
+    Get the psychopy coordinates of a corner of the screen
+    :param monitor: Monitor_geometry or psychopy window
+    """
+    return as_monitor_geometry(monitor).get_position_in_px(location, square_side, return_scree_size=return_scree_size)
+
+
+def map_color_scale(value, leftMin=0, leftMax=255, rightMin=-1, rightMax=1, reversed=False):
+    """
+    Psychopy colora work on a scale that ranges from -1 to 1
+    The UI allows user to imput colors in a range from 0 to 255
+    This functions maps the values from the user input to the psychopy scale
+    """
+    if reversed:
+        # Mapping from PsychoPy colors to 255 RBG values
+        leftMin, leftMax, rightMin, rightMax = -1, 1, 0, 255
+
+    # Figure out how 'wide' each range is
+    leftSpan = leftMax - leftMin
+    rightSpan = rightMax - rightMin
+
+    # Convert the left range into a 0-1 range (float)
+    valueScaled = float(value - leftMin) / float(leftSpan)
+
+    # Convert the 0-1 range into a value in the right range.
+    return rightMin + (valueScaled * rightSpan)
+
+
+####################################################################################################################
+####################################################################################################################
+"""    STIMULI CALCULATOR   """
+####################################################################################################################
+####################################################################################################################
+
+# Columns of the timeline of a fear conditioning complex stimulus, one row per frame
+FEARCOND_TIMELINE_DTYPE = np.dtype([('blackout_on', np.uint8),             # 1 during blackout, 0-255 when flashing
+                                    ('grating_on', np.bool_),
+                                    ('grating_orientation', np.float32),
+                                    ('grating_contrast', np.float32),
+                                    ('grating_direction', np.float32),
+                                    ('ultrasound_on', np.bool_)])
+
+
+class Stimuli_calculator():
+    def __init__(self, monitor, params, screenMs):
+        """
+            Gets called by UI_app Main() when a stimulus needs to be generated and calls the right subfuction to calculate
+            the stimulus parameters
+
+            :param monitor: Monitor_geometry describing the screen [a psychopy window is also accepted]
+            :param params:  stimulus parameters, dict. Loaded from YAML file
+            :param screenMs:  ms per screeen refresch
+            :return: the frame schedule of the stimulus is stored in self.schedule [see Utils/frame_schedules.py]
+            """
+        self.schedule = None  # Initialise variable to avoid problems
+        monitor = as_monitor_geometry(monitor)
+
+        # Call subfunctions to generate the stimulus
+        if 'loom' == params['type'].lower():
+            self.schedule = self.loomer(monitor, params, screenMs)
+        elif 'grating' in params['type'].lower():
+            self.schedule = self.grater(monitor, params, screenMs)
+        elif 'audio' in params['type'].lower():
+            self.schedule = self.audio_generator(monitor, params, screenMs)
+        elif 'delay' in params['type'].lower():
+            self.schedule = self.delayer(monitor, params, screenMs)
+        elif 'fearcond_copmlex' in params['type'].lower():
+            # Define which aspects of the
+            self.schedule = self.complex_fearcon_stim(monitor, params, screenMs, blackout=True, grating=True,
+                                                            ultrasound=True, overlap=True)
+        elif 'spot_loom' == params['type'].lower():
+            self.schedule = self.spot_to_loomer(monitor, params, screenMs)
+
+    @staticmethod
+    def is_random(params):
+        """ Returns True if the frames change every time they are calculated for the same params [e.g. gratings with
+        a random duration], in which case they can't be reused """
+        if 'grating' in params['type'].lower() and 'duration' in params.keys():
+            duration = str(params['duration']).split(',')
+            return len(duration) > 1 and int(duration[1]) != 0
+        return False
+
+    def loomer(self, monitor, params, screenMs):
+        """
+        Calculates the position of the loom, for how many screen frames it will stay on and what the radius will be
+        at each frame
+        :param monitor:  Monitor_geometry
+        :param params:   stim params [from YAML file]
+        :param screenMs:  Ms for each screen refresh
+        :return: Loom_schedule with the position of the centre of the loom and the radii steps
+        """
+        # get position of centre of loom. The user selects it in pixels so we need to convert it to whatver the
+        # unit that is being used for the loom
+        pos = int(params['pos'].split(', ')[0]), int(params['pos'].split(', ')[1])
+        unit = params['units']
+        pos = monitor.convert(pos[0], in_unit='px', out_unit=unit), monitor.convert(pos[1], in_unit='px', out_unit=unit)
+
+        # Prepare radii steps
+        if params['modality'] == 'linear':
+            numExpSteps = int(np.round(int(params['expand_time']) / screenMs))
+
+            # calculate loom radii during expansioin phase
+            radii = np.linspace(float(params['start_size']),
+                                float(params['end_size']), numExpSteps)
+
+        elif params['modality'] == 'exponential':
+            radii = self.exponential_expansion(monitor, params, screenMs)
+
+        else:
+            raise Warning('Couldnt compute loom parameters')
+
+        # Add on time, off time and repeats
+        radii = self.repeat_loom(radii, params, screenMs)
+
+        return Loom_schedule(pos, radii, params['start_size'], params.get('color', 0), unit)
+
+    def exponential_expansion(self, monitor, params, screenMs):
+        """
+        Radii of an exponential loom [constant L/V: an object of half size L approaching at speed V] during the expansion.
+        The radius at time t before collision is distance * (L/V) / |t|, calculated at each screen refresh until it
+        reaches the user selected max radius.
+        :return: radii at each frame, in the stimulus units
+        """
+        # Get the parameters to calculate the loom expansion steps
+        speed = int(params['LV speed'])/1000  # L/V in seconds
+        if params['units'] == 'degs' or params['units'] == 'deg':
+            start_size = float(params['start_size'])
+        elif params['units'] == 'cm':
+            start_size = monitor.convert(float(params['start_size']), in_unit='cm', out_unit='deg')
+        else:
+            raise Warning('Exponential looms can only be defined in deg or cm')
+        tangent = math.tan(math.radians(float(start_size)/2))
+
+        # Calc expansions steps  [based on Matlab code for exponential looms]
+        time_to_collision = round(float(100*speed/tangent),2)/100  # time to collision IN SECONDS
+        frame_duration = screenMs/1000
+        num_steps = max(int(np.ceil(time_to_collision/frame_duration)), 1)
+        time_array = -time_to_collision + np.arange(num_steps)*frame_duration  # all < 0, collision is never reached
+
+        radii = speed/np.abs(time_array) * monitor.distance  # Radii in cm
+
+        # Convert all the radii in degres in one go if the stim is being defined in degrees
+        if params['units'] == 'deg' or params['units'] == 'degs':
+            radii = monitor.convert(radii, in_unit='cm', out_unit='deg')
+
+        # The expansion ends when the radius reaches the user selected max value
+        max_radius = float(params['max radius'])
+        end = np.searchsorted(radii, max_radius)
+        radii = radii[:end+1]
+        radii[radii > max_radius] = max_radius
+        return radii
+
+    def repeat_loom(self, radii, params, screenMs):
+        """
+        Keep the loom at its final size for on_time ms, then add off_time ms with no loom and repeat the whole thing
+        'repeats' times.
+        :param radii: radii during the expansion phase
+        """
+        numOnSteps = int(np.round(int(params.get('on_time', 0)) / screenMs))
+
+        # keep the radius constant during on time
+        last_radius = radii[-1]
+        on_radii = np.repeat(last_radius, numOnSteps)
+
+        # put everything together
+        radii = np.append(radii, on_radii)
+
+        # Repeat the stimulus N times
+        if int(params.get('repeats', 1)) > 0:
+            # Add  inter stimuli interval
+            isi = int(params.get('off_time', 0))
+            if isi > 0:
+                numOffSteps = int(np.round(isi / screenMs))
+                off_radii = np.zeros(numOffSteps)
+                radii = np.append(radii, off_radii)
+            radii = np.tile(radii, int(params.get('repeats', 1)))
+        return radii
+
+
+    def spot_to_loomer(self, monitor, params, screenMs):
+        """
+            This function calculates the frames for a spot to loom stimulus in which a spot appears on the screen, moves towards the center and turns into a loom.
+            In practice this is just a psychopy circle whose position and size changes over the course of the stimulus.
+        """
+        # Convert spot start and end positions from user defined pixel values to cm
+        positions = []
+        for param_name in ['initial_pos', 'end_pos']:
+            pos = int(params[param_name].split(', ')[0]), int(params[param_name].split(', ')[1])
+            unit = params['units']
+            pos = monitor.convert(pos[0], in_unit='px', out_unit=unit), monitor.convert(pos[1], in_unit='px', out_unit=unit)
+            positions.append(pos)
+        positions = tuple(positions)
+
+        # get total duration of the stimulus in number of frames
+        tot_duration = int(params['duration']) + int(params['expand_time']) + int(params['on_time'])
+        tot_steps = int(np.round(tot_duration / screenMs))
+        spot_steps = int(np.round(int(params['duration']) / screenMs))
+        loom_expansion_steps = int(np.round(int(params['expand_time']) / screenMs))
+
+        frames = np.zeros((3, tot_steps))   # 2d array with x,y position and size of the circle at each frame -> to be filled in
+
+        # define position of circle at all frames
+        x_spot_position = np.linspace(positions[0][0], positions[1][0], spot_steps)
+        y_spot_position = np.linspace(positions[0][1], positions[1][1], spot_steps)
+
+
+        frames[0, :spot_steps] = x_spot_position
+        frames[0, spot_steps:] = positions[1][0]  # the spot remains in place when it turns into a loom
+        frames[1, :spot_steps] = y_spot_position
+        frames[1, spot_steps:] = positions[1][1]
+
+        # define the size at each frame
+        frames[2, :spot_steps] = int(params['size']) # constant
+        frames[2, spot_steps:spot_steps+loom_expansion_steps] = np.linspace(int(params['size']), int(params['end_size']), loom_expansion_steps) # expands
+        frames[2, spot_steps+loom_expansion_steps:] =  int(params['end_size']) # constant
+
+        return Spot_loom_schedule(frames[:2].T, frames[2], params['units'])
+
+    def grater(self, monitor, params, screenMs):
+        """
+        Calculates the data for generating a grating stimulus given some params
+        same input as loomer
+        """
+        dur = int(params['duration'].split(',')[0])
+        dur_range = int(params['duration'].split(',')[1])
+        if dur_range:
+            dur = random.randint(dur-dur_range, dur+dur_range+1)
+        numExpSteps = int(np.round(dur / screenMs))
+        x, y, width, height = monitor.get_position_in_px('top left', 0, return_scree_size=True)
+        if params['units'] == 'cm':
+            pos = (0, 0)
+            screen_size = (width, width)
+        else:
+            pos = (0, 0)
+            screen_size = (width*2, width*2)
+
+        """
+        The velocity is set by specifying the phase of the grating at each frame.
+        The phase advances by velocity [periods per second] * seconds per frame at each frame, so the phase at frame n
+        is just n times that. Instead of storing an array of phases we use a Grating_phases object that calculates
+        the phase when it is needed. The sign of the phases depends on the direction of movement
+        """
+        vel = float(params['velocity'])
+
+        # Get phase shift
+        if float(params['direction']) <= 0:
+            direction = -1
+        else:
+            direction = 1
+        phases = Grating_phases(numExpSteps, direction * abs(vel) * screenMs / 1000)
+
+        # Get orientation
+        orientation = int(params['orientation'])
+        if vel < 0:
+            orientation += 180  # make it go in the opposite direction
+
+        # get colors
+        fg = map_color_scale(int(params['fg color']))
+
+        return Grating_schedule(pos, screen_size, orientation, fg, params['spatial frequency'], params['units'], phases)
+
+    def audio_generator(self, monitor, params, screenMs):
+        """ an audio stim is played at the first frame and lasts as many frames as the audio file, just so that we can
+         avoid creating furter stims for the duration of the audio file"""
+        numExpSteps = int(np.round(int(params['duration']) / screenMs))
+        return Audio_schedule(numExpSteps, params.get('filepath', None))
+
+    def delayer(self, monitor, params, screenMs):
+        numExpSteps = int(np.round(int(params['duration']) / screenMs))
+        return Delay_schedule(numExpSteps)
+
+    def complex_fearcon_stim(self, monitor, params, screenMs: float, blackout: int = False, grating: int = False,
+                             ultrasound: int = False, overlap: int = False) -> object:
+        """ Generate a more complex stimulus (combination of different things) specific to the fear-cond experiments
+         This stimulus includes (optionally):
+         * Blackout period before the proper stimulus onset
+         * Grating with variable (optionally): duration, contrast, direction, orientation
+         * Overlapping ultrasound stimulus
+
+         The frames are stored in a structured array with one row per frame and one column per feature
+         [see FEARCOND_TIMELINE_DTYPE], so that the values for a frame can be read with timeline[frame_number]"""
+
+        x, y, width, height = monitor.get_position_in_px('top left', 0, return_scree_size=True)
+        if params['units'] == 'cm':
+            pos = (0, 0)
+            screen_size = (width, width)
+        else:
+            pos = (0, 0)
+            screen_size = (width * 2, width * 2)
+
+        screenMs /= 1000
+
+        # Get the total length of the stimulus (# frames)
+        if blackout: nframes_blackout = int(round(int(params['blackout'])/screenMs))
+        else: nframes_blackout = 0
+
+        if grating: nframes_grating = int(np.ceil(int(params['grating'])/screenMs))
+        else: nframes_grating = 0
+
+        nframes_overlap = 0
+        if ultrasound:
+            if overlap:
+                nframes_overlap = int(round(int(params['overlap'])/screenMs))
+                nframes_ultrasound = int(round(int(params['ultrasound'])/screenMs)) - nframes_overlap
+            else: nframes_ultrasound = int(round(int(params['ultrasound'])/screenMs))
+        else: nframes_ultrasound = 0
+
+        nframes_combined = nframes_blackout + nframes_grating + nframes_ultrasound
+        timeline = np.zeros(nframes_combined, dtype=FEARCOND_TIMELINE_DTYPE)
+
+        # Start filling in the timeline, start with blackout period
+        grating_start, grating_end = nframes_blackout, nframes_blackout + nframes_grating
+        timeline['blackout_on'][:nframes_blackout] = 1
+
+        # now the grating
+        timeline['grating_on'][grating_start:grating_end] = True
+
+        # And then ultrasound, which starts before the end of the grating if they overlap
+        if ultrasound:
+            timeline['ultrasound_on'][grating_end - nframes_overlap:] = True
+
+        """ To display on_frames:
+            import matplotlib.pyplot as plt
+            plt.figure()
+            [plt.plot(timeline[col]) for col in timeline.dtype.names if '_on' in col]
+            plt.show()
+        """
+
+        # Now define varying grating frames
+        """ The varying properties of the grating are defined in the params as prop_name: 'True' and 
+        prop_name_lims: 'x0 - x1', where x0 and x1 outline the range of values. The value goes linearly from x0 to x1 
+        in 'period' seconds and then starts again from x0.
+
+        if a prop is not variable the default value will be used
+        """
+
+        # Default grating variables and params
+        grating_defaults = dict(Orientation=180, Direction=1, Contrast=255)
+        period = int(params['period'])
+        for prop, default in grating_defaults.items():
+            column = 'grating_{}'.format(prop.lower())
+            timeline[column] = default
+
+            if not grating or str(params[prop]) != 'True':
+                continue
+
+            limits = [int(s) for s in params['{}_lims'.format(prop)].split(' - ')]
+            nframes_period = int(np.ceil(period/screenMs))
+            grating_frames = np.arange(nframes_grating)  # frame number relative to the grating onset
+            values = np.linspace(limits[0], limits[1], nframes_period)
+            timeline[column][grating_start:grating_end] = values[grating_frames % nframes_period]
+
+        # Flash the screen on and off during the grating period
+        if grating and str(params.get('flash_screen', False)) == 'True':
+            period = float(params['flash_screen_period'])
+            nframes_period = int(np.ceil(period / screenMs))
+            n_periods = int(np.ceil(int(params['grating']) / period)/2)
+
+            grating_frames = np.arange(nframes_grating)
+            flash_on = ((grating_frames // nframes_period) % 2 == 0) & (grating_frames < 2*nframes_period*n_periods)
+            timeline['blackout_on'][grating_start:grating_end] = np.where(flash_on, 255, 0)
+
+        return Fearcond_schedule(timeline, pos, screen_size, params['spatial frequency'], params['units'],
+                                 int(params['Velocity']), str(params.get('flash_screen', False)) == 'True',
+                                 params['audiostim'])
@@ -0,0 +1,92 @@
+import numpy as np
+
+from Utils.latency_benchmark import timestamp_ns
+
+
+"""
+DIGITAL SYNC OUTPUT LOCKED TO THE FLIPS
+
+Optional sync channel for the acquisition system: a few bytes are written to a serial port [e.g. an arduino that
+turns them into TTL pulses] when a stimulus appears on the screen [onset], when it disappears [offset] and, optionally,
+every N frames of a stimulus [frame marker]. The bytes of each event are precomputed, and the render loop queues them
+with window.callOnFlip, so they are written right after the window is flipped: each event gets an electrical
+timestamp that doesn't depend on reading back the analogue trace of the LDR square.
+How long each write takes is recorded, to check that the sync output doesn't delay the render loop.
+"""
+
+
+ONSET, OFFSET, FRAME = 'onset', 'offset', 'frame'
+
+
+class Sync_output():
+    def __init__(self, ser, patterns, frame_every=0, n_writes=10000):
+        """
+        :param ser: open serial port [anything with write]
+        :param patterns: dict event -> byte or list of bytes written for the event [ONSET, OFFSET and FRAME]
+        :param frame_every: write the FRAME pattern every N frames of a stim, 0 for no frame markers
+        :param n_writes: number of write durations kept for the summary
+        """
+        self.ser = ser
+        self.patterns = {event: bytes(pattern if isinstance(pattern, (list, tuple)) else [pattern])
+                         for event, pattern in patterns.items() if pattern is not None}
+        self.frame_every = int(frame_every or 0)
+
+        self.write_durations = np.zeros(n_writes, dtype=np.int64)  # ns
+        self.n_writes = 0
+        self.counts = {event: 0 for event in self.patterns}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """ Sync output from the sync_output settings in GUI_cfg.yml, None if no port is set """
+        sync_settings = settings.get('sync_output', None)
+        if not sync_settings or not sync_settings.get('port', None):
+            return None
+
+        import serial
+        ser = serial.Serial(sync_settings['port'], sync_settings.get('baud', 115200), write_timeout=0)
+        patterns = {ONSET: sync_settings.get('onset', 1), OFFSET: sync_settings.get('offset', 2),
+                    FRAME: sync_settings.get('frame', 4)}
+        print('Sync output on port {}'.format(sync_settings['port']))
+        return cls(ser, patterns, frame_every=sync_settings.get('frame_every', 0))
+
+    def on_next_flip(self, window, event):
+        """ Write the pattern of the event right after the next flip of the window """
+        if event not in self.patterns:
+            return
+        window.callOnFlip(self.emit, event)
+
+    def on_frame(self, window, frame_number):
+        """ Called for each frame of a stim that is drawn: onset on the first frame, frame markers every N frames """
+        if frame_number == 0:
+            self.on_next_flip(window, ONSET)
+        elif self.frame_every and frame_number % self.frame_every == 0:
+            self.on_next_flip(window, FRAME)
+
+    def emit(self, event):
+        start = timestamp_ns()
+        try:
+            self.ser.write(self.patterns[event])
+        except Exception as e:
+            print('Could not write sync {}: {}'.format(event, e))
+            return
+        self.write_durations[self.n_writes % len(self.write_durations)] = timestamp_ns() - start
+        self.n_writes += 1
+        self.counts[event] += 1
+
+    def write_summary(self):
+        """ Duration of the writes [ms] """
+        durations = self.write_durations[:min(self.n_writes, len(self.write_durations))] / 1e6
+        if not len(durations):
+            return {}
+        return dict(writes=int(self.n_writes), median=float(np.median(durations)),
+                    p95=float(np.percentile(durations, 95)), max=float(np.max(durations)))
+
+    def print_summary(self):
+        summary = self.write_summary()
+        if summary:
+            print('     ... sync output: {}, write duration median {:.3f} ms, 95% {:.3f} ms, max {:.3f} ms'.format(
+                ', '.join('{} {}'.format(count, event) for event, count in self.counts.items()),
+                summary['median'], summary['p95'], summary['max']))
+
+    def close(self):
+        self.ser.close()
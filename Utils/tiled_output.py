@@ -0,0 +1,338 @@
+import time
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+
+from Utils.stimuli_calculator import Stimuli_calculator, Monitor_geometry, map_color_scale
+from Utils.frame_schedules import Audio_schedule, Delay_schedule
+from Utils.frame_state import Frame_state
+from Utils.stim_pool import Stim_pool
+from Utils.compositor import Compositor
+from Utils.stim_stream import Stream_segment
+
+
+"""
+TILED OUTPUT: SHOW THE STIMULI ON SEVERAL DISPLAYS IN LOCK-STEP
+
+The main psychopy window can be extended with tiles: other windows, each on its own display and with its own monitor
+profile [a Screens/*.yml file]. The frame schedule of each stim is calculated for every tile with the geometry of its
+monitor [so a loom that is 10 deg wide is 10 deg wide on every display], in the background when the stim is armed
+[see Tiled_output.arm], from the params of the main window's schedule: a stim with a random duration lasts as long on
+every display. All the tiles are driven by the same frame number as the main window. The tiles are flipped right
+before the main window, without waiting for the screen refresh: the flip of the main window is the one that waits, so
+all displays swap on the same refresh.
+Each tile has its own pool of stimulus objects and compositor, and is passed to the renderers instead of Main_UI.
+The windows are created by a backend: Psychopy_backend for the real displays, Dummy_backend to run everything without
+a display [e.g. to test the tiles on a machine without the monitors].
+"""
+
+
+####################################################################################################################
+####################################################################################################################
+"""    BACKENDS   """
+####################################################################################################################
+####################################################################################################################
+
+
+class Psychopy_backend():
+    def __init__(self, units='cm', fullscreen=True, wait_blanking=False):
+        """
+        :param units: default units of the windows
+        :param fullscreen: full screen windows
+        :param wait_blanking: if True flip() waits for the screen refresh
+        """
+        self.units = units
+        self.fullscreen = fullscreen
+        self.wait_blanking = wait_blanking
+
+    def create_window(self, geometry, bg_color):
+        from psychopy import visual, monitors
+        monitor = monitors.Monitor(geometry.name)
+        monitor.setSizePix(geometry.size_pix)
+        monitor.setWidth(geometry.width)
+        monitor.setDistance(geometry.distance)
+
+        # The flip of the main window waits for the screen refresh, tiles are flipped without waiting right before it
+        return visual.Window(list(geometry.size_pix), monitor=monitor, color=[bg_color]*3,
+                             screen=geometry.screen_number, fullscr=self.fullscreen, units=self.units,
+                             waitBlanking=self.wait_blanking)
+
+    def create_square(self, window, width, pos):
+        """ Square for the Light Dependant Resistor """
+        from psychopy import visual
+        return visual.Rect(window, width=width, height=width, pos=pos, units='cm')
+
+    def ms_per_frame(self, window):
+        avg, std, ms_per_frame = window.getMsPerFrame(showVisual=True, msg='Testing refresh rate')
+        return ms_per_frame
+
+    def create_pool(self, window):
+        return Stim_pool(window)
+
+
+class Dummy_stim():
+    def __init__(self, kind, units, n_elements=1):
+        """ Stands in for a psychopy stimulus: it accepts all the properties set by the renderers and counts draws """
+        self.kind, self.units = kind, units
+        self.opacities = np.zeros(n_elements)
+        self.opacity, self.n_draws = 1, 0
+
+    def setFillColor(self, color, colorSpace=None):
+        self.fillColor = color
+
+    def setLineColor(self, color, colorSpace=None):
+        self.lineColor = color
+
+    def setColor(self, color, colorSpace=None):
+        self.color = color
+
+    def draw(self):
+        self.n_draws += 1
+
+
+class Dummy_window():
+    def __init__(self, geometry, bg_color, frame_ms=1000 / 60, wait_blanking=False):
+        """
+        Stands in for a psychopy window, time advances by one screen refresh at each flip. If wait_blanking is True
+        flip() sleeps until the next refresh would have happened
+        """
+        self.geometry = geometry
+        self.color = [bg_color]*3
+        self.frame_ms = frame_ms
+        self.wait_blanking = wait_blanking
+        self.n_flips = 0
+        self.start = time.perf_counter()
+        self.on_flip = []  # functions to call after the next flip
+
+    def setColor(self, color):
+        self.color = color
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self.on_flip.append((function, args, kwargs))
+
+    def flip(self):
+        self.n_flips += 1
+        flip_time = self.n_flips * self.frame_ms / 1000
+        if self.wait_blanking:
+            time.sleep(max(0, flip_time - (time.perf_counter() - self.start)))
+        for function, args, kwargs in self.on_flip:
+            function(*args, **kwargs)
+        self.on_flip = []
+        return flip_time
+
+    def close(self):
+        pass
+
+
+class Dummy_pool(Stim_pool):
+    def build(self, kind, units):
+        if kind not in self.KINDS:
+            raise ValueError('Unrecognised kind of stimulus: {}'.format(kind))
+        return Dummy_stim(kind, units, n_elements=self.BATCH_SIZE if kind == 'circle_array' else 1)
+
+
+class Dummy_backend():
+    """ Windows and stimuli that don't need a display or psychopy """
+    def __init__(self, frame_ms=1000 / 60, wait_blanking=False):
+        self.frame_ms = frame_ms
+        self.wait_blanking = wait_blanking
+
+    def create_window(self, geometry, bg_color):
+        return Dummy_window(geometry, bg_color, self.frame_ms, self.wait_blanking)
+
+    def create_square(self, window, width, pos):
+        return Dummy_stim('square', 'cm')
+
+    def ms_per_frame(self, window):
+        return self.frame_ms
+
+    def create_pool(self, window):
+        return Dummy_pool(window)
+
+
+####################################################################################################################
+####################################################################################################################
+"""    TILES   """
+####################################################################################################################
+####################################################################################################################
+
+
+class Tile():
+    def __init__(self, name, geometry, settings):
+        """
+        One extra display. It has the same attributes that the renderers use on Main_UI, so it can be passed to them
+
+        :param name: name of the tile
+        :param geometry: Monitor_geometry of the display
+        :param settings: settings from GUI_cfg.yml
+        """
+        self.name = name
+        self.geometry = geometry
+        self.settings = settings
+
+        self.psypy_window, self.stim_pool, self.compositor = None, None, None  # set by Tiled_output.open
+        self.bg_luminosity = settings['default_bg']
+        self.stim_timer = None
+        self.frame_state = Frame_state()
+        self.plays_audio = False  # audio is played by the main window only
+
+    def open(self, backend):
+        self.psypy_window = backend.create_window(self.geometry, map_color_scale(int(self.settings['default_bg'])))
+        self.stim_pool = backend.create_pool(self.psypy_window)
+        self.compositor = Compositor(self.stim_pool)
+
+    def change_bg_lum(self):
+        lum = min(int(self.bg_luminosity or 0), 255)
+        if self.frame_state.changed('bg', lum):
+            lum = map_color_scale(lum)
+            self.psypy_window.setColor([lum, lum, lum])
+
+
+class Tiled_output():
+    def __init__(self, tiles, backend, max_armed=64, n_flips=10000):
+        """
+        :param tiles: list of Tile
+        :param backend: creates the windows and the stimuli [Psychopy_backend or Dummy_backend]
+        :param max_armed: number of stims whose tile schedules are kept, the oldest are forgotten
+        :param n_flips: number of flip times kept for the summary
+        """
+        self.tiles = tiles
+        self.backend = backend
+        # time it takes to issue the flips of all the tiles, stims only [ms]. The tiles don't wait for the refresh, so
+        # this is not when the displays swap: they swap on the refresh the main window waits for
+        self.flip_issue_ms = deque(maxlen=n_flips)
+
+        # schedule of the main window -> (that schedule, list of schedules of the tiles), set by arm
+        self.armed = OrderedDict()
+        self.max_armed = max_armed
+        self.lock = threading.Lock()  # stims are armed by several threads
+
+    @classmethod
+    def from_settings(cls, settings, backend=None):
+        """
+        Create the tiles listed in GUI_cfg.yml, e.g.
+            tiles:
+                - screen: 'Projector_LG'    # name of a Screens/*.yml file
+        """
+        if backend is None:
+            backend = Psychopy_backend(units=settings['unit'], fullscreen=settings['fullscreen'])
+        tiles = []
+        for tile_settings in settings.get('tiles', None) or []:
+            geometry = Monitor_geometry.from_settings(dict(Name=tile_settings['screen']))
+            tiles.append(Tile(tile_settings.get('name', tile_settings['screen']), geometry, settings))
+        return cls(tiles, backend)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def open(self, pool_units):
+        """ Create the windows and the stimulus objects of all the tiles """
+        for tile in self.tiles:
+            tile.open(self.backend)
+            tile.stim_pool.prebuild(pool_units)
+            tile.psypy_window.flip()
+
+    @staticmethod
+    def tile_params(params, n_frames, screenMs):
+        """ Params used to calculate the stim on the tiles: the same as the main window, but a random duration is
+        replaced by the duration the stim has in the main window """
+        if not Stimuli_calculator.is_random(params):
+            return params
+        params = dict(params)
+        params['duration'] = '{},0'.format(int(round(n_frames * screenMs)))
+        return params
+
+    def tile_schedules(self, params, schedule, get_schedule, screenMs):
+        """ Schedule of a stim for each tile, given its params and schedule in the main window """
+        if isinstance(schedule, Audio_schedule):
+            return [Delay_schedule(schedule.n_frames) for tile in self.tiles]  # audio is played by the main window only
+        elif isinstance(schedule, Delay_schedule):
+            return [schedule for tile in self.tiles]
+        params = self.tile_params(params, schedule.n_frames, screenMs)
+        return [get_schedule(params, screenMs, tile.geometry) for tile in self.tiles]
+
+    def arm(self, params, schedule, get_schedule, screenMs):
+        """
+        Calculate the schedules of a stim for the tiles, called in the background when the stim is armed
+
+        :param params: params of the stim
+        :param schedule: its schedule in the main window
+        :param get_schedule: function that given the stim params, ms per frame and monitor geometry returns the schedule
+        :param screenMs: ms per frame
+        """
+        if not self.tiles:
+            return
+        schedules = self.tile_schedules(params, schedule, get_schedule, screenMs)
+        with self.lock:
+            self.armed[id(schedule)] = (schedule, schedules)
+            self.armed.move_to_end(id(schedule))
+            while len(self.armed) > self.max_armed:
+                self.armed.popitem(last=False)
+
+    def load_segment(self, segment, get_schedule, screenMs):
+        """
+        Add the stims of a segment to the tiles' compositors, with the schedules calculated when they were armed [if
+        they weren't, they are calculated now]
+
+        :param segment: Stream_segment or Layered_segment being played in the main window
+        :param get_schedule: function that given the stim params, ms per frame and monitor geometry returns the schedule
+        :param screenMs: ms per frame
+        """
+        if not self.tiles:
+            return
+        layers = [[] for tile in self.tiles]
+        for seg, z in segment.layers:
+            armed = self.armed.get(id(seg.schedule), None)
+            if armed is not None and armed[0] is seg.schedule:
+                schedules = armed[1]
+            else:
+                schedules = self.tile_schedules(seg.params, seg.schedule, get_schedule, screenMs)
+            for tile_layers, schedule in zip(layers, schedules):
+                tile_layers.append((Stream_segment(seg.name, seg.params, schedule, z=z), z))
+        for tile, tile_layers in zip(self.tiles, layers):
+            tile.compositor.add_layers(tile_layers)
+
+    def update(self, frame_number, bg_luminosity):
+        """
+        Update the stims of all the tiles for a frame of the shared timeline
+
+        :param frame_number: frame number of the segment being played, None if no stim is being played
+        :param bg_luminosity: background luminosity of the main window
+        """
+        for tile in self.tiles:
+            tile.bg_luminosity = bg_luminosity
+            if frame_number is not None:
+                tile.compositor.update(tile, frame_number)
+            tile.change_bg_lum()  # after the renderers, which might change the background [e.g. fear conditioning]
+
+    def draw(self):
+        for tile in self.tiles:
+            tile.compositor.draw()
+
+    def flip(self, playing=False):
+        """
+        Flip all the tiles without waiting, the main window is flipped right after and waits for the refresh
+
+        :param playing: True if a stim is being played, only then the time it takes to issue the flips is recorded
+        """
+        if not self.tiles:
+            return
+        start = time.perf_counter()
+        for tile in self.tiles:
+            tile.psypy_window.flip()
+        if playing:
+            self.flip_issue_ms.append((time.perf_counter() - start) * 1000)
+
+    def clear(self):
+        for tile in self.tiles:
+            tile.compositor.clear()
+
+    def print_flip_issue_time(self):
+        if self.flip_issue_ms:
+            print('     ... time to issue the flips of {} tiles: avg {} ms, max {} ms'.format(
+                len(self), round(np.mean(self.flip_issue_ms), 2), round(np.max(self.flip_issue_ms), 2)))
+            self.flip_issue_ms.clear()
+
+    def close(self):
+        for tile in self.tiles:
+            tile.psypy_window.close()
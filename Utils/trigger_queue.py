@@ -0,0 +1,133 @@
+from collections import deque, namedtuple
+
+from Utils.latency_benchmark import timestamp_ns
+
+
+"""
+TRIGGER QUEUE
+
+All the triggers [GUI buttons, arduino, mantis, control server, benchmark] are put in one queue and the render loop
+takes them out at the start of a frame, so stims are only ever started by the render thread, between two frames.
+Producers only append to a deque and the render thread only pops from it [both are atomic], so no lock is needed and
+a trigger never waits for the render loop.
+When the render loop takes the triggers out:
+    * debounce: a trigger that comes less than debounce_ms after the previous one from the same source is ignored
+    * minimum ISI: a stim is not started less than min_isi_ms after the previous one
+    * policy: a trigger that can't be played straight away [a stim is playing, or it's too soon] is either dropped
+      ['drop', what used to happen] or kept until it can be played ['queue', up to max_queued triggers]
+The render loop tells the queue if the trigger it took out was actually played [e.g. it is not if the GUI is still
+loading]: only then the launch is counted and the minimum ISI starts. The triggers that were dropped, deferred,
+debounced and that couldn't be played are counted.
+"""
+
+
+POLICIES = ('drop', 'queue')
+
+Trigger = namedtuple('Trigger', 'source t_ns stim_name play')
+
+
+class Trigger_queue():
+    def __init__(self, debounce_ms=0, min_isi_ms=0, policy='drop', max_queued=8):
+        """
+        :param debounce_ms: triggers from the same source closer than this are ignored
+        :param min_isi_ms: min time between the start of two stims
+        :param policy: 'drop' or 'queue' the triggers that can't be played straight away
+        :param max_queued: max number of triggers waiting to be played with the 'queue' policy
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unrecognised trigger policy: {}, use one of {}'.format(policy, POLICIES))
+        self.debounce_ns = int(debounce_ms * 1e6)
+        self.min_isi_ns = int(min_isi_ms * 1e6)
+        self.policy = policy
+        self.max_queued = max_queued
+
+        self.incoming = deque()  # appended by any thread, popped by the render thread
+        self.waiting = deque()  # render thread only: triggers that will be played when possible
+        self.last_from_source = {}  # source -> time of its last trigger that wasn't debounced
+        self.last_launch_ns = None
+        self.accepting = True  # set by the render thread: False if new triggers would be dropped
+
+        self.received, self.launched, self.dropped, self.deferred, self.debounced = 0, 0, 0, 0, 0
+        self.failed = 0  # taken out of the queue but not played
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(**(settings.get('trigger_queue', None) or {}))
+
+    def put(self, source, t_ns=None, stim_name=None, play=None):
+        """
+        Add a trigger, from any thread. Returns False if the trigger will most likely be dropped [e.g. a stim is
+        playing and the policy is 'drop']
+
+        :param source: what triggered the stim [GUI, arduino, mantis...]
+        :param t_ns: when the trigger was received, if None it is taken now
+        :param stim_name: name of the stim to play [or list of names], looked up when the trigger is received
+        :param play: function(main, source, t_ns, stim_name) that starts the stim[s], returns True if it did
+        """
+        if t_ns is None:
+            t_ns = timestamp_ns()
+        self.incoming.append(Trigger(source, t_ns, stim_name, play))
+        return self.accepting
+
+    def has_pending(self):
+        return bool(self.incoming) or bool(self.waiting)
+
+    def next_trigger(self, busy, now_ns=None):
+        """
+        Called by the render thread at the start of a frame, returns the trigger to play now or None. Once it has
+        been played call played()
+
+        :param busy: True if a stim is being played
+        :param now_ns: current time, if None it is taken now
+        """
+        if now_ns is None:
+            now_ns = timestamp_ns()
+        too_soon = self.last_launch_ns is not None and now_ns - self.last_launch_ns < self.min_isi_ns
+        can_play = not busy and not too_soon
+
+        play_now = None
+        if can_play and self.waiting:
+            play_now = self.waiting.popleft()  # the oldest trigger waiting goes first
+
+        while self.incoming:
+            trigger = self.incoming.popleft()
+            self.received += 1
+
+            last = self.last_from_source.get(trigger.source, None)
+            if last is not None and trigger.t_ns - last < self.debounce_ns:
+                self.debounced += 1
+                continue
+            self.last_from_source[trigger.source] = trigger.t_ns
+
+            if can_play and play_now is None:
+                play_now = trigger
+            elif self.policy == 'queue' and len(self.waiting) < self.max_queued:
+                self.waiting.append(trigger)
+                self.deferred += 1
+            else:
+                self.dropped += 1
+
+        if play_now is not None:
+            can_play = False  # most likely a stim is playing from now on
+
+        self.accepting = can_play or (self.policy == 'queue' and len(self.waiting) < self.max_queued)
+        return play_now
+
+    def played(self, launched, now_ns=None):
+        """
+        Called by the render thread after playing the trigger returned by next_trigger
+
+        :param launched: True if the stim[s] started, only then the launch is counted and the min ISI starts
+        :param now_ns: time at which the stim was started, if None it is taken now
+        """
+        if not launched:
+            self.failed += 1
+            return
+        self.last_launch_ns = timestamp_ns() if now_ns is None else now_ns
+        self.launched += 1
+
+    def print_summary(self):
+        if self.dropped or self.deferred or self.debounced or self.failed:
+            print('     ... triggers: {} received, {} launched, {} dropped, {} deferred, {} debounced, {} not played, '
+                  '{} waiting'.format(self.received, self.launched, self.dropped, self.deferred, self.debounced,
+                                      self.failed, len(self.waiting)))